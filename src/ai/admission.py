@@ -0,0 +1,137 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+
+# Контроль допуска перед пайплайном с LLM: одновременно работают не больше max_active запросов,
+# остальные ждут в ограниченной очереди с приоритетом (срочные — вперед). Если очередь полна
+# или ожидаемое ожидание не укладывается в бюджет запроса, запрос сбрасывается (Overloaded) —
+# вызывающий отвечает из поиска без LLM или 503, а не копит хвост за лимитом хаба.
+
+URGENT, NORMAL = 0, 1  # меньше — важнее
+
+
+class Overloaded(Exception):
+    """Запрос не допущен: reason — queue_full / wait / timeout / preempted, retry_after — оценка, когда приходить снова."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"Перегрузка ({reason}), повторить через {retry_after:.1f} с")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    acquire/release или slot(): слот на весь запрос. Освободившийся слот передается первому
+    ожидающему напрямую (active не падает), поэтому новый запрос не обгоняет очередь.
+    Оценка ожидания: (впереди + 1) * среднее время занятия слота / max_active.
+    """
+
+    def __init__(self, max_active: int, queue_size: int, smoothing: float = 0.2):
+        self.max_active = max(1, max_active)
+        self.queue_size = max(0, queue_size)
+        self.smoothing = smoothing
+        self.active = 0
+        self._waiters = []  # куча (priority, seq, future)
+        self._seq = itertools.count()
+        self.service_time = None  # EWMA длительности занятия слота, секунды
+        self.admitted = 0
+        self.queued = 0
+        self.max_depth = 0
+        self.shed = Counter()
+
+    def depth(self) -> int:
+        return len(self._waiters)
+
+    def estimated_wait(self, ahead: int) -> float | None:
+        """Сколько ждать слота при ahead ожидающих впереди; None — пока нет замеров."""
+        if self.service_time is None:
+            return None
+        return (ahead + 1) * self.service_time / self.max_active
+
+    def _overloaded(self, reason: str, ahead: int) -> Overloaded:
+        self.shed[reason] += 1
+        return Overloaded(reason, max(1.0, self.estimated_wait(ahead) or 1.0))
+
+    async def acquire(self, priority: int = NORMAL, max_wait: float | None = None):
+        """Ждет слот не дольше max_wait (None — без ограничения); не дождался — Overloaded."""
+        if self.active < self.max_active and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+        ahead = sum(1 for p, _, _ in self._waiters if p <= priority)
+        estimate = self.estimated_wait(ahead)
+        if max_wait is not None and (max_wait <= 0 or (estimate is not None and estimate > max_wait)):
+            raise self._overloaded("wait", ahead)
+        if len(self._waiters) >= self.queue_size:
+            # Очередь полна: срочный запрос вытесняет самый поздний из менее важных, иначе сброс
+            victim = max(self._waiters, default=None)
+            if victim is None or victim[0] <= priority:
+                raise self._overloaded("queue_full", ahead)
+            self._remove(victim)
+            victim[2].set_exception(self._overloaded("preempted", len(self._waiters)))
+
+        entry = (priority, next(self._seq), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, entry)
+        self.queued += 1
+        self.max_depth = max(self.max_depth, len(self._waiters))
+        try:
+            done, _ = await asyncio.wait({entry[2]}, timeout=max_wait)
+        except asyncio.CancelledError:
+            self._abandon(entry)
+            raise
+        if not done:
+            self._abandon(entry)
+            raise self._overloaded("timeout", ahead)
+        entry[2].result()  # вытесненный получает Overloaded
+        self.admitted += 1
+
+    def release(self, held: float | None = None):
+        """Освобождает слот; held — сколько он был занят (для оценки ожидания)."""
+        if held is not None:
+            self.service_time = held if self.service_time is None else (
+                (1 - self.smoothing) * self.service_time + self.smoothing * held
+            )
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)  # слот переходит к ожидающему
+                return
+        self.active -= 1
+
+    def _remove(self, entry):
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+
+    def _abandon(self, entry):
+        future = entry[2]
+        if future.done() and not future.cancelled() and future.exception() is None:
+            self.release()  # слот уже передали, а ждать перестали — отдаем следующему
+            return
+        if entry in self._waiters:
+            self._remove(entry)
+        future.cancel()
+
+    @asynccontextmanager
+    async def slot(self, priority: int = NORMAL, max_wait: float | None = None):
+        await self.acquire(priority, max_wait)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def stats(self) -> dict:
+        return {
+            "max_active": self.max_active,
+            "active": self.active,
+            "queue_depth": len(self._waiters),
+            "queue_size": self.queue_size,
+            "max_depth": self.max_depth,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed": dict(self.shed),
+            "service_time": round(self.service_time, 3) if self.service_time is not None else None,
+        }
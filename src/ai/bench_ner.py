@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import glob
+import json
+import statistics
+import time
+from pathlib import Path
+
+from . import main as server
+
+# Сравнение бэкендов NER для второго поиска: llm (запрос к хабу), local (словарь терминов)
+# и none (второй поиск по сырому тексту). Латентность саммари и recall поиска на data/test_set:
+# протокол кейса в top-5 уникальных протоколов и код МКБ gt среди их кодов.
+# Запуск из корня репозитория: python -m src.ai.bench_ner -d data/test_set -n 50
+
+BACKENDS = ("llm", "local", "none")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def run_case(case, generation, backend, top_k):
+    query = case["query"]
+    start = time.perf_counter()
+    summary = query if backend == "none" else await server.clinical_summary(query, generation, backend)
+    ner_ms = (time.perf_counter() - start) * 1000
+    res_raw, res_med, res_lex = await asyncio.gather(
+        server.search_text(generation.store, query), server.search_text(generation.store, summary),
+        server.search_lexical(generation, f"{query} {summary}"),
+    )
+    meta = await server.protocol_index(generation)
+    ranked = server.rank_protocols(query, res_raw, res_med, res_lex, meta, top_k=top_k)
+    codes = {str(c).strip() for p in ranked for c in p.payload.get("icd_codes", [])}
+    return {
+        "summary": summary,
+        "ner_ms": round(ner_ms, 2),
+        "protocol_hit": int(case.get("protocol_id") in [p.payload["protocol_id"] for p in ranked]),
+        "code_hit": int(str(case.get("gt")).strip() in codes),
+    }
+
+
+async def run_benchmark(data_dir, limit, backends, top_k, output):
+    files = sorted(glob.glob(f"{data_dir}/*.json"))[:limit]
+    if not files:
+        print(f"❌ Ошибка: В директории {data_dir} не найдено JSON файлов.")
+        return
+    cases = [json.load(open(f, encoding="utf-8")) for f in files]
+
+    await server.startup_event()
+    try:
+        generation = server.index.current
+        results = {}
+        for backend in backends:
+            if backend == "local":
+                await server.clinical_terms(generation)  # загрузка словаря не входит в латентность
+            rows = []
+            for case in cases:
+                try:
+                    rows.append(await run_case(case, generation, backend, top_k))
+                except Exception as e:
+                    print(f"\n❌ {backend}: ошибка на кейсе {case.get('protocol_id')}: {e}")
+            results[backend] = rows
+    finally:
+        await server.shutdown_event()
+
+    print("\n" + "=" * 30)
+    summary = {}
+    for backend, rows in results.items():
+        if not rows:
+            continue
+        latencies = [r["ner_ms"] for r in rows]
+        summary[backend] = {
+            "count": len(rows),
+            f"protocol_recall_at_{top_k}": sum(r["protocol_hit"] for r in rows) / len(rows),
+            f"code_recall_at_{top_k}": sum(r["code_hit"] for r in rows) / len(rows),
+            "ner_mean_ms": statistics.mean(latencies),
+            "ner_p50_ms": percentile(latencies, 0.5),
+            "ner_p95_ms": percentile(latencies, 0.95),
+        }
+        m = summary[backend]
+        print(
+            f"🧪 {backend:>5}: protocol@{top_k} {m[f'protocol_recall_at_{top_k}']:.4f} | code@{top_k} "
+            f"{m[f'code_recall_at_{top_k}']:.4f} | NER mean {m['ner_mean_ms']:.1f} ms"
+            f" | p50 {m['ner_p50_ms']:.1f} ms | p95 {m['ner_p95_ms']:.1f} ms"
+        )
+    print("=" * 30)
+
+    output_file = Path(output)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump({"summary": summary, "details": results}, f, indent=2, ensure_ascii=False)
+    print(f"📄 Подробный отчет сохранен в {output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--data_dir", default="data/test_set", help="Путь к папке test_set")
+    parser.add_argument("-n", "--limit", type=int, default=50, help="Сколько кейсов взять")
+    parser.add_argument("-b", "--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("-k", "--top_k", type=int, default=5, help="Сколько уникальных протоколов считать")
+    parser.add_argument("-o", "--output", default="data/evals/ner_benchmark.json")
+
+    args = parser.parse_args()
+    asyncio.run(run_benchmark(args.data_dir, args.limit, args.backends, args.top_k, args.output))
@@ -0,0 +1,66 @@
+import argparse
+import glob
+import json
+import statistics
+import time
+from sentence_transformers import SentenceTransformer
+from config import MODEL_PATH, DB_PATH, COLLECTION_NAME, NUMPY_DB_PATH, MANIFEST_PATH, INDEX_ROOT, EMBED_CACHE_DIR
+from embedding_cache import CachedEncoder
+from vector_store import QdrantStore, NumpyStore
+from index_generations import IndexPaths, resolve_index
+
+# Сравнение задержки поиска: встроенный Qdrant против точного поиска матрицей NumPy.
+# Запуск из корня репозитория: python src/ai/bench_vector_store.py -d data/test_set
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def time_per_query(store, vectors, limit, repeats):
+    latencies = []
+    for _ in range(repeats):
+        for v in vectors:
+            start = time.perf_counter()
+            store.search(v, limit)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def run_benchmark(data_dir, n_queries, limit, repeats):
+    encoder = CachedEncoder(SentenceTransformer(MODEL_PATH), MODEL_PATH, EMBED_CACHE_DIR, "query")
+    files = sorted(glob.glob(f"{data_dir}/*.json"))[:n_queries]
+    queries = [json.load(open(f, encoding="utf-8"))["query"] for f in files]
+    vectors = encoder.encode([f"query: {q[:1000]}" for q in queries], batch_size=32).tolist()
+    print(f"🧪 {len(vectors)} запросов, limit={limit}, повторов={repeats}")
+
+    _, paths = resolve_index(INDEX_ROOT, IndexPaths(DB_PATH, NUMPY_DB_PATH, MANIFEST_PATH))
+    stores = {"qdrant": QdrantStore(paths.db, COLLECTION_NAME), "numpy": NumpyStore(paths.numpy)}
+    results = {}
+    for name, store in stores.items():
+        store.search(vectors[0], limit)  # прогрев
+        latencies = time_per_query(store, vectors, limit, repeats)
+        results[name] = [hit.id for hit in store.search(vectors[0], limit)]
+        print(
+            f"{name:>7}: {store.count()} точек | mean {statistics.mean(latencies):.3f} ms"
+            f" | p50 {percentile(latencies, 0.5):.3f} ms | p95 {percentile(latencies, 0.95):.3f} ms"
+        )
+
+    start = time.perf_counter()
+    stores["numpy"].search_batch(vectors, limit)
+    batch_ms = (time.perf_counter() - start) * 1000
+    print(f"  numpy батчем: {batch_ms:.3f} ms на {len(vectors)} запросов ({batch_ms / len(vectors):.3f} ms/запрос)")
+
+    overlap = len(set(results["qdrant"]) & set(results["numpy"])) / max(len(results["qdrant"]), 1)
+    print(f"🎯 Совпадение top-{limit} (первый запрос): {overlap:.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--data_dir", default="data/test_set", help="Папка с тестовыми кейсами")
+    parser.add_argument("-n", "--n_queries", type=int, default=50)
+    parser.add_argument("-k", "--limit", type=int, default=30)
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    args = parser.parse_args()
+    run_benchmark(args.data_dir, args.n_queries, args.limit, args.repeats)
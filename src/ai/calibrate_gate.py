@@ -0,0 +1,135 @@
+import argparse
+import json
+import statistics
+import time
+from pathlib import Path
+
+import requests
+from tqdm import tqdm
+
+# Калибровка гейта LLM (LLM_GATE_MIN_SCORE / LLM_GATE_MIN_MARGIN) на data/test_set.
+# Каждый кейс гоняется через работающий сервер дважды: X-LLM-Gate: retrieval (ответ из поиска)
+# и X-LLM-Gate: llm (всегда через LLM), кэш ответов отключен. Скоры гейта сервер отдает в X-LLM-Gate-Scores.
+#
+#   python src/ai/calibrate_gate.py -e http://localhost:8000/diagnose -d data/test_set -n 40
+
+# Скор гейта — RRF (при RRF_K=60 не больше 3/61 ~ 0.049) плюс 10.0 за код МКБ
+SCORE_GRID = [0.0, 0.02, 0.025, 0.03, 0.035, 0.04, 0.045, 10.0]
+MARGIN_GRID = [0.0, 0.001, 0.002, 0.005, 0.01, 0.02, 1.0, 5.0]
+
+
+def call(endpoint, query, mode):
+    start_time = time.time()
+    response = requests.post(
+        endpoint, json={"symptoms": query}, timeout=180,
+        headers={"X-LLM-Gate": mode, "Cache-Control": "no-cache"},
+    )
+    response.raise_for_status()
+    latency = (time.time() - start_time) * 1000
+    codes = [d.get("icd_code") for d in response.json().get("diagnoses", [])]
+    scores = dict(
+        part.strip().split("=") for part in response.headers.get("X-LLM-Gate-Scores", "").split(";") if "=" in part
+    )
+    return codes, latency, {k: float(v) for k, v in scores.items()}
+
+
+def path_metrics(cases, key):
+    if not cases:
+        return {"count": 0, "accuracy_at_1": 0.0, "avg_latency": 0.0, "p50_latency": 0.0}
+    return {
+        "count": len(cases),
+        "accuracy_at_1": sum(c[key]["hit"] for c in cases) / len(cases),
+        "avg_latency": statistics.mean(c[key]["latency"] for c in cases),
+        "p50_latency": statistics.median(c[key]["latency"] for c in cases),
+    }
+
+
+def simulate(cases, min_score, min_margin):
+    """Что дал бы гейт с такими порогами: доля ответов без LLM, их точность и итоговая точность/латентность."""
+    gated = [c for c in cases if c["top1"] >= min_score and c["margin"] >= min_margin]
+    rest = [c for c in cases if not (c["top1"] >= min_score and c["margin"] >= min_margin)]
+    blended_hits = sum(c["retrieval"]["hit"] for c in gated) + sum(c["llm"]["hit"] for c in rest)
+    blended_latency = sum(c["retrieval"]["latency"] for c in gated) + sum(c["llm"]["latency"] for c in rest)
+    return {
+        "min_score": min_score,
+        "min_margin": min_margin,
+        "coverage": len(gated) / len(cases),
+        "gated_accuracy": sum(c["retrieval"]["hit"] for c in gated) / len(gated) if gated else None,
+        "llm_accuracy_on_gated": sum(c["llm"]["hit"] for c in gated) / len(gated) if gated else None,
+        "accuracy_at_1": blended_hits / len(cases),
+        "avg_latency": blended_latency / len(cases),
+    }
+
+
+def run_calibration(endpoint, data_dir, limit, output):
+    test_files = sorted(Path(data_dir).glob("*.json"))[:limit]
+    if not test_files:
+        print(f"❌ Ошибка: В директории {data_dir} не найдено JSON файлов.")
+        return
+
+    cases = []
+    for test_file in tqdm(test_files, desc="Calibrate"):
+        with open(test_file, "r", encoding="utf-8") as f:
+            test_case = json.load(f)
+        ground_truth = str(test_case.get("gt")).strip()
+        case = {"file": test_file.name, "gt": ground_truth}
+        try:
+            for mode in ("retrieval", "llm"):
+                codes, latency, scores = call(endpoint, test_case["query"], mode)
+                case[mode] = {
+                    "pred": codes[:3],
+                    "hit": int(bool(codes) and str(codes[0]).strip() == ground_truth),
+                    "latency": round(latency, 2),
+                }
+                case.setdefault("top1", scores.get("top1", 0.0))
+                case.setdefault("margin", scores.get("margin", 0.0))
+        except Exception as e:
+            print(f"\n❌ Ошибка на файле {test_file.name}: {e}")
+            continue
+        cases.append(case)
+
+    if not cases:
+        return
+
+    paths = {"retrieval": path_metrics(cases, "retrieval"), "llm": path_metrics(cases, "llm")}
+    # К фиксированной сетке добавляем квартили реальных top1 — шкала скоров зависит от модели
+    score_grid = SCORE_GRID
+    if len(cases) > 1:
+        quartiles = statistics.quantiles([c["top1"] for c in cases], n=4)
+        score_grid = sorted(set(SCORE_GRID + [round(q, 3) for q in quartiles]))
+    grid = [simulate(cases, s, m) for s in score_grid for m in MARGIN_GRID]
+    # Лучшие пороги: не хуже чистого LLM по точности, при этом максимум ответов без LLM
+    llm_accuracy = paths["llm"]["accuracy_at_1"]
+    candidates = [g for g in grid if g["accuracy_at_1"] >= llm_accuracy] or grid
+    best = max(candidates, key=lambda g: (g["accuracy_at_1"], g["coverage"]))
+
+    print("\n" + "=" * 30)
+    for name, m in paths.items():
+        print(f"🛣 {name:9} Accuracy@1: {m['accuracy_at_1']:.4f}  Avg Latency: {m['avg_latency']:.0f} ms  p50: {m['p50_latency']:.0f} ms")
+    print("-" * 30)
+    print(f"{'min_score':>9} {'margin':>7} {'coverage':>8} {'gated@1':>8} {'acc@1':>7} {'latency':>9}")
+    for g in sorted(grid, key=lambda g: (-g["accuracy_at_1"], -g["coverage"]))[:15]:
+        gated = f"{g['gated_accuracy']:.3f}" if g["gated_accuracy"] is not None else "-"
+        print(f"{g['min_score']:>9.2f} {g['min_margin']:>7.2f} {g['coverage']:>8.2%} {gated:>8} "
+              f"{g['accuracy_at_1']:>7.3f} {g['avg_latency']:>7.0f}ms")
+    print("-" * 30)
+    print(f"✅ Рекомендация: LLM_GATE_MIN_SCORE={best['min_score']} LLM_GATE_MIN_MARGIN={best['min_margin']} "
+          f"(без LLM {best['coverage']:.0%} запросов, Accuracy@1 {best['accuracy_at_1']:.4f})")
+    print("=" * 30)
+
+    output_file = Path(output)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump({"paths": paths, "grid": grid, "best": best, "details": cases}, f, indent=2, ensure_ascii=False)
+    print(f"📄 Подробный отчет сохранен в {output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--endpoint", default="http://localhost:8000/diagnose", help="URL API /diagnose")
+    parser.add_argument("-d", "--data_dir", default="data/test_set", help="Путь к папке test_set")
+    parser.add_argument("-n", "--limit", type=int, default=50, help="Сколько кейсов взять")
+    parser.add_argument("-o", "--output", default="data/evals/gate_calibration.json")
+
+    args = parser.parse_args()
+    run_calibration(args.endpoint, args.data_dir, args.limit, args.output)
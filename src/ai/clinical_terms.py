@@ -0,0 +1,200 @@
+import json
+import os
+import re
+from collections import Counter, defaultdict
+
+try:
+    from .text_ru import STOPWORDS, negation_flags, stem, tokenize
+except ImportError:
+    from text_ru import STOPWORDS, negation_flags, stem, tokenize
+
+# Локальная замена NER-вызова LLM: словарь терминов из проиндексированных протоколов
+# (секции complaints/criteria/definition), бытовые формулировки -> медицинские термины
+# и отрицания ("нет температуры" в саммари не попадает). Только CPU, без моделей.
+
+TERM_SECTIONS = ("complaints", "criteria", "definition")
+MAX_NGRAM = 3
+RE_ICD_CODE = re.compile(r"\b[A-ZА-Я]\d{2}(?:\.\d{1,2})?\b")
+# Одиночное прилагательное ("верхней", "тяжелой") без существительного в саммари бесполезно
+ADJECTIVE_ENDINGS = ("ый", "ий", "ой", "ая", "яя", "ое", "ее", "ые", "ие", "ого", "его", "ому", "ему", "ыми", "ими", "ых", "их", "ую", "юю")
+
+# Как пациенты описывают жалобы -> как это написано в протоколах.
+# Ключи стеммятся при загрузке, поэтому формы слова ("болит"/"болело") писать не нужно.
+LAY_TERMS = {
+    "болит живот": "боль в животе",
+    "болит голова": "головная боль",
+    "болит горло": "боль в горле",
+    "болит грудь": "боль в грудной клетке",
+    "болит спина": "боль в спине",
+    "болит поясница": "боль в поясничной области",
+    "болит сердце": "боль в области сердца",
+    "болит ухо": "боль в ухе",
+    "болят суставы": "артралгия",
+    "болят мышцы": "миалгия",
+    "колет в боку": "боль в боку",
+    "температура": "лихорадка",
+    "жар": "лихорадка",
+    "знобит": "озноб",
+    "тошнит": "тошнота",
+    "рвет": "рвота",
+    "вырвало": "рвота",
+    "понос": "диарея",
+    "жидкий стул": "диарея",
+    "запор": "запор",
+    "изжога": "изжога",
+    "кашляет": "кашель",
+    "задыхается": "одышка",
+    "тяжело дышать": "одышка",
+    "сопли": "ринорея",
+    "насморк": "ринорея",
+    "заложен нос": "заложенность носа",
+    "кружится голова": "головокружение",
+    "давление": "артериальная гипертензия",
+    "высокое давление": "артериальная гипертензия",
+    "низкое давление": "артериальная гипотензия",
+    "сердцебиение": "тахикардия",
+    "сердце колотится": "тахикардия",
+    "отекают ноги": "отеки нижних конечностей",
+    "отеки": "отеки",
+    "сыпь": "сыпь",
+    "чешется": "зуд",
+    "чешется кожа": "кожный зуд",
+    "пожелтел": "желтуха",
+    "желтые глаза": "иктеричность склер",
+    "слабость": "слабость",
+    "устает": "утомляемость",
+    "похудел": "снижение массы тела",
+    "худеет": "снижение массы тела",
+    "пьет много": "полидипсия",
+    "жажда": "полидипсия",
+    "часто мочится": "поллакиурия",
+    "больно мочиться": "дизурия",
+    "кровь в моче": "гематурия",
+    "кровь в кале": "гематохезия",
+    "потерял сознание": "обморок",
+    "судороги": "судороги",
+    "немеет": "онемение",
+    "сын": "ребенок",
+    "дочь": "ребенок",
+    "малыш": "ребенок",
+    "беременна": "беременность",
+}
+
+
+def content_stems(tokens: list[str]) -> list[tuple[int, str | None]]:
+    """
+    (индекс токена, стем) для значимых слов; стоп-слова пропускаются ("боль в животе" == "боль животе"),
+    пунктуация дает (индекс, None) — граница, через которую n-граммы не идут.
+    """
+    result = []
+    for i, token in enumerate(tokens):
+        if not token[0].isalnum():
+            result.append((i, None))
+        elif token not in STOPWORDS:
+            result.append((i, stem(token)))
+    return result
+
+
+def stem_phrase(phrase: str) -> tuple[str, ...]:
+    return tuple(s for _, s in content_stems(tokenize(phrase)) if s)
+
+
+class ClinicalTermExtractor:
+    """
+    Словарь: кортеж стемов (1-3 слова) -> медицинский термин в самой частой форме из протоколов.
+    extract() ищет в тексте пациента самые длинные совпадения (сначала бытовые формулировки,
+    затем термины протоколов) и выкидывает те, что стоят под отрицанием.
+    """
+
+    def __init__(self, terms: dict[tuple, str], lay: dict[str, str] | None = None):
+        self.terms = terms
+        self.lay = {}
+        for phrase, medical in (LAY_TERMS if lay is None else lay).items():
+            key = stem_phrase(phrase)
+            self.lay[key] = medical
+            if len(key) == 2:
+                # "болит живот" и "живот болит"
+                self.lay.setdefault(key[::-1], medical)
+
+    @classmethod
+    def build(cls, payloads, sections=TERM_SECTIONS, min_df: int = 2, max_df_ratio: float = 0.3,
+              max_terms: int = 50000) -> "ClinicalTermExtractor":
+        """
+        Словарь по payload чанков индекса. Документная частота считается по протоколам:
+        термины одного протокола (опечатки, имена) и общие слова (> max_df_ratio протоколов) отбрасываются.
+        """
+        protocol_grams = defaultdict(set)
+        surfaces = defaultdict(Counter)
+        for payload in payloads:
+            if payload.get("section") not in sections:
+                continue
+            grams = protocol_grams[payload.get("protocol_id")]
+            tokens = tokenize(payload.get("content", ""))
+            content = content_stems(tokens)
+            for n in range(1, MAX_NGRAM + 1):
+                for i in range(len(content) - n + 1):
+                    window = content[i:i + n]
+                    key = tuple(s for _, s in window)
+                    if None in key or not key[0][0].isalpha() or not key[-1][0].isalpha():
+                        continue
+                    if n == 1 and (len(tokens[window[0][0]]) < 5 or tokens[window[0][0]].endswith(ADJECTIVE_ENDINGS)):
+                        continue
+                    grams.add(key)
+                    surfaces[key][" ".join(tokens[window[0][0]:window[-1][0] + 1])] += 1
+
+        df = Counter(key for grams in protocol_grams.values() for key in grams)
+        max_df = max(min_df, int(len(protocol_grams) * max_df_ratio))
+        kept = [key for key, count in df.items() if min_df <= count <= max_df]
+        kept.sort(key=lambda key: (-df[key], key))
+        terms = {key: surfaces[key].most_common(1)[0][0] for key in kept[:max_terms]}
+        return cls(terms)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"terms": [[" ".join(k), v] for k, v in self.terms.items()]}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "ClinicalTermExtractor":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls({tuple(k.split(" ")): v for k, v in data["terms"]})
+
+    def _match(self, stems: list[str | None], i: int) -> tuple[int, str] | None:
+        for n in range(min(MAX_NGRAM, len(stems) - i), 0, -1):
+            key = tuple(stems[i:i + n])
+            if None in key:
+                continue
+            for vocabulary in (self.lay, self.terms):
+                if key in vocabulary:
+                    return n, vocabulary[key]
+        return None
+
+    def extract(self, text: str) -> list[str]:
+        """Медицинские термины из текста пациента в порядке упоминания, без отрицаемых и без повторов."""
+        tokens = tokenize(text)
+        flags = negation_flags(tokens)
+        content = content_stems(tokens)
+        stems = [s for _, s in content]
+        found = list(dict.fromkeys(RE_ICD_CODE.findall(text.upper())))
+        i = 0
+        while i < len(content):
+            match = self._match(stems, i) if stems[i] else None
+            if not match:
+                i += 1
+                continue
+            n, term = match
+            if not flags[content[i][0]] and term not in found:
+                found.append(term)
+            i += n
+        return found
+
+    def summary(self, text: str) -> str:
+        """Саммари для поиска: термины через запятую; если ничего не нашлось — исходный текст."""
+        terms = self.extract(text)
+        return ", ".join(terms) if terms else text
+
+    def stats(self) -> dict:
+        return {"terms": len(self.terms), "lay_terms": len(self.lay)}
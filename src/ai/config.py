@@ -7,5 +7,141 @@ GPT_OSS_API_KEY = os.getenv("GPT_OSS_API_KEY")
 MODEL_PATH = "./src/ai/models/multilingual-e5-small"
 DB_PATH = "./src/ai/vector_db"
 COLLECTION_NAME = "protocols"
+# Манифест инкрементальной индексации: protocol_id -> хеши содержимого и id точек
+MANIFEST_PATH = "./src/ai/index_manifest.json"
+# Словарь медицинских терминов из протоколов для локального NER (clinical_terms.py)
+TERMS_PATH = "./src/ai/clinical_terms.json"
+# Лексический индекс BM25 по чанкам (lexical_index.py)
+LEXICAL_PATH = "./src/ai/lexical_index"
+# Таблица протоколов: нормализованные коды МКБ, лучший код, тексты чанков для контекста LLM (protocol_index.py).
+# Точки векторного индекса несут только protocol_id и номер чанка, остальное сервер берет отсюда
+PROTOCOLS_PATH = "./src/ai/protocol_table"
 
-BASE_URL = "https://hub.qazcode.ai"
+# Поколения индекса (blue/green): ingest пишет INDEX_ROOT/<gen>/ и переключает INDEX_ROOT/CURRENT.
+# DB_PATH / NUMPY_DB_PATH / MANIFEST_PATH выше — старая раскладка, если поколений еще нет.
+INDEX_ROOT = "./src/ai/indexes"
+INDEX_KEEP_GENERATIONS = int(os.getenv("INDEX_KEEP_GENERATIONS", "3"))
+# Как часто сервер проверяет CURRENT (сек), 0 — только через POST /admin/reload-index
+INDEX_WATCH_INTERVAL = float(os.getenv("INDEX_WATCH_INTERVAL", "10"))
+# Если задан — админские ручки требуют заголовок X-Admin-Token
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Кэш эмбеддингов (LRU в памяти + диск), привязан к отпечатку модели из MODEL_PATH.
+# Кэши других моделей сами не удаляются: python src/ai/embedding_cache.py
+EMBED_CACHE = os.getenv("EMBED_CACHE", "1") == "1"
+EMBED_CACHE_DIR = "./src/ai/embedding_cache"
+EMBED_CACHE_MEMORY_ITEMS = int(os.getenv("EMBED_CACHE_MEMORY_ITEMS", "20000"))
+# Размер дискового уровня в МБ, 0 — только память
+EMBED_CACHE_DISK_MB = int(os.getenv("EMBED_CACHE_DISK_MB", "256"))
+
+# Кэш ответов /diagnose: размер (0 — выключен), TTL в секундах и порог косинуса
+# для почти-дубликатов жалоб (1 — только точное совпадение нормализованного текста)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.97"))
+
+# Режим векторного поиска: "chunks" — по 30 чанков на путь с дедупликацией протоколов в ранжировании,
+# "protocols" — сразу лучший чанк каждого из PROTOCOL_SEARCH_LIMIT разных протоколов.
+# PROTOCOL_CANDIDATES (numpy): 0 — точный максимум по всем чанкам, N — сначала limit * N протоколов
+# по центроидам, затем чанки только этих кандидатов (быстрее на больших корпусах)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "chunks")
+PROTOCOL_SEARCH_LIMIT = int(os.getenv("PROTOCOL_SEARCH_LIMIT", "10"))
+PROTOCOL_CANDIDATES = int(os.getenv("PROTOCOL_CANDIDATES", "0"))
+
+# Гибридный поиск: к двум плотным поискам добавляется BM25, списки сливаются reciprocal rank fusion
+# (скор = сумма 1 / (RRF_K + ранг) по спискам, где встретился чанк)
+LEXICAL_SEARCH = os.getenv("LEXICAL_SEARCH", "1") == "1"
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Прибавка к скору протокола, чье название целиком есть в запросе (0 — выключено; шкала RRF, см. выше)
+TITLE_MATCH_BOOST = float(os.getenv("TITLE_MATCH_BOOST", "0"))
+# Коды МКБ от LLM, которые не покрыт ни один код найденных протоколов (точный код, его уточнение
+# вроде K35 -> K35.8 или рубрика из диапазона K80-K87), заменяются лучшим кодом протокола того же ранга
+LLM_VALIDATE_CODES = os.getenv("LLM_VALIDATE_CODES", "1") == "1"
+
+# Гейт LLM: если после бустинга топ-1 протокол набрал >= LLM_GATE_MIN_SCORE и оторвался от топ-2
+# на >= LLM_GATE_MIN_MARGIN, ответ собирается из поиска без LLM. Скор = RRF (<= 3 / (RRF_K + 1)) + 10.0 за код МКБ
+# в тексте, поэтому по умолчанию гейт срабатывает только на явном коде. Пороги — через calibrate_gate.py
+LLM_GATE = os.getenv("LLM_GATE", "1") == "1"
+LLM_GATE_MIN_SCORE = float(os.getenv("LLM_GATE_MIN_SCORE", "10.0"))
+LLM_GATE_MIN_MARGIN = float(os.getenv("LLM_GATE_MIN_MARGIN", "1.0"))
+# confidence в ответе, собранном без LLM
+LLM_GATE_CONFIDENCE = float(os.getenv("LLM_GATE_CONFIDENCE", "0.9"))
+
+# POST /diagnose/batch: максимум элементов и сколько LLM-вызовов батча идут одновременно
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "64"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))
+
+# Векторное хранилище: "qdrant" (встроенный QdrantClient) или "numpy" (точный поиск матрицей в памяти)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "qdrant")
+NUMPY_DB_PATH = "./src/ai/vector_np"
+NUMPY_DTYPE = os.getenv("NUMPY_DTYPE", "float32")
+
+# LLM_BASE_URL — для локального фейкового хаба (src/mock_llm_server.py)
+BASE_URL = os.getenv("LLM_BASE_URL", "https://hub.qazcode.ai")
+
+# Лимиты хаба LLM (запросов и токенов в минуту), 0 — без ограничения. Бюджет один на LLM_BASE_URL:
+# провайдеры одного хаба делят лимитер, созданный первым (с его RPM/TPM)
+LLM_RPM = int(os.getenv("LLM_RPM", "15"))
+LLM_TPM = int(os.getenv("LLM_TPM", "0"))
+# Сколько токенов ответа закладываем в оценку TPM до вызова (потом правим по usage)
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "600"))
+# Сколько ждать после 429, если хаб не прислал Retry-After
+LLM_DEFAULT_RETRY_AFTER = float(os.getenv("LLM_DEFAULT_RETRY_AFTER", "15"))
+# Стрим ответа LLM: генерация обрывается, как только в "diagnoses" пришло LLM_STREAM_DIAGNOSES объектов
+LLM_STREAM = os.getenv("LLM_STREAM", "1") == "1"
+LLM_STREAM_DIAGNOSES = int(os.getenv("LLM_STREAM_DIAGNOSES", "3"))
+# Пакетный режим LLM: когда лимит хаба выбран, до LLM_BATCH_MAX_CASES ожидающих пациентов
+# уходят одним промптом (1 — выключено)
+LLM_BATCH_MAX_CASES = int(os.getenv("LLM_BATCH_MAX_CASES", "1"))
+# Устойчивость вызовов хаба (llm_resilience.py): таймаут одной попытки, число попыток,
+# экспоненциальная пауза с jitter (LLM_BACKOFF_MAX — и потолок Retry-After, дольше не ждем, уходим в фоллбек)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+# Хедж: второй такой же запрос, если первый идет дольше p95 (LLM_HEDGE_QUANTILE) успешных вызовов,
+# но не раньше LLM_HEDGE_MIN_DELAY секунд. Тратит RPM, поэтому выключен по умолчанию
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1.0"))
+# Предохранитель: после LLM_BREAKER_FAILURES отказов хаба подряд (429 не считается) вызовы LLM сразу падают
+# (ответ из поиска) на LLM_BREAKER_RESET секунд, затем один пробный вызов. 0 — выключен
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+# Бюджет времени запроса (deadline.py): клиент может передать свой в X-Request-Timeout (секунды)
+# или X-Request-Timeout-Ms, иначе REQUEST_DEADLINE — с запасом под 60 с таймаут клиента эвалуатора
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "55"))
+REQUEST_DEADLINE_MAX = float(os.getenv("REQUEST_DEADLINE_MAX", "300"))
+# Сколько секунд NER оставляет диагностическому LLM; если на сам NER остается меньше DEADLINE_NER_MIN — NER пропускается
+DEADLINE_LLM_RESERVE = float(os.getenv("DEADLINE_LLM_RESERVE", "15"))
+DEADLINE_NER_MIN = float(os.getenv("DEADLINE_NER_MIN", "1"))
+# Меньше DEADLINE_LLM_MIN секунд в остатке — LLM не зовем, отвечаем из поиска;
+# DEADLINE_RESPONSE_RESERVE — запас на сборку фоллбека и отправку ответа
+DEADLINE_LLM_MIN = float(os.getenv("DEADLINE_LLM_MIN", "3"))
+DEADLINE_RESPONSE_RESERVE = float(os.getenv("DEADLINE_RESPONSE_RESERVE", "0.5"))
+
+# Контроль допуска (admission.py): не больше ADMISSION_MAX_ACTIVE запросов /diagnose в пайплайне с LLM
+# одновременно, до ADMISSION_QUEUE_SIZE ждут в очереди (X-Priority: urgent — вперед). Очередь полна или ожидание
+# не укладывается в бюджет запроса: ADMISSION_SHED="retrieval" — ответ из поиска без LLM с полем "shed",
+# "reject" — 503 с Retry-After (стрим всегда отвечает из поиска). ADMISSION_MAX_ACTIVE=0 — выключено
+ADMISSION_MAX_ACTIVE = int(os.getenv("ADMISSION_MAX_ACTIVE", "8"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "32"))
+ADMISSION_SHED = os.getenv("ADMISSION_SHED", "retrieval")
+
+# Одинаковые запросы /diagnose в полете (нормализованный текст + поколение индекса + режим гейта)
+# считаются один раз, остальные ждут тот же результат (single_flight.py)
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "1") == "1"
+
+# Саммари жалоб для второго поиска: "llm" (NER-запрос к хабу) или "local" (словарь терминов
+# из протоколов + отрицания, только CPU). Сравнение — python -m src.ai.bench_ner
+NER_BACKEND = os.getenv("NER_BACKEND", "llm")
+
+# Пул инференса (энкодер + векторный поиск) вне event loop
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "64"))
+# Сколько секунд ждать свободный слот очереди, 0 — ждать сколько нужно
+INFERENCE_SUBMIT_TIMEOUT = float(os.getenv("INFERENCE_SUBMIT_TIMEOUT", "30"))
+# Микробатчинг query-эмбеддингов между запросами: размер батча и окно ожидания
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "16"))
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
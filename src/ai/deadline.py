@@ -0,0 +1,101 @@
+import asyncio
+import contextvars
+import time
+from contextlib import contextmanager
+
+# Бюджет времени запроса. Дедлайн кладется в contextvar в начале обработки и виден всем стадиям
+# (задачи asyncio копируют контекст при создании), каждая стадия смотрит остаток и
+# деградирует (без NER, ответ из поиска без LLM), а не досиживает до таймаута клиента.
+
+_current = contextvars.ContextVar("request_deadline", default=None)
+
+# Заголовки, из которых клиент может передать свой таймаут (секунды или миллисекунды)
+TIMEOUT_HEADERS = (("x-request-timeout", 1.0), ("x-request-timeout-ms", 0.001))
+
+
+class DeadlineExceeded(TimeoutError):
+    """Бюджет запроса исчерпан (или его не хватает на стадию)."""
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.budget = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.degraded: list[str] = []  # стадии, которые пропущены или оборваны из-за бюджета
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def degrade(self, stage: str):
+        if stage not in self.degraded:
+            self.degraded.append(stage)
+
+    def header(self) -> str:
+        value = f"budget={self.budget:.1f}; remaining={max(0.0, self.remaining()):.2f}"
+        return value + (f"; degraded={','.join(self.degraded)}" if self.degraded else "")
+
+
+def from_headers(headers, default: float, maximum: float) -> Deadline:
+    """Дедлайн из X-Request-Timeout / X-Request-Timeout-Ms, иначе default; не больше maximum."""
+    seconds = default
+    for name, scale in TIMEOUT_HEADERS:
+        try:
+            seconds = float(headers.get(name)) * scale
+            break
+        except (TypeError, ValueError):
+            continue
+    return Deadline(max(0.0, min(seconds, maximum)))
+
+
+def current() -> Deadline | None:
+    return _current.get()
+
+
+@contextmanager
+def scope(deadline: Deadline):
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def remaining(reserve: float = 0.0) -> float | None:
+    """Остаток бюджета за вычетом reserve (время, которое нужно оставить следующим стадиям); None — дедлайна нет."""
+    deadline = _current.get()
+    return None if deadline is None else deadline.remaining() - reserve
+
+
+def allows(seconds: float, reserve: float = 0.0) -> bool:
+    """Хватит ли бюджета на стадию длиной хотя бы seconds."""
+    left = remaining(reserve)
+    return left is None or left >= seconds
+
+
+async def run_within(aw, reserve: float = 0.0, stage: str | None = None):
+    """
+    await aw, но не дольше остатка бюджета минус reserve; по истечении aw отменяется
+    (вместе с запросом к LLM) и поднимается DeadlineExceeded, stage отмечается как деградировавшая.
+    Собственный TimeoutError стадии (сокет, поток) — не бюджет: уходит вызывающему как есть.
+    """
+    timeout = remaining(reserve)
+    if timeout is None:
+        return await aw
+    if timeout <= 0:
+        if asyncio.iscoroutine(aw):
+            aw.close()  # не запущенную корутину закрываем, чтобы не было предупреждения
+        raise _exceeded(stage)
+    budget = asyncio.timeout(timeout)
+    try:
+        async with budget:
+            return await aw
+    except TimeoutError:
+        if not budget.expired():
+            raise
+        raise _exceeded(stage) from None
+
+
+def _exceeded(stage: str | None) -> DeadlineExceeded:
+    if stage:
+        _current.get().degrade(stage)
+    return DeadlineExceeded(f"Нет бюджета на стадию {stage or '?'}")
@@ -1,12 +1,18 @@
 import json
 import re
-from qdrant_client import QdrantClient
 from sentence_transformers import SentenceTransformer
-from config import MODEL_PATH, DB_PATH, COLLECTION_NAME
+from config import MODEL_PATH, DB_PATH, COLLECTION_NAME, VECTOR_BACKEND, NUMPY_DB_PATH, MANIFEST_PATH, PROTOCOLS_PATH, INDEX_ROOT, EMBED_CACHE_DIR
+from vector_store import open_store
+from index_generations import IndexPaths, resolve_index
+from protocol_index import ProtocolIndex
+from embedding_cache import CachedEncoder
 
 # Инициализация
-encoder = SentenceTransformer(MODEL_PATH)
-qdrant = QdrantClient(path=DB_PATH)
+encoder = CachedEncoder(SentenceTransformer(MODEL_PATH), MODEL_PATH, EMBED_CACHE_DIR, "query")
+generation, paths = resolve_index(INDEX_ROOT, IndexPaths(DB_PATH, NUMPY_DB_PATH, MANIFEST_PATH, protocols=PROTOCOLS_PATH))
+store = open_store(VECTOR_BACKEND, paths.db, paths.numpy, COLLECTION_NAME)
+# В точках только protocol_id и номер чанка — название, коды и текст берем из таблицы протоколов
+protocols = ProtocolIndex.load(paths.protocols) if ProtocolIndex.exists(paths.protocols) else ProtocolIndex.build(store.iter_points())
 
 def debug_test_case(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -22,11 +28,7 @@ def debug_test_case(file_path):
 
     # 1. Поиск
     query_vector = encoder.encode(f"query: {query}").tolist()
-    results = qdrant.query_points(
-        collection_name=COLLECTION_NAME,
-        query=query_vector,
-        limit=20
-    ).points
+    results = protocols.resolve(store.search(query_vector, limit=20))
 
     print(f"🔎 РЕЗУЛЬТАТЫ ПОИСКА (Top 10):")
     found_correct_protocol = False
@@ -0,0 +1,281 @@
+import atexit
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: без межпроцессной блокировки
+    fcntl = None
+
+MODEL_FILES = ("config.json", "modules.json", "sentence_bert_config.json", "model.safetensors", "pytorch_model.bin")
+KNOWN_PREFIXES = ("query", "passage")
+IN_USE_FILE = ".in_use"
+
+
+def model_fingerprint(model_path: str) -> str:
+    """Отпечаток модели: путь + конфиги + размер/mtime весов. Сменили MODEL_PATH или веса — новый кэш."""
+    h = hashlib.sha256(os.path.abspath(model_path).encode("utf-8"))
+    for name in MODEL_FILES:
+        file_path = os.path.join(model_path, name)
+        if not os.path.exists(file_path):
+            continue
+        st = os.stat(file_path)
+        h.update(f"{name}:{st.st_size}:{int(st.st_mtime)}".encode("utf-8"))
+        if name.endswith(".json"):
+            with open(file_path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class EmbeddingCache:
+    """
+    Двухуровневый кэш эмбеддингов: LRU в памяти процесса + диск.
+    Диск: vectors.npy-подобный memmap на фиксированное число слотов, keys.bin (хеш ключа в слоте,
+    чтобы читатель из другого процесса не получил чужой вектор) и index.json (ключ -> слот, время доступа).
+    Писать на диск может только один процесс (flock), остальные читают.
+    Каталог привязан к отпечатку модели; каталоги других моделей не трогаются (их чистит prune_caches).
+    """
+
+    def __init__(self, cache_dir: str, model_id: str, namespace: str, dim: int,
+                 memory_items: int = 20000, disk_mb: int = 256):
+        self.model_id = model_id
+        self.dim = dim
+        self.memory_items = memory_items
+        self.memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.evictions = 0
+        self._dirty = 0
+        self._clock = 0
+
+        self.disk_slots = int(disk_mb * 1024 * 1024 // (dim * 4)) if disk_mb > 0 else 0
+        self.writable = False
+        self.index: dict[str, list[int]] = {}
+        if self.disk_slots:
+            self._open_disk(cache_dir, namespace)
+
+    def _open_disk(self, cache_dir: str, namespace: str):
+        root = os.path.join(cache_dir, self.model_id)
+        self.path = os.path.join(root, namespace)
+        os.makedirs(self.path, exist_ok=True)
+
+        # Общий лок на весь кэш модели, пока процесс его читает/пишет: prune_caches такой не удаляет
+        self._in_use_file = open(os.path.join(root, IN_USE_FILE), "a+")
+        if fcntl is not None:
+            fcntl.flock(self._in_use_file, fcntl.LOCK_SH)
+
+        self._lock_file = open(os.path.join(self.path, ".lock"), "a+")
+        if fcntl is None:
+            self.writable = True
+        else:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.writable = True
+            except OSError:
+                print(f"ℹ️ Дисковый кэш эмбеддингов {self.path} занят другим процессом — только чтение")
+
+        meta_path = os.path.join(self.path, "meta.json")
+        meta = {"dim": self.dim, "slots": self.disk_slots}
+        fresh = True
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                fresh = json.load(f) != meta
+        if fresh and not self.writable:
+            self.disk_slots = 0
+            return
+        mode = "w+" if fresh else "r+" if self.writable else "r"
+        self.vectors = np.memmap(os.path.join(self.path, "vectors.f32"), dtype=np.float32, mode=mode,
+                                 shape=(self.disk_slots, self.dim))
+        self.keys = np.memmap(os.path.join(self.path, "keys.bin"), dtype=np.uint8, mode=mode,
+                              shape=(self.disk_slots, 16))
+        if fresh:
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            self._save_index()
+        else:
+            with open(os.path.join(self.path, "index.json"), "r", encoding="utf-8") as f:
+                self.index = json.load(f)
+            self._clock = max((v[1] for v in self.index.values()), default=0)
+        self._free = sorted(set(range(self.disk_slots)) - {v[0] for v in self.index.values()}, reverse=True)
+        if self.writable:
+            # Скрипты не зовут close() — дописываем индекс при выходе из процесса
+            atexit.register(self.flush)
+
+    def key(self, text: str) -> str:
+        prefix, _, rest = text.partition(": ")
+        if prefix not in KNOWN_PREFIXES:
+            prefix, rest = "", text
+        digest = hashlib.blake2b(
+            f"{self.model_id}\0{prefix}\0{normalize_text(rest)}".encode("utf-8"), digest_size=16
+        )
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.hits_memory += 1
+                return vector
+            entry = self.index.get(key) if self.disk_slots else None
+            if entry is not None and bytes(self.keys[entry[0]]) == bytes.fromhex(key):
+                vector = np.array(self.vectors[entry[0]])
+                self._clock += 1
+                entry[1] = self._clock
+                self._remember(key, vector)
+                self.hits_disk += 1
+                return vector
+            self.misses += 1
+            return None
+
+    def put(self, key: str, vector: np.ndarray):
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            if not (self.disk_slots and self.writable) or key in self.index:
+                return
+            if not self._free:
+                self._evict_disk()
+            slot = self._free.pop()
+            self.vectors[slot] = vector
+            self.keys[slot] = np.frombuffer(bytes.fromhex(key), dtype=np.uint8)
+            self._clock += 1
+            self.index[key] = [slot, self._clock]
+            self._dirty += 1
+            if self._dirty >= 256:
+                self._flush_locked()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        # Освобождаем сразу десятую часть самых давно использованных слотов, а не по одному
+        n = max(1, self.disk_slots // 10)
+        oldest = sorted(self.index.items(), key=lambda kv: kv[1][1])[:n]
+        for key, (slot, _) in oldest:
+            del self.index[key]
+            self._free.append(slot)
+        self.evictions += len(oldest)
+
+    def _save_index(self):
+        tmp_path = os.path.join(self.path, "index.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, os.path.join(self.path, "index.json"))
+
+    def _flush_locked(self):
+        if not (self.disk_slots and self.writable) or not self._dirty:
+            return
+        self.vectors.flush()
+        self.keys.flush()
+        self._save_index()
+        self._dirty = 0
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def stats(self) -> dict:
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {
+            "model_id": self.model_id,
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits_memory + self.hits_disk) / lookups, 3) if lookups else 0.0,
+            "memory_items": len(self.memory),
+            "disk_items": len(self.index),
+            "disk_slots": self.disk_slots,
+            "disk_writable": self.writable,
+            "evictions": self.evictions,
+        }
+
+
+def prune_caches(cache_dir: str, keep_model_id: str) -> list[str]:
+    """
+    Удаляет кэши других моделей (отдельный шаг, не при открытии: ingest и сервер с разными
+    MODEL_PATH делят каталог). Кэш, который сейчас открыт другим процессом (даже только на чтение), пропускается.
+    """
+    removed = []
+    if not os.path.isdir(cache_dir):
+        return removed
+    for other in sorted(os.listdir(cache_dir)):
+        root = os.path.join(cache_dir, other)
+        if other == keep_model_id or not os.path.isdir(root):
+            continue
+        with open(os.path.join(root, IN_USE_FILE), "a+") as in_use:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(in_use, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    print(f"ℹ️ Кэш эмбеддингов {root} открыт другим процессом — пропускаю")
+                    continue
+            shutil.rmtree(root, ignore_errors=True)
+        removed.append(other)
+    return removed
+
+
+class CachedEncoder:
+    """
+    Обертка над SentenceTransformer с тем же encode(): попадания берутся из кэша,
+    промахи кодируются одним батчем. Остальные атрибуты проксируются в энкодер.
+    """
+
+    def __init__(self, encoder, model_path: str, cache_dir: str, namespace: str,
+                 memory_items: int = 20000, disk_mb: int = 256):
+        self.encoder = encoder
+        self.cache = EmbeddingCache(
+            cache_dir, model_fingerprint(model_path), namespace,
+            encoder.get_sentence_embedding_dimension(), memory_items, disk_mb,
+        )
+
+    def encode(self, sentences, batch_size: int = 32, **kwargs):
+        # Параметры, меняющие сам вектор (нормализация и т.п.), в ключ не входят — такие вызовы не кэшируем
+        extra = {k: v for k, v in kwargs.items() if k not in ("show_progress_bar",)}
+        if extra:
+            return self.encoder.encode(sentences, batch_size=batch_size, **kwargs)
+
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        keys = [self.cache.key(t) for t in texts]
+        vectors = [self.cache.get(k) for k in keys]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            encoded = self.encoder.encode([texts[i] for i in missing], batch_size=batch_size, **kwargs)
+            for i, vector in zip(missing, encoded):
+                vectors[i] = np.asarray(vector, dtype=np.float32)
+                self.cache.put(keys[i], vectors[i])
+        if single:
+            return vectors[0].copy()
+        return np.stack(vectors) if vectors else np.zeros((0, self.cache.dim), dtype=np.float32)
+
+    def close(self):
+        self.cache.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.encoder, name)
+
+
+if __name__ == "__main__":
+    # Ручная чистка: оставить только кэш модели из MODEL_PATH
+    from config import EMBED_CACHE_DIR, MODEL_PATH
+
+    model_id = model_fingerprint(MODEL_PATH)
+    removed = prune_caches(EMBED_CACHE_DIR, model_id)
+    print(f"🧹 Удалено кэшей других моделей: {len(removed)} (оставлен {model_id})")
@@ -1,21 +1,31 @@
 from src.ai.providers import GPTOSSProvider
-from qdrant_client import QdrantClient
+from src.ai.vector_store import open_store
+from src.ai.protocol_index import ProtocolIndex
+from src.ai.index_generations import IndexPaths, resolve_index
+from src.ai.config import VECTOR_BACKEND, NUMPY_DB_PATH, PROTOCOLS_PATH, MANIFEST_PATH, INDEX_ROOT
 from sentence_transformers import SentenceTransformer
 
 class DiagnosisEngine:
-    def __init__(self, api_key, hub_url, vector_db_path, model_path):
+    def __init__(self, api_key, hub_url, vector_db_path, model_path,
+                 backend=VECTOR_BACKEND, numpy_db_path=NUMPY_DB_PATH, protocols_path=PROTOCOLS_PATH,
+                 index_root=INDEX_ROOT):
         self.llm = GPTOSSProvider(api_key, hub_url)
         self.encoder = SentenceTransformer(model_path)
-        self.vector_db = QdrantClient(path=vector_db_path)
         self.collection_name = "protocols"
+        # Текущее опубликованное поколение, как у сервера; переданные пути — только если поколений еще нет
+        self.generation, paths = resolve_index(
+            index_root, IndexPaths(vector_db_path, numpy_db_path, MANIFEST_PATH, protocols=protocols_path),
+        )
+        self.vector_db = open_store(backend, paths.db, paths.numpy, self.collection_name)
+        # Точки несут только ссылку на протокол — текст и коды берутся из таблицы протоколов
+        if ProtocolIndex.exists(paths.protocols):
+            self.protocols = ProtocolIndex.load(paths.protocols)
+        else:
+            self.protocols = ProtocolIndex.build(self.vector_db.iter_points())
 
     async def diagnose_patient(self, user_text: str):
         query_vector = self.encoder.encode(user_text).tolist()
-        search_results = self.vector_db.search(
-            collection_name=self.collection_name,
-            query_vector=query_vector,
-            limit=5  
-        )
+        search_results = self.protocols.resolve(self.vector_db.search(query_vector, limit=5))
 
         context_parts = []
         for res in search_results:
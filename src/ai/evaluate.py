@@ -6,6 +6,10 @@ from pathlib import Path
 from tqdm import tqdm
 import random
 
+# Таймаут клиента; сервер получает бюджет чуть меньше, чтобы успеть ответить фоллбеком, а не оборваться
+CLIENT_TIMEOUT = 120
+SERVER_BUDGET = CLIENT_TIMEOUT - 5
+
 def run_evaluation(endpoint, data_dir, team_name):
     data_path = Path(data_dir)
     test_files = list(data_path.glob("*.json"))
@@ -37,7 +41,10 @@ def run_evaluation(endpoint, data_dir, team_name):
 
         start_time = time.time()
         try:
-            response = requests.post(endpoint, json={"text": query}, timeout=120)
+            response = requests.post(
+                endpoint, json={"text": query}, timeout=CLIENT_TIMEOUT,
+                headers={"X-Request-Timeout": str(SERVER_BUDGET)},
+            )
             response.raise_for_status()
             prediction = response.json()
         except Exception as e:
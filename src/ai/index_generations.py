@@ -0,0 +1,212 @@
+import asyncio
+import os
+import shutil
+import time
+from contextlib import asynccontextmanager
+from typing import NamedTuple
+
+# Раскладка одного поколения индекса: INDEX_ROOT/<gen>/{vector_db, vector_np, index_manifest.json, clinical_terms.json, lexical_index, protocol_table}.
+# INDEX_ROOT/CURRENT хранит имя опубликованного поколения; ingest пишет новое поколение рядом
+# и атомарно переключает CURRENT, сервер подхватывает его без рестарта.
+CURRENT_FILE = "CURRENT"
+
+
+class IndexPaths(NamedTuple):
+    db: str
+    numpy: str
+    manifest: str
+    terms: str = ""
+    lexical: str = ""
+    protocols: str = ""
+
+
+def index_paths(gen_dir: str) -> IndexPaths:
+    return IndexPaths(
+        db=os.path.join(gen_dir, "vector_db"),
+        numpy=os.path.join(gen_dir, "vector_np"),
+        manifest=os.path.join(gen_dir, "index_manifest.json"),
+        terms=os.path.join(gen_dir, "clinical_terms.json"),
+        lexical=os.path.join(gen_dir, "lexical_index"),
+        protocols=os.path.join(gen_dir, "protocol_table"),
+    )
+
+
+def current_generation(root: str) -> str | None:
+    try:
+        with open(os.path.join(root, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def resolve_index(root: str, legacy: IndexPaths) -> tuple[str, IndexPaths]:
+    """Пути опубликованного поколения; если поколений еще нет — старая раскладка (DB_PATH и т.д.)."""
+    name = current_generation(root)
+    if name:
+        return name, index_paths(os.path.join(root, name))
+    return "legacy", legacy
+
+
+def new_generation(root: str) -> tuple[str, str]:
+    """Имя и каталог для нового поколения; каталог не создается."""
+    name = time.strftime("gen-%Y%m%d-%H%M%S")
+    n = 1
+    while os.path.exists(os.path.join(root, name)):
+        n += 1
+        name = time.strftime("gen-%Y%m%d-%H%M%S") + f"-{n}"
+    return name, os.path.join(root, name)
+
+
+def publish_generation(root: str, name: str, keep: int = 3):
+    """Атомарно переключает CURRENT на name и удаляет старые поколения сверх keep."""
+    tmp_path = os.path.join(root, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(name)
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILE))
+
+    generations = sorted(
+        d for d in os.listdir(root) if d.startswith("gen-") and os.path.isdir(os.path.join(root, d))
+    )
+    # Предыдущее поколение сервер может еще дочитывать — удаляем только то, что старше keep
+    for old in generations[:-keep] if keep > 0 else []:
+        if old != name:
+            shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+
+
+class IndexGeneration:
+    """Открытое поколение индекса + счетчик запросов, которые сейчас на нем работают."""
+
+    def __init__(self, name: str, store, paths: IndexPaths | None = None):
+        self.name = name
+        self.store = store
+        self.paths = paths
+        # Производные от поколения структуры (словарь терминов и т.п.), живут и умирают вместе с ним
+        self.resources = {}
+        self.refs = 0
+        self.retired = False
+        self.closed = False
+        self.closing: asyncio.Task | None = None
+        self.loaded_at = time.time()
+
+
+class IndexManager:
+    """
+    Blue/green поколения индекса в работающем сервере.
+    Запросы берут lease() на текущее поколение и доживают на нем, даже если
+    в это время случилась подмена; старое поколение закрывается, когда его отпустит последний.
+    warmup(generation) — async-прогрев производных структур нового поколения до подмены.
+    """
+
+    def __init__(self, root: str, open_store, legacy: IndexPaths, warmup=None):
+        self.root = root
+        self.open_store = open_store  # IndexPaths -> VectorStore
+        self.legacy = legacy
+        self.warmup = warmup
+        self.current: IndexGeneration | None = None
+        self.draining: list[IndexGeneration] = []
+        self.swaps = 0
+        self._reload_lock = asyncio.Lock()
+        self._watch_task = None
+
+    def _open(self) -> IndexGeneration:
+        name, paths = resolve_index(self.root, self.legacy)
+        store = self.open_store(paths)
+        # Прогрев: первый поиск не должен платить за ленивую инициализацию
+        store.scroll(limit=1)
+        return IndexGeneration(name, store, paths)
+
+    def load(self) -> IndexGeneration:
+        self.current = self._open()
+        return self.current
+
+    @property
+    def generation(self) -> str:
+        return self.current.name if self.current else ""
+
+    @asynccontextmanager
+    async def lease(self):
+        gen = self.current
+        gen.refs += 1
+        try:
+            yield gen
+        finally:
+            gen.refs -= 1
+            if gen.retired and gen.refs == 0:
+                await self._close(gen)
+
+    async def _close(self, gen: IndexGeneration):
+        if gen.closed:
+            return
+        if gen.closing is None:
+            gen.closing = asyncio.ensure_future(self._close_store(gen))
+        # Последний lease часто отпускает отмененный запрос (клиент ушел): закрытие хранилища
+        # и снятие его файлового лока доводятся до конца, даже если ждать его здесь уже нельзя
+        await asyncio.shield(gen.closing)
+
+    async def _close_store(self, gen: IndexGeneration):
+        try:
+            await asyncio.to_thread(gen.store.close)
+        except Exception:
+            gen.closing = None  # следующий _close() попробует снова
+            raise
+        gen.closed = True
+        if gen in self.draining:
+            self.draining.remove(gen)
+        print(f"🧹 Поколение индекса {gen.name} закрыто.")
+
+    async def reload(self, force: bool = False) -> dict:
+        """Открывает опубликованное поколение и атомарно подменяет текущее."""
+        async with self._reload_lock:
+            previous = self.current
+            name = current_generation(self.root) or "legacy"
+            if previous and previous.name == name and not force:
+                return {"generation": name, "swapped": False}
+
+            new_gen = await asyncio.to_thread(self._open)
+            if self.warmup:
+                # Подменяем только прогретое поколение: первые запросы на нем не платят за загрузку
+                started = time.perf_counter()
+                try:
+                    await self.warmup(new_gen)
+                except Exception:
+                    await self._close(new_gen)
+                    raise
+                print(f"🔥 Поколение {new_gen.name} прогрето за {time.perf_counter() - started:.2f} с")
+            self.current = new_gen
+            self.swaps += 1
+            print(f"🔁 Индекс переключен: {previous.name if previous else '-'} -> {new_gen.name}")
+            if previous:
+                previous.retired = True
+                if previous.refs == 0:
+                    await self._close(previous)
+                else:
+                    self.draining.append(previous)
+            return {"generation": new_gen.name, "previous": previous.name if previous else None, "swapped": True}
+
+    async def _watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if (current_generation(self.root) or "legacy") != self.generation:
+                    await self.reload()
+            except Exception as e:
+                print(f"⚠️ Не удалось переключить индекс: {e}")
+
+    def start_watch(self, interval: float):
+        if interval > 0 and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch(interval))
+
+    async def close(self):
+        if self._watch_task:
+            self._watch_task.cancel()
+        for gen in [self.current, *self.draining]:
+            if gen:
+                await self._close(gen)
+
+    def stats(self) -> dict:
+        return {
+            "generation": self.generation,
+            "in_flight": self.current.refs if self.current else 0,
+            "draining": [{"generation": g.name, "in_flight": g.refs} for g in self.draining],
+            "swaps": self.swaps,
+        }
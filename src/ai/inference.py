@@ -0,0 +1,164 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+class InferenceOverloaded(RuntimeError):
+    """Очередь инференса переполнена дольше допустимого — вызывающий должен деградировать."""
+
+
+class InferenceExecutor:
+    """
+    Отдельный пул потоков под CPU-тяжелую работу: энкодер и поиск по векторному хранилищу.
+    Хранилище передается в search() явно — им владеет IndexManager (поколения индекса).
+    Event loop uvicorn только ждет результат, поэтому эмбеддинг одного пациента
+    не задерживает обработку LLM-ответов других.
+    Очередь ограничена: workers задач в работе + queue_size в ожидании, остальные ждут слот
+    (backpressure), а если слот не освободился за submit_timeout — InferenceOverloaded.
+    """
+
+    def __init__(self, encoder,
+                 workers: int = 2, queue_size: int = 64, submit_timeout: float = 0,
+                 batch_size: int = 1, batch_wait_ms: float = 0):
+        self.encoder = encoder
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.submit_timeout = submit_timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+        self._slots = asyncio.Semaphore(self.capacity)
+        self.in_flight = 0
+        self.rejected = 0
+        # Одиночные embed() от разных запросов склеиваются в один батч энкодера
+        self.batcher = EmbeddingBatcher(self, batch_size, batch_wait_ms) if batch_size > 1 else None
+
+    async def _acquire_slot(self):
+        if not self.submit_timeout:
+            await self._slots.acquire()
+            return
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.submit_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise InferenceOverloaded(
+                f"Очередь инференса занята ({self.in_flight}/{self.capacity}) дольше {self.submit_timeout} с"
+            )
+
+    async def run(self, fn, *args, **kwargs):
+        """Выполняет fn в пуле инференса, занимая слот ограниченной очереди."""
+        await self._acquire_slot()
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, partial(fn, *args, **kwargs))
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    async def embed(self, text: str) -> list[float]:
+        if self.batcher:
+            return await self.batcher.embed(text)
+        return (await self.run(self.encoder.encode, text)).tolist()
+
+    async def embed_many(self, texts: list[str], batch_size: int = 32) -> list[list[float]]:
+        """Эмбеддинг готового списка одним вызовом энкодера (паддинг внутри батча)."""
+        if not texts:
+            return []
+        return (await self.run(self.encoder.encode, texts, batch_size=batch_size)).tolist()
+
+    async def search(self, store, vector: list[float], limit: int = 30):
+        return await self.run(store.search, vector, limit)
+
+    async def search_batch(self, store, vectors: list[list[float]], limit: int = 30):
+        return await self.run(store.search_batch, vectors, limit)
+
+    async def search_groups(self, store, vector: list[float], limit: int = 10, candidates: int = 0):
+        return await self.run(store.search_groups, vector, limit, candidates)
+
+    async def search_groups_batch(self, store, vectors: list[list[float]], limit: int = 10, candidates: int = 0):
+        return await self.run(store.search_groups_batch, vectors, limit, candidates)
+
+    def stats(self) -> dict:
+        stats = {
+            "workers": self.workers,
+            "capacity": self.capacity,
+            "in_flight": self.in_flight,
+            "rejected": self.rejected,
+        }
+        if self.batcher:
+            stats["embedding_batcher"] = self.batcher.stats()
+        cache = getattr(self.encoder, "cache", None)
+        if cache is not None:
+            stats["embedding_cache"] = cache.stats()
+        return stats
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class EmbeddingBatcher:
+    """
+    Динамический микробатчинг query-эмбеддингов между параллельными запросами.
+    Строки копятся max_wait_ms (или пока не наберется max_batch), затем кодируются
+    одним батчем в пуле инференса, и каждый вызывающий получает свой вектор.
+    На CPU один батч из N строк заметно дешевле N проходов по одной.
+    """
+
+    def __init__(self, executor: InferenceExecutor, max_batch: int = 16, max_wait_ms: float = 5):
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+        self.full_batches = 0
+
+    async def embed(self, text: str) -> list[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            task = asyncio.create_task(self._encode(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _encode(self, batch: list[tuple[str, asyncio.Future]]):
+        texts = [text for text, _ in batch]
+        self.batches += 1
+        self.items += len(texts)
+        if len(texts) == self.max_batch:
+            self.full_batches += 1
+        try:
+            vectors = await self.executor.run(self.executor.encoder.encode, texts, batch_size=len(texts))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            # Вызывающий мог уже отвалиться (отмена запроса) — его вектор просто выбрасываем
+            if not future.done():
+                future.set_result(vector.tolist())
+
+    def stats(self) -> dict:
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "items": self.items,
+            "full_batches": self.full_batches,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "fill_ratio": round(self.items / (self.batches * self.max_batch), 3) if self.batches else 0.0,
+        }
@@ -1,23 +1,52 @@
+import argparse
+import hashlib
 import json
+import os
 import re
+import shutil
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct
+from qdrant_client.models import Distance, VectorParams, PointStruct, PointIdsList
 from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
-from config import MODEL_PATH, DB_PATH, COLLECTION_NAME
+from config import (
+    MODEL_PATH, COLLECTION_NAME, NUMPY_DTYPE, INDEX_ROOT, INDEX_KEEP_GENERATIONS,
+    EMBED_CACHE, EMBED_CACHE_DIR, EMBED_CACHE_MEMORY_ITEMS, EMBED_CACHE_DISK_MB,
+)
+from vector_store import QdrantStore
+from embedding_cache import CachedEncoder
+from clinical_terms import ClinicalTermExtractor
+from lexical_index import BM25Index
+from protocol_index import ProtocolTableWriter
+from index_generations import current_generation, index_paths, new_generation, publish_generation
 
-# Загружаем модель
-model = SentenceTransformer(MODEL_PATH)
-client = QdrantClient(path=DB_PATH)
+# Индексируем только важные секции для Accuracy
+INDEXED_SECTIONS = ("complaints", "criteria", "definition")
+
+# Регулярки компилируем один раз на процесс (их гоняют воркеры пула)
+RE_REFS = re.compile(r'\[\d+[\d\s,\-]*\]')
+RE_UD = re.compile(r'\(\s*УД\s*-\s*[A-ZА-Я]\s*\)')
+RE_NUMBERS = re.compile(r'\b\d+(\.\d+)+\b')
+RE_BULLETS = re.compile(r'[\uf0b7•\t\-_–—]')
+RE_SPACES = re.compile(r'\s+')
+RE_ICD = re.compile(r'[A-Z]\d{2}(?:\.\d{1,2})?')
+POINT_NAMESPACE = uuid.UUID("6f1c2a52-5d0e-4d8e-9a51-3f0c7b0e6a11")
+CYRILLIC_TO_LATIN = str.maketrans("ОАВСКМЕ", "OABCKME")
+# Формат payload точек: 2 — только protocol_id и номер чанка, остальное в таблице протоколов.
+# Смена формата пересобирает коллекцию (неизмененные точки старого формата иначе остались бы с полным payload)
+PAYLOAD_FORMAT = 2
 
 def clean_medical_text(text):
     if not text: return ""
-    text = re.sub(r'\[\d+[\d\s,\-]*\]', '', text)
-    text = re.sub(r'\(\s*УД\s*-\s*[A-ZА-Я]\s*\)', '', text)
-    text = re.sub(r'\b\d+(\.\d+)+\b', '', text)
-    text = re.sub(r'[•\t\-_–—]', ' ', text)
+    text = RE_REFS.sub('', text)
+    text = RE_UD.sub('', text)
+    text = RE_NUMBERS.sub('', text)
+    text = RE_BULLETS.sub(' ', text)
     text = text.replace('\n', ' ').replace('\r', ' ')
-    text = re.sub(r'\s+', ' ', text)
+    text = RE_SPACES.sub(' ', text)
     return text.strip()
 
 def chunk_text(text, chunk_size=1000, overlap=200):
@@ -31,83 +60,335 @@ def chunk_text(text, chunk_size=1000, overlap=200):
 
 def clean_title(title):
     t = title.replace("ДИАГНОСТИКИ И ЛЕЧЕНИЯ", "").replace("КЛИНИЧЕСКИЙ ПРОТОКОЛ", "")
-    t = re.sub(r'\s+[IVX1-9]$', '', t) 
+    t = re.sub(r'\s+[IVX1-9]$', '', t)
     return t.strip()
 
 def extract_all_codes(item):
     # Собираем текст из первых 2000 символов (там обычно основные коды)
     intro_text = " ".join([s.get("content", "") for s in item.get("sections", [])])[:2000]
     intro_text += " " + " ".join(item.get("icd_codes", []))
-    
-    intro_text = intro_text.upper().translate(str.maketrans("ОАВСКМЕ", "OABCKME"))
-    
+
+    intro_text = intro_text.upper().translate(CYRILLIC_TO_LATIN)
+
     # Регулярка для кодов
-    codes = re.findall(r'[A-Z]\d{2}(?:\.\d{1,2})?', intro_text)
-    
+    codes = RE_ICD.findall(intro_text)
+
     # Убираем "витаминные" и шумовые коды, если есть другие
     clean_codes = [c for c in codes if not c.startswith(('B12', 'E55', 'D64'))]
     if not clean_codes: clean_codes = codes
-    
-    return list(dict.fromkeys(clean_codes))
 
-def ingest_from_json(file_path):
-    print(f"🔄 Пересоздаю коллекцию {COLLECTION_NAME}...")
-    client.recreate_collection(
-        collection_name=COLLECTION_NAME,
-        vectors_config=VectorParams(size=384, distance=Distance.COSINE),
-    )
+    return list(dict.fromkeys(clean_codes))
 
+def iter_protocols(file_path, read_size=1 << 20):
+    """
+    Потоково читает JSON-массив протоколов: в памяти держим только текущий протокол
+    и хвост буфера, а не весь processed_protocols.json.
+    """
+    decoder = json.JSONDecoder()
     with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f) 
+        buf = f.read(read_size).lstrip()
+        if not buf.startswith('['):
+            raise ValueError(f"{file_path}: ожидался JSON-массив протоколов")
+        buf = buf[1:]
+        eof = False
+        while True:
+            buf = buf.lstrip().lstrip(',').lstrip()
+            if buf.startswith(']'):
+                return
+            try:
+                item, end = decoder.raw_decode(buf)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more = f.read(read_size)
+                eof = not more
+                buf += more
+                continue
+            yield item
+            buf = buf[end:]
+            if len(buf) < read_size and not eof:
+                more = f.read(read_size)
+                eof = not more
+                buf += more
+
+def point_id(protocol_id, chunk_no):
+    """Стабильный id точки: зависит только от протокола и номера чанка, а не от порядка в файле."""
+    return str(uuid.uuid5(POINT_NAMESPACE, f"{protocol_id}/{chunk_no}"))
+
+def content_hash(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+def prepare_protocol(item):
+    """
+    Чистка, чанкинг и сборка текстов для эмбеддинга одного протокола (выполняется в пуле процессов).
+    Возвращает (protocol_id, хеши для манифеста, [(текст для вектора, payload)]).
+    """
+    protocol_id = item.get("protocol_id")
+    raw_title = item.get("true_title", "Unknown")
+    title = clean_title(raw_title)
+
+    # ВЫТАСКИВАЕМ ВСЕ КОДЫ ДЛЯ ВСЕГО ПРОТОКОЛА ОДИН РАЗ
+    all_protocol_codes = extract_all_codes(item)
+    icd_str = ", ".join(all_protocol_codes)
 
-    points = []
+    cleaned_sections = []
+    chunks = []
+    for section in item.get("sections", []):
+        sec_type = section.get("type", "unknown")
+        if sec_type not in INDEXED_SECTIONS:
+            continue
+
+        content = clean_medical_text(section.get("content", ""))
+        if len(content) < 30: continue
+        cleaned_sections.append(f"{sec_type}:{content}")
+
+        for chunk in chunk_text(content):
+            # ВЕКТОР ТЕПЕРЬ ВКЛЮЧАЕТ ВСЕ КОДЫ!
+            text_to_vector = f"passage: ПРОТОКОЛ: {title}. КОДЫ МКБ: {icd_str}. ТЕКСТ: {chunk}"
+            chunks.append((text_to_vector, {
+                "protocol_id": protocol_id,
+                "title": title,
+                "icd_codes": all_protocol_codes, # ТУТ ТЕПЕРЬ СПИСОК КОДОВ
+                "section": sec_type,
+                "content": chunk
+            }))
+
+    hashes = {
+        "title": content_hash(title),
+        "icd_codes": content_hash(*all_protocol_codes),
+        "sections": content_hash(*cleaned_sections),
+    }
+    return protocol_id, hashes, chunks
+
+def bounded_map(pool, fn, iterable, window):
+    """Как pool.map, но держит в полете не больше window задач (map сабмитит весь вход сразу)."""
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_manifest(path, manifest):
+    # Пишем во временный файл и подменяем атомарно: оборванный прогон не портит манифест
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def ingest_from_json(file_path, paths, workers=None, encode_batch=256, batch_size=64, full=False):
+    """
+    Инкрементальная индексация: по манифесту (protocol_id -> хеши + id точек)
+    переэмбеддим только новые и изменившиеся протоколы, пропавшие удаляем.
+    Полная пересборка — при full=True, смене модели или формата payload, отсутствии коллекции.
+    Таблица протоколов (paths.protocols) пишется заново по всем протоколам, включая неизмененные.
+    """
+    model = SentenceTransformer(MODEL_PATH)
+    if EMBED_CACHE:
+        # Чанки, уже кодированные прошлыми прогонами (--full, правка соседнего раздела), берем из кэша
+        model = CachedEncoder(
+            model, MODEL_PATH, EMBED_CACHE_DIR, "passage",
+            memory_items=EMBED_CACHE_MEMORY_ITEMS, disk_mb=EMBED_CACHE_DISK_MB,
+        )
+    client = QdrantClient(path=paths.db)
+
+    manifest = load_manifest(paths.manifest)
+    if (full or not manifest or manifest.get("model") != MODEL_PATH
+            or manifest.get("payload_format") != PAYLOAD_FORMAT or not client.collection_exists(COLLECTION_NAME)):
+        print(f"🔄 Пересоздаю коллекцию {COLLECTION_NAME}...")
+        client.recreate_collection(
+            collection_name=COLLECTION_NAME,
+            vectors_config=VectorParams(size=384, distance=Distance.COSINE),
+        )
+        manifest = {"model": MODEL_PATH, "payload_format": PAYLOAD_FORMAT, "protocols": {}}
+    old_protocols = manifest["protocols"]
+    new_protocols = {}
+
+    workers = workers or os.cpu_count() or 1
+    timings = {"encode": 0.0, "upsert": 0.0}
+    stats = {"unchanged": 0, "updated": 0, "new": 0, "deleted": 0}
     idx = 0
+    protocols = 0
+    started = time.perf_counter()
 
-    for item in tqdm(data, desc="Индексация"):
-        protocol_id = item.get("protocol_id")
-        raw_title = item.get("true_title", "Unknown")
-        title = clean_title(raw_title)
-        
-        # ВЫТАСКИВАЕМ ВСЕ КОДЫ ДЛЯ ВСЕГО ПРОТОКОЛА ОДИН РАЗ
-        all_protocol_codes = extract_all_codes(item)
-        icd_str = ", ".join(all_protocol_codes)
-        
-        for section in item.get("sections", []):
-            sec_type = section.get("type", "unknown")
-            # Индексируем только важные секции для Accuracy
-            if sec_type not in ["complaints", "criteria", "definition"]:
-                continue
+    texts, point_ids, payloads = [], [], []
+    table = ProtocolTableWriter(paths.protocols)
+    # Запись в Qdrant идет в отдельном потоке (строго по порядку), пока энкодер считает следующий батч
+    writer = ThreadPoolExecutor(max_workers=1)
+    writes = deque()
+
+    def write(fn, *args):
+        writes.append(writer.submit(fn, *args))
+        while len(writes) > 1:
+            writes.popleft().result()
 
-            content = clean_medical_text(section.get("content", ""))
-            if len(content) < 30: continue
-            
-            chunks = chunk_text(content)
-            for chunk in chunks:
-                # ВЕКТОР ТЕПЕРЬ ВКЛЮЧАЕТ ВСЕ КОДЫ!
-                text_to_vector = f"passage: ПРОТОКОЛ: {title}. КОДЫ МКБ: {icd_str}. ТЕКСТ: {chunk}"
-                
-                vector = model.encode(text_to_vector).tolist()
-                
-                points.append(PointStruct(
-                    id=idx,
-                    vector=vector,
-                    payload={
-                        "protocol_id": protocol_id,
-                        "title": title,
-                        "icd_codes": all_protocol_codes, # ТУТ ТЕПЕРЬ СПИСОК КОДОВ
-                        "section": sec_type,
-                        "content": chunk
-                    }
-                ))
-                idx += 1
-                
-                if len(points) >= 100:
-                    client.upsert(COLLECTION_NAME, points)
-                    points = []
-                
-    if points:
+    def upsert(points):
+        t = time.perf_counter()
         client.upsert(COLLECTION_NAME, points)
-    print(f"✅ Готово! Создано {idx} векторов.")
+        timings["upsert"] += time.perf_counter() - t
+
+    def delete(ids):
+        client.delete(COLLECTION_NAME, points_selector=PointIdsList(points=ids))
+
+    def flush():
+        nonlocal idx
+        t = time.perf_counter()
+        vectors = model.encode(texts, batch_size=batch_size)
+        timings["encode"] += time.perf_counter() - t
+        points = [
+            PointStruct(id=pid, vector=vector.tolist(), payload=payload)
+            for pid, vector, payload in zip(point_ids, vectors, payloads)
+        ]
+        idx += len(points)
+        write(upsert, points)
+        texts.clear()
+        point_ids.clear()
+        payloads.clear()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        prepared = bounded_map(pool, prepare_protocol, iter_protocols(file_path), window=workers * 4)
+        for protocol_id, hashes, chunks in tqdm(prepared, desc="Индексация"):
+            protocols += 1
+            key = protocol_id
+            n = 1
+            while key in new_protocols:
+                # Дубликат protocol_id в выгрузке: не даем ему затереть точки первого
+                n += 1
+                key = f"{protocol_id}#{n}"
+
+            ids = [point_id(key, i) for i in range(len(chunks))]
+            for pid, (_, payload) in zip(ids, chunks):
+                table.add(pid, {**payload, "protocol_id": key})
+
+            old = old_protocols.get(key)
+            if old and old["hashes"] == hashes:
+                new_protocols[key] = old
+                stats["unchanged"] += 1
+                continue
+
+            for i, (pid, (text_to_vector, _)) in enumerate(zip(ids, chunks)):
+                point_ids.append(pid)
+                texts.append(text_to_vector)
+                # В точке только ссылка на таблицу протоколов
+                payloads.append({"protocol_id": key, "chunk": i})
+            new_protocols[key] = {"hashes": hashes, "points": ids}
+            stats["updated" if old else "new"] += 1
+
+            # Чанков стало меньше — лишние старые точки удаляем
+            stale = sorted(set(old["points"]) - set(ids)) if old else []
+            if stale:
+                write(delete, stale)
+            if len(texts) >= encode_batch:
+                flush()
+
+    if texts:
+        flush()
+
+    # Протоколы, пропавшие из выгрузки
+    removed = [key for key in old_protocols if key not in new_protocols]
+    for key in removed:
+        write(delete, old_protocols[key]["points"])
+    stats["deleted"] = len(removed)
+
+    while writes:
+        writes.popleft().result()
+    writer.shutdown()
+    if isinstance(model, CachedEncoder):
+        model.close()
+        cache_stats = model.cache.stats()
+        print(f"🗃 Кэш эмбеддингов: попаданий {cache_stats['hits_memory'] + cache_stats['hits_disk']}, промахов {cache_stats['misses']}")
+
+    protocols_table = table.close()
+    print(f"✅ Таблица протоколов: {len(protocols_table.protocols)} протоколов, {len(protocols_table.points)} чанков -> {paths.protocols}")
+
+    manifest["protocols"] = new_protocols
+    save_manifest(paths.manifest, manifest)
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"✅ Готово! Протоколов {protocols}: новых {stats['new']}, изменено {stats['updated']}, "
+        f"без изменений {stats['unchanged']}, удалено {stats['deleted']}. Записано {idx} векторов."
+    )
+    print(
+        f"⚡ {elapsed:.1f} с, {idx / elapsed:.1f} чанков/с "
+        f"(encode {timings['encode']:.1f} с, upsert {timings['upsert']:.1f} с, воркеров {workers})"
+    )
+    changed = stats["new"] + stats["updated"] + stats["deleted"] > 0
+    return client, changed, protocols_table
+
+def export_numpy(client, paths):
+    # Та же коллекция одной матрицей для VECTOR_BACKEND=numpy
+    store = QdrantStore(paths.db, COLLECTION_NAME, client=client)
+    n = store.export_numpy(paths.numpy, dtype=NUMPY_DTYPE)
+    print(f"✅ NumPy-индекс: {n} векторов -> {paths.numpy}")
+
+def export_terms(protocols, paths):
+    # Словарь терминов для NER_BACKEND=local — по тем же секциям, что попали в индекс
+    extractor = ClinicalTermExtractor.build(protocols.iter_payloads(), sections=INDEXED_SECTIONS)
+    extractor.save(paths.terms)
+    print(f"✅ Словарь терминов: {len(extractor.terms)} -> {paths.terms}")
+
+def export_lexical(protocols, paths):
+    # BM25 по тем же чанкам; id документов — id точек, чтобы сливать с векторными результатами
+    lexical = BM25Index.build(protocols.iter_points())
+    lexical.save(paths.lexical)
+    stats = lexical.stats()
+    print(f"✅ BM25-индекс: {stats['docs']} чанков, {stats['terms']} термов -> {paths.lexical}")
+
+def build_generation(file_path, workers=None, encode_batch=256, batch_size=64, full=False, keep=INDEX_KEEP_GENERATIONS):
+    """
+    Собирает новое поколение индекса рядом с текущим (копия + инкрементальное обновление)
+    и публикует его. Работающий сервер переключится на него сам, не трогая текущее поколение.
+    """
+    os.makedirs(INDEX_ROOT, exist_ok=True)
+    previous = current_generation(INDEX_ROOT)
+    name, gen_dir = new_generation(INDEX_ROOT)
+    if previous and not full:
+        print(f"📋 Новое поколение {name} на основе {previous}")
+        shutil.copytree(os.path.join(INDEX_ROOT, previous), gen_dir)
+    else:
+        print(f"📋 Новое поколение {name} с нуля")
+        os.makedirs(gen_dir)
+    paths = index_paths(gen_dir)
+
+    try:
+        client, changed, protocols = ingest_from_json(file_path, paths, workers, encode_batch, batch_size, full)
+        if not changed and previous and not full:
+            client.close()
+            shutil.rmtree(gen_dir)
+            print(f"✅ Изменений нет, остается поколение {previous}")
+            return previous
+        export_numpy(client, paths)
+        export_terms(protocols, paths)
+        export_lexical(protocols, paths)
+        # Qdrant держит lock на каталог — закрываем до публикации, чтобы сервер смог его открыть
+        client.close()
+    except BaseException:
+        shutil.rmtree(gen_dir, ignore_errors=True)
+        raise
+
+    publish_generation(INDEX_ROOT, name, keep=keep)
+    print(f"🚀 Опубликовано поколение {name}")
+    return name
 
 if __name__ == "__main__":
-    ingest_from_json("processed_protocols.json")
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--file", default="processed_protocols.json", help="JSON с протоколами")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Процессов на чистку/чанкинг (по умолчанию все ядра)")
+    parser.add_argument("--encode-batch", type=int, default=256, help="Сколько чанков копить до одного вызова энкодера")
+    parser.add_argument("--batch-size", type=int, default=64, help="batch_size внутри encode()")
+    parser.add_argument("--full", action="store_true", help="Пересобрать индекс с нуля, игнорируя манифест")
+    args = parser.parse_args()
+
+    build_generation(args.file, args.workers, args.encode_batch, args.batch_size, args.full)
@@ -1,22 +1,28 @@
 import json
-from qdrant_client import QdrantClient
 from sentence_transformers import SentenceTransformer
-from config import MODEL_PATH, DB_PATH, COLLECTION_NAME
+from config import MODEL_PATH, DB_PATH, COLLECTION_NAME, VECTOR_BACKEND, NUMPY_DB_PATH, MANIFEST_PATH, PROTOCOLS_PATH, INDEX_ROOT, EMBED_CACHE_DIR
+from vector_store import open_store
+from index_generations import IndexPaths, resolve_index
+from protocol_index import ProtocolIndex
+from embedding_cache import CachedEncoder
 
 # Инициализация
-encoder = SentenceTransformer(MODEL_PATH)
-client = QdrantClient(path=DB_PATH)
+encoder = CachedEncoder(SentenceTransformer(MODEL_PATH), MODEL_PATH, EMBED_CACHE_DIR, "query")
+generation, paths = resolve_index(INDEX_ROOT, IndexPaths(DB_PATH, NUMPY_DB_PATH, MANIFEST_PATH, protocols=PROTOCOLS_PATH))
+store = open_store(VECTOR_BACKEND, paths.db, paths.numpy, COLLECTION_NAME)
+# В точках только protocol_id и номер чанка — название, коды и текст берем из таблицы протоколов
+protocols = ProtocolIndex.load(paths.protocols) if ProtocolIndex.exists(paths.protocols) else ProtocolIndex.build(store.iter_points())
 
 def inspect_database():
-    print(f"--- ИНСПЕКЦИЯ БАЗЫ: {COLLECTION_NAME} ---")
+    print(f"--- ИНСПЕКЦИЯ БАЗЫ: {COLLECTION_NAME} ({VECTOR_BACKEND}, поколение {generation}) ---")
     
     # 1. Проверка количества
-    count = client.count(collection_name=COLLECTION_NAME).count
+    count = store.count()
     print(f"📊 Всего векторов: {count}")
 
     # 2. Выборка 3 случайных точек
     print("\n🔍 ПРИМЕРЫ ДАННЫХ В БАЗЕ:")
-    points, _ = client.scroll(collection_name=COLLECTION_NAME, limit=3, with_payload=True)
+    points = protocols.resolve(store.scroll(limit=3))
     
     for p in points:
         payload = p.payload
@@ -33,11 +39,7 @@ def inspect_database():
     print(f"\n🧪 ТЕСТОВЫЙ ПОИСК ПО ЗАПРОСУ: '{test_query}'")
     
     query_vector = encoder.encode(f"query: {test_query}").tolist()
-    results = client.query_points(
-        collection_name=COLLECTION_NAME,
-        query=query_vector,
-        limit=5
-    ).points
+    results = protocols.resolve(store.search(query_vector, limit=5))
 
     for i, res in enumerate(results):
         print(f"{i+1}. [{res.score:.4f}] {res.payload['title']} | ICD: {res.payload['icd_codes']}")
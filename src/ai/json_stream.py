@@ -0,0 +1,99 @@
+import json
+import re
+
+CLOSERS = {"{": "}", "[": "]"}
+RE_DIAGNOSES_KEY = re.compile(r'"diagnoses"\s*:\s*$')
+
+
+class DiagnosesParser:
+    """
+    Инкрементальный разбор ответа LLM по мере стрима.
+    Ищет первый JSON-объект в тексте (болтовня до и после игнорируется) и следит за массивом
+    "diagnoses": как только в нем набралось required законченных объектов, done=True —
+    генерацию можно обрывать. result() собирает объект из уже пришедшего текста,
+    дописывая недостающие закрывающие скобки.
+    """
+
+    def __init__(self, required: int = 3):
+        self.required = required
+        self.buffer = ""
+        self.pos = 0
+        self.start = None  # начало верхнего объекта в buffer
+        self.end = None  # конец текста, который попадет в result()
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.diagnoses_depth = None  # глубина стека внутри массива diagnoses
+        self.item_start = None
+        self.diagnoses = []
+        self.done = False
+        self.complete = False  # верхний объект закрылся сам, без обрыва
+
+    def feed(self, chunk: str) -> bool:
+        if self.done:
+            return True
+        self.buffer += chunk
+        while self.pos < len(self.buffer) and not self.done:
+            self._step(self.buffer[self.pos])
+            self.pos += 1
+        return self.done
+
+    def _step(self, ch: str):
+        if self.start is None:
+            if ch == "{":
+                self.start = self.pos
+                self.stack.append(ch)
+            return
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif ch == "\\":
+                self.escape = True
+            elif ch == '"':
+                self.in_string = False
+            return
+
+        if ch == '"':
+            self.in_string = True
+        elif ch in CLOSERS:
+            if (ch == "[" and len(self.stack) == 1 and self.diagnoses_depth is None
+                    and RE_DIAGNOSES_KEY.search(self.buffer, self.start, self.pos)):
+                self.diagnoses_depth = 2
+            elif ch == "{" and self.diagnoses_depth is not None and len(self.stack) == self.diagnoses_depth:
+                self.item_start = self.pos
+            self.stack.append(ch)
+        elif ch in "}]":
+            if not self.stack:
+                return
+            self.stack.pop()
+            depth = len(self.stack)
+            if ch == "}" and self.item_start is not None and depth == self.diagnoses_depth:
+                self._add_item(self.buffer[self.item_start:self.pos + 1])
+                self.item_start = None
+                if len(self.diagnoses) >= self.required:
+                    self.end = self.pos + 1
+                    self.done = True
+            elif ch == "]" and self.diagnoses_depth is not None and depth == self.diagnoses_depth - 1:
+                self.diagnoses_depth = None
+            elif depth == 0:
+                self.end = self.pos + 1
+                self.done = True
+                self.complete = True
+
+    def _add_item(self, text: str):
+        try:
+            self.diagnoses.append(json.loads(text))
+        except json.JSONDecodeError:
+            pass
+
+    def result(self) -> dict | None:
+        """Верхний объект из пришедшего текста или None, если JSON так и не начался/не разобрался."""
+        if self.start is None or self.end is None:
+            return None
+        closing = "".join(CLOSERS[c] for c in reversed(self.stack))
+        try:
+            return json.loads(self.buffer[self.start:self.end] + closing)
+        except json.JSONDecodeError:
+            if self.diagnoses:
+                return {"diagnoses": self.diagnoses}
+            return None
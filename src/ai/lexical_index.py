@@ -0,0 +1,105 @@
+import json
+import os
+from array import array
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+
+try:
+    from .text_ru import STOPWORDS, stem, words
+except ImportError:
+    from text_ru import STOPWORDS, stem, words
+
+# Лексический индекс BM25 по чанкам (текст + название протокола) — третий сигнал рядом
+# с двумя плотными поисками. Постинги лежат CSR-массивами: offsets[t]:offsets[t+1] — срез docs/weights
+# терма t. Вес BM25 посчитан заранее, так что запрос — это сумма срезов через bincount.
+
+
+# Словоформ в корпусе немного, а встречаются они миллионы раз — стем считаем один раз на форму
+cached_stem = lru_cache(maxsize=262144)(stem)
+
+
+def lexical_terms(text: str) -> list[str]:
+    return [cached_stem(w) for w in words(text) if len(w) > 1 and w not in STOPWORDS]
+
+
+class BM25Index:
+    POSTINGS_FILE = "postings.npz"
+    VOCAB_FILE = "vocab.json"
+
+    def __init__(self, ids: list, vocab: dict[str, int], offsets: np.ndarray, docs: np.ndarray, weights: np.ndarray):
+        self.ids = ids  # номер документа -> id точки в векторном хранилище
+        self.vocab = vocab
+        self.offsets = offsets
+        self.docs = docs
+        self.weights = weights
+
+    @classmethod
+    def build(cls, points, k1: float = 1.2, b: float = 0.75) -> "BM25Index":
+        """points: Hit-подобные объекты (id, payload) — чанки с content и title."""
+        ids, doc_terms = [], []
+        for point in points:
+            payload = point.payload
+            ids.append(point.id)
+            doc_terms.append(Counter(lexical_terms(f"{payload.get('title', '')} {payload.get('content', '')}")))
+
+        vocab = {}
+        term_ids, docs, tfs = array("i"), array("i"), array("f")  # постинги в порядке документов
+        doc_len = np.array([sum(tf.values()) for tf in doc_terms], dtype=np.float32)
+        for doc, tf in enumerate(doc_terms):
+            for term, count in tf.items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                docs.append(doc)
+                tfs.append(count)
+
+        n_docs = len(ids)
+        term_ids = np.frombuffer(term_ids, dtype=np.int32)
+        # Группируем по терму; stable сохраняет порядок документов внутри терма
+        order = np.argsort(term_ids, kind="stable")
+        term_ids = term_ids[order]
+        docs = np.frombuffer(docs, dtype=np.int32)[order]
+        tfs = np.frombuffer(tfs, dtype=np.float32)[order]
+
+        df = np.bincount(term_ids, minlength=len(vocab)).astype(np.float32)
+        idf = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+        avgdl = max(float(doc_len.mean()), 1.0) if n_docs else 1.0
+        norm = k1 * (1.0 - b + b * doc_len[docs] / avgdl)
+        weights = idf[term_ids] * tfs * (k1 + 1.0) / (tfs + norm)
+
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df.astype(np.int64), out=offsets[1:])
+        return cls(ids, vocab, offsets, docs, weights.astype(np.float32))
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        np.savez(os.path.join(path, self.POSTINGS_FILE), offsets=self.offsets, docs=self.docs, weights=self.weights)
+        with open(os.path.join(path, self.VOCAB_FILE), "w", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "terms": list(self.vocab)}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(os.path.join(path, cls.POSTINGS_FILE)) as data:
+            offsets, docs, weights = data["offsets"], data["docs"], data["weights"]
+        with open(os.path.join(path, cls.VOCAB_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        return cls(meta["ids"], {t: i for i, t in enumerate(meta["terms"])}, offsets, docs, weights)
+
+    def search(self, text: str, limit: int = 30) -> list[tuple]:
+        """[(id точки, скор BM25)] по убыванию скора."""
+        term_ids = {self.vocab[t] for t in lexical_terms(text) if t in self.vocab}
+        if not term_ids or not self.ids:
+            return []
+        slices = [slice(self.offsets[t], self.offsets[t + 1]) for t in term_ids]
+        docs = np.concatenate([self.docs[s] for s in slices])
+        weights = np.concatenate([self.weights[s] for s in slices])
+        scores = np.bincount(docs, weights=weights, minlength=len(self.ids))
+        limit = min(limit, int(np.count_nonzero(scores)))
+        if limit <= 0:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[d], float(scores[d])) for d in top]
+
+    def stats(self) -> dict:
+        return {"docs": len(self.ids), "terms": len(self.vocab), "postings": int(len(self.docs))}
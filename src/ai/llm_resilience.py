@@ -0,0 +1,231 @@
+import asyncio
+import random
+import time
+from collections import deque
+
+# Обертка вызовов LLM-хаба: повторы по классу ошибки (статус + Retry-After), экспоненциальная
+# задержка с jitter, опциональный хедж (второй такой же запрос, если первый дольше p95)
+# и предохранитель: после серии отказов хаба вызовы сразу падают с CircuitOpenError,
+# и сервер за миллисекунды уходит в ответ из поиска вместо ожидания таймаутов.
+
+# Статусы, на которых повтор имеет смысл: таймаут, конфликт, лимит и ошибки самого хаба.
+# 429 повторяется (с Retry-After), но в счет отказов предохранителя не идет
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Предохранитель разомкнут: хаб считается недоступным, вызов не отправлялся."""
+
+
+def status_code(error: Exception) -> int | None:
+    return getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+
+
+def retry_after_seconds(error: Exception) -> float | None:
+    """Retry-After (секунды) или retry-after-ms из ответа хаба; None, если заголовка нет."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return max(0.0, float(headers.get(name)) * scale)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """Сетевые ошибки и таймауты — да; из HTTP-ошибок только RETRYABLE_STATUSES (400/401/404 повтор не исправит)."""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    status = status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    # openai.APIConnectionError / APITimeoutError приходят без статуса
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Full jitter: случайная пауза в [0, min(cap, base * 2^attempt)] — повторы разных запросов не идут волной."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class LatencyTracker:
+    """Скользящее окно длительностей успешных вызовов для порога хеджа."""
+
+    def __init__(self, window: int = 200):
+        self.samples = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> float | None:
+        if len(self.samples) < 20:
+            return None  # мало данных — хедж не включаем
+        values = sorted(self.samples)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class CircuitBreaker:
+    """
+    closed -> (failures подряд отказов) -> open -> (reset_timeout) -> half_open: пропускается
+    один пробный вызов; успех замыкает, отказ снова размыкает на reset_timeout.
+    """
+
+    def __init__(self, failures: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failures
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed" or self.failure_threshold <= 0:
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self.probe_in_flight = False
+        if self.state == "half_open" and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.failure_threshold > 0 and self.failures >= self.failure_threshold):
+            if self.state != "open":
+                self.opened += 1
+                print(f"🔌 Предохранитель LLM разомкнут на {self.reset_timeout:.0f} с ({self.failures} отказов подряд)")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "opened": self.opened, "rejected": self.rejected}
+
+
+class ResilientCaller:
+    """
+    call(fn): fn — фабрика корутины одного запроса (вызывается заново на каждую попытку и хедж).
+    Повторяются только is_retryable ошибки, не больше max_attempts попыток; Retry-After больше
+    max_delay не ждем — отдаем ошибку сразу, пусть вызывающий уходит в фоллбек.
+    Хедж: если попытка идет дольше p95 (но не меньше hedge_min_delay) и can_hedge() разрешает,
+    запускается вторая такая же, побеждает первый успешный ответ, проигравший отменяется.
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0,
+                 hedge: bool = False, hedge_quantile: float = 0.95, hedge_min_delay: float = 1.0,
+                 breaker: CircuitBreaker | None = None, clock=time.perf_counter):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker or CircuitBreaker(failures=0)
+        self.latency = LatencyTracker()
+        self.clock = clock
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failed = 0
+
+    def hedge_delay(self) -> float | None:
+        if not self.hedge:
+            return None
+        p = self.latency.quantile(self.hedge_quantile)
+        return None if p is None else max(p, self.hedge_min_delay)
+
+    async def call(self, fn, hedge: bool = True, can_hedge=None, discard=None):
+        """can_hedge() — можно ли сейчас хеджировать; discard(result) — освободить ответ проигравшей попытки."""
+        self.calls += 1
+        for attempt in range(self.max_attempts):
+            if not self.breaker.allow():
+                self.failed += 1
+                raise CircuitOpenError("LLM-хаб недоступен (предохранитель разомкнут)")
+            started = self.clock()
+            try:
+                result = await self._attempt(fn, hedge, can_hedge, discard)
+            except asyncio.CancelledError:
+                # Отмена сверху (клиент ушел) — не отказ хаба; пробный вызов освобождаем
+                self.breaker.probe_in_flight = False
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    # Ошибка запроса, а не хаба: предохранитель не трогаем
+                    self.breaker.probe_in_flight = False
+                    self.failed += 1
+                    raise
+                if status_code(e) == 429:
+                    # Хаб жив и просит подождать — это лимит, а не отказ: предохранитель не размыкаем
+                    self.breaker.probe_in_flight = False
+                else:
+                    self.breaker.failure()
+                retry_after = retry_after_seconds(e)
+                last = attempt + 1 >= self.max_attempts
+                if last or (retry_after is not None and retry_after > self.max_delay):
+                    self.failed += 1
+                    raise
+                delay = max(backoff_delay(attempt, self.base_delay, self.max_delay), retry_after or 0.0)
+                self.retries += 1
+                print(f"🔁 LLM: {type(e).__name__} ({status_code(e) or '-'}), повтор {attempt + 2}/{self.max_attempts} через {delay:.2f} с")
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.success()
+            self.latency.add(self.clock() - started)
+            return result
+
+    async def _attempt(self, fn, hedge: bool, can_hedge, discard):
+        delay = self.hedge_delay() if hedge else None
+        if delay is None:
+            return await fn()
+        primary = asyncio.ensure_future(fn())
+        tasks = [primary]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or (can_hedge is not None and not can_hedge()):
+                winner = primary
+                return await primary
+            self.hedges += 1
+            tasks.append(asyncio.ensure_future(fn()))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if task is not winner:
+                    task.cancel()
+                    if discard is not None:
+                        # Проигравший мог успеть ответить (например, открыть стрим) — освобождаем результат
+                        task.add_done_callback(lambda t: discard(t.result()) if not t.cancelled() and t.exception() is None else None)
+
+    def stats(self) -> dict:
+        p95 = self.latency.quantile(0.95)
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "failed": self.failed,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "latency_p95": round(p95, 3) if p95 is not None else None,
+            "breaker": self.breaker.stats(),
+        }
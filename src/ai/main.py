@@ -3,25 +3,131 @@ import uvicorn
 import re
 import json
 import asyncio
-from fastapi import FastAPI, HTTPException, Request
+import math
+import time
+from dataclasses import replace
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from qdrant_client import QdrantClient
 from sentence_transformers import SentenceTransformer
 from .providers import GPTOSSProvider
-from .config import GPT_OSS_API_KEY, MODEL_PATH, DB_PATH, COLLECTION_NAME, BASE_URL
+from .pipeline import StageGraph
+from .inference import InferenceExecutor
+from .embedding_cache import CachedEncoder
+from .response_cache import ResponseCache, normalize_query
+from .clinical_terms import ClinicalTermExtractor
+from .lexical_index import BM25Index
+from .protocol_index import ProtocolIndex, best_icd_code, code_covered, normalize_code
+from .vector_store import Hit, open_store
+from .index_generations import IndexManager, IndexPaths
+from .deadline import DeadlineExceeded, allows, current as current_deadline, from_headers, remaining, run_within, scope
+from .admission import NORMAL, URGENT, AdmissionController, Overloaded
+from .single_flight import SingleFlight
+from .metrics import (
+    CONTENT_TYPE, FALLBACKS, LLM_JSON_FAILURES, REQUEST_SECONDS, Gauge, collect, record, render as render_metrics,
+    server_timing, stage, timed,
+)
+from .config import (
+    GPT_OSS_API_KEY, MODEL_PATH, DB_PATH, COLLECTION_NAME, BASE_URL,
+    VECTOR_BACKEND, NUMPY_DB_PATH, MANIFEST_PATH, TERMS_PATH, LEXICAL_PATH, PROTOCOLS_PATH, NER_BACKEND, INDEX_ROOT, INDEX_WATCH_INTERVAL, ADMIN_TOKEN,
+    INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE, INFERENCE_SUBMIT_TIMEOUT,
+    EMBED_BATCH_SIZE, EMBED_BATCH_WAIT_MS,
+    EMBED_CACHE, EMBED_CACHE_DIR, EMBED_CACHE_MEMORY_ITEMS, EMBED_CACHE_DISK_MB,
+    RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY,
+    BATCH_MAX_ITEMS, BATCH_LLM_CONCURRENCY,
+    LLM_GATE, LLM_GATE_MIN_SCORE, LLM_GATE_MIN_MARGIN, LLM_GATE_CONFIDENCE,
+    RETRIEVAL_MODE, PROTOCOL_SEARCH_LIMIT, PROTOCOL_CANDIDATES, LEXICAL_SEARCH, RRF_K, TITLE_MATCH_BOOST, LLM_VALIDATE_CODES,
+    REQUEST_DEADLINE, REQUEST_DEADLINE_MAX, DEADLINE_LLM_RESERVE, DEADLINE_NER_MIN, DEADLINE_LLM_MIN, DEADLINE_RESPONSE_RESERVE,
+    ADMISSION_MAX_ACTIVE, ADMISSION_QUEUE_SIZE, ADMISSION_SHED, COALESCE_REQUESTS,
+)
 
 app = FastAPI(title="QazCode Medical AI - Dual RAG")
 
-encoder, qdrant, llm = None, None, None
+inference, index, llm, responses, admission = None, None, None, None, None
+flights = SingleFlight()
+
+Gauge("admission_active", "Запросы со слотом допуска", lambda: admission.active if admission else None)
+Gauge("admission_queue_depth", "Запросы в очереди допуска", lambda: admission.depth() if admission else None)
+Gauge("coalescing_in_flight", "Уникальные запросы /diagnose в полете", lambda: flights.stats()["in_flight"] if COALESCE_REQUESTS else None)
 
 @app.on_event("startup")
 async def startup_event():
-    global encoder, qdrant, llm
+    global inference, index, llm, responses, admission
     print("⌛ Загрузка AI компонентов...")
     encoder = SentenceTransformer(MODEL_PATH)
-    qdrant = QdrantClient(path=DB_PATH)
+    if EMBED_CACHE:
+        # Повторяющиеся запросы (и саммари) не гоняем через энкодер второй раз
+        encoder = CachedEncoder(
+            encoder, MODEL_PATH, EMBED_CACHE_DIR, "query",
+            memory_items=EMBED_CACHE_MEMORY_ITEMS, disk_mb=EMBED_CACHE_DISK_MB,
+        )
+    # Поколения индекса: ingest публикует новое, сервер подменяет его на лету.
+    # Поиск идет без payload: название, коды и текст чанков берутся из таблицы протоколов
+    index = IndexManager(
+        INDEX_ROOT,
+        lambda paths: open_store(VECTOR_BACKEND, paths.db, paths.numpy, COLLECTION_NAME, with_payload=False),
+        legacy=IndexPaths(DB_PATH, NUMPY_DB_PATH, MANIFEST_PATH, TERMS_PATH, LEXICAL_PATH, PROTOCOLS_PATH),
+        warmup=warm_generation,
+    )
+    generation = index.load()
+    # Энкодер и поиск работают в отдельном пуле потоков, event loop их только ждет
+    inference = InferenceExecutor(
+        encoder,
+        workers=INFERENCE_WORKERS,
+        queue_size=INFERENCE_QUEUE_SIZE,
+        submit_timeout=INFERENCE_SUBMIT_TIMEOUT,
+        batch_size=EMBED_BATCH_SIZE,
+        batch_wait_ms=EMBED_BATCH_WAIT_MS,
+    )
     llm = GPTOSSProvider(GPT_OSS_API_KEY, BASE_URL)
-    print("✅ Система готова.")
+    if RESPONSE_CACHE_SIZE > 0:
+        responses = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY)
+    if ADMISSION_MAX_ACTIVE > 0:
+        admission = AdmissionController(ADMISSION_MAX_ACTIVE, ADMISSION_QUEUE_SIZE)
+    # Первое поколение прогревается так же, как подмененное через reload
+    await warm_generation(generation)
+    index.start_watch(INDEX_WATCH_INTERVAL)
+    print(f"✅ Система готова (векторы: {VECTOR_BACKEND}, NER: {NER_BACKEND}, поколение {generation.name}, {generation.store.count()} точек).")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if inference:
+        inference.shutdown()
+        if isinstance(inference.encoder, CachedEncoder):
+            inference.encoder.close()
+    if index:
+        await index.close()
+
+
+@app.get("/stats")
+async def stats():
+    """Счетчики пула инференса, батчера и кэша эмбеддингов, поколений индекса, кэша ответов, допуска и LLM."""
+    return {
+        "inference": inference.stats() if inference else None,
+        "index": index.stats() if index else None,
+        "response_cache": responses.stats() if responses else None,
+        "admission": admission.stats() if admission else None,
+        "coalescing": flights.stats() if COALESCE_REQUESTS else None,
+        "llm": llm.stats() if llm else None,
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики в формате Prometheus: стадии пайплайна, попытки и токены LLM, фоллбеки, очередь допуска."""
+    return Response(render_metrics(), media_type=CONTENT_TYPE)
+
+
+@app.post("/admin/reload-index")
+async def reload_index(force: bool = False, x_admin_token: str | None = Header(default=None)):
+    """Подхватывает опубликованное поколение индекса без рестарта."""
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    try:
+        return await index.reload(force=force)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Не удалось открыть поколение индекса: {e}")
 
 
 async def get_clinical_keywords(user_text: str):
@@ -31,160 +137,849 @@ async def get_clinical_keywords(user_text: str):
         f"Текст пациента: {user_text}\n\n"
         f"Верни ТОЛЬКО текст саммари."
     )
+    messages = [{"role": "user", "content": prompt}]
     try:
-        response = await llm.client.chat.completions.create(
-            model=llm.model, # Используем основную модель (flash)
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1
-        )
+        # 429 и сбои хаба повторяет llm.chat (с паузой по Retry-After); при разомкнутом
+        # предохранителе ошибка приходит сразу — ищем по сырому тексту
+        response = await llm.chat(messages=messages, temperature=0.1)
         return response.choices[0].message.content
     except Exception as e:
-        if "429" in str(e):
-            print("⏳ Лимит на NER, жду 15 сек...")
-            await asyncio.sleep(15)
-            response = await llm.client.chat.completions.create(
-                model=llm.model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.1
-            )
-            return response.choices[0].message.content
         print(f"⚠️ Ошибка NER: {e}")
         return user_text
 
+def load_clinical_terms(generation) -> ClinicalTermExtractor:
+    path = generation.paths.terms if generation.paths else ""
+    if path and os.path.exists(path):
+        return ClinicalTermExtractor.load(path)
+    # Поколение собрано до появления словаря — строим по payload из самого индекса
+    print(f"📚 Нет словаря терминов для поколения {generation.name}, строю по индексу...")
+    return ClinicalTermExtractor.build(generation.store.iter_payloads())
+
+
+def load_lexical_index(generation) -> BM25Index:
+    path = generation.paths.lexical if generation.paths else ""
+    if path and os.path.isdir(path):
+        return BM25Index.load(path)
+    print(f"🔤 Нет BM25-индекса для поколения {generation.name}, строю по индексу...")
+    return BM25Index.build(generation.store.iter_points())
+
+
+def load_protocol_index(generation) -> ProtocolIndex:
+    path = generation.paths.protocols if generation.paths else ""
+    if ProtocolIndex.exists(path):
+        return ProtocolIndex.load(path)
+    # Поколение старого формата: полный payload лежит в самих точках
+    print(f"🏷 Нет таблицы протоколов для поколения {generation.name}, строю по индексу...")
+    return ProtocolIndex.build(generation.store.iter_points())
+
+
+async def generation_resource(generation, name: str, loader):
+    """Производная структура поколения (словарь, BM25); грузится один раз, параллельные запросы ждут ту же загрузку."""
+    task = generation.resources.get(name)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(loader, generation))
+        generation.resources[name] = task
+    try:
+        return await task
+    except Exception:
+        # Следующий запрос попробует загрузить заново
+        if generation.resources.get(name) is task:
+            del generation.resources[name]
+        raise
+
+
+async def clinical_terms(generation) -> ClinicalTermExtractor:
+    return await generation_resource(generation, "terms", load_clinical_terms)
+
+
+async def protocol_index(generation) -> ProtocolIndex | None:
+    """Таблица протоколов поколения; без нее бустинг и фоллбек считают все по payload найденных точек."""
+    try:
+        return await generation_resource(generation, "protocols", load_protocol_index)
+    except Exception as e:
+        print(f"⚠️ Метаданные протоколов недоступны: {e}")
+        return None
+
+
+WARMUP_QUERY = "query: боль в животе"
+
+
+async def warm_generation(generation):
+    """
+    Прогрев поколения до того, как на него пойдут запросы: таблица протоколов (и страницы mmap с чанками),
+    словарь терминов, BM25 и пробные поиски. Без него все это грузилось бы лениво первыми запросами.
+    """
+    protocols = await generation_resource(generation, "protocols", load_protocol_index)
+    await asyncio.to_thread(protocols.warm)
+    print(f"🏷 Таблица протоколов: {protocols.stats()['protocols']} протоколов, {protocols.stats()['chunks']} чанков")
+    try:
+        # Словарь нужен локальному NER и ответам без LLM под перегрузкой
+        extractor = await clinical_terms(generation)
+        print(f"📚 Словарь терминов: {len(extractor.terms)} терминов")
+    except Exception as e:
+        if NER_BACKEND == "local":
+            raise
+        print(f"⚠️ Словарь терминов недоступен: {e}")
+    if LEXICAL_SEARCH:
+        lexical = await generation_resource(generation, "lexical", load_lexical_index)
+        await inference.run(lexical_hits, lexical, WARMUP_QUERY, 1)
+        print(f"🔤 BM25: {lexical.stats()['terms']} термов")
+    # Пробный векторный поиск в том же режиме, что и у запросов (в метрики стадий не идет)
+    vector = await inference.embed(WARMUP_QUERY)
+    if RETRIEVAL_MODE == "protocols":
+        hits = await inference.search_groups(generation.store, vector, PROTOCOL_SEARCH_LIMIT, PROTOCOL_CANDIDATES)
+    else:
+        hits = await inference.search(generation.store, vector, limit=30)
+    protocols.resolve(hits)
+
+
+@timed("ner")
+async def clinical_summary(user_text: str, generation, backend: str = NER_BACKEND) -> str:
+    """Медицинское саммари жалоб для второго поиска: LLM-NER или локальный словарь терминов."""
+    if backend == "local":
+        try:
+            extractor = await clinical_terms(generation)
+        except Exception as e:
+            print(f"⚠️ Ошибка NER: {e}")
+            return user_text
+        return extractor.summary(user_text)
+    # LLM-NER укладывается в бюджет запроса, оставляя DEADLINE_LLM_RESERVE на диагноз
+    if not allows(DEADLINE_NER_MIN, DEADLINE_LLM_RESERVE):
+        current_deadline().degrade("ner")
+        print("⏱ Мало бюджета — без NER, поиск по сырому тексту")
+        return user_text
+    try:
+        return await run_within(get_clinical_keywords(user_text), DEADLINE_LLM_RESERVE, stage="ner")
+    except DeadlineExceeded:
+        print("⏱ NER не уложился в бюджет — поиск по сырому тексту")
+        return user_text
+
+
+async def search_text(store, text: str, limit: int = 30, kind: str = "raw"):
+    """Эмбеддинг + векторный поиск через пул инференса, event loop при этом свободен; kind — raw / summary для метрик."""
+    with stage(f"encode_{kind}"):
+        vector = await inference.embed(f"query: {text[:1000]}")
+    with stage(f"search_{kind}"):
+        if RETRIEVAL_MODE == "protocols":
+            return await inference.search_groups(store, vector, PROTOCOL_SEARCH_LIMIT, PROTOCOL_CANDIDATES)
+        return await inference.search(store, vector, limit=limit)
+
+
+async def search_vectors(store, vectors: list, limit: int = 30) -> list[list]:
+    """Батч-вариант search_text для готовых векторов, в том же режиме RETRIEVAL_MODE."""
+    if RETRIEVAL_MODE == "protocols":
+        return await inference.search_groups_batch(store, vectors, PROTOCOL_SEARCH_LIMIT, PROTOCOL_CANDIDATES)
+    return await inference.search_batch(store, vectors, limit)
+
+
+def lexical_hits(lexical: BM25Index, text: str, limit: int) -> list:
+    # Как и векторный поиск — только id и скоры, payload подставит rank_protocols из таблицы
+    return [Hit(id=point_id, score=score, payload=None) for point_id, score in lexical.search(text, limit)]
+
+
+async def search_lexical(generation, text: str, limit: int = 30):
+    """BM25 по чанкам поколения; если индекса нет и построить не вышло — пустой список (остается dense)."""
+    if not LEXICAL_SEARCH:
+        return []
+    try:
+        lexical = await generation_resource(generation, "lexical", load_lexical_index)
+    except Exception as e:
+        print(f"⚠️ BM25 недоступен: {e}")
+        return []
+    with stage("search_lexical"):
+        return await inference.run(lexical_hits, lexical, text, limit)
+
+
+@timed("boosting")
+def rank_protocols(query_text_raw: str, res_raw: list, res_med: list, res_lex: list = (),
+                   meta: ProtocolIndex | None = None, top_k: int = 5):
+    """
+    Слияние поисков (сырой текст, саммари, BM25) через reciprocal rank fusion, бустинг по кодам МКБ
+    и отбор top_k уникальных протоколов. score у возвращенных точек — уже с бустингом (по нему работает гейт LLM),
+    payload — полный, из таблицы протоколов (поиск возвращает только id).
+    """
+    # Объединяем результаты: скоры разных поисков несравнимы, складываем только ранги
+    fused = {}
+    for results in (res_raw, res_med, res_lex):
+        for rank, point in enumerate(results, start=1):
+            score, _ = fused.get(point.id, (0.0, point))
+            fused[point.id] = (score + 1.0 / (RRF_K + rank), point)
+
+    # Heavy Boosting с защитой от Стоп-слов: запрос сканируется автоматом один раз
+    if meta is None:
+        meta = ProtocolIndex.build(point for _, point in fused.values() if point.payload)
+    match = meta.scan(query_text_raw)
+    scored_results = []
+
+    for score, point in fused.values():
+        pid = meta.protocol_of(point)
+        if pid is None:
+            continue
+        # БУСТИНГ ПО КОДАМ МКБ (Оставляем, это хард-факты): +10 за каждый код протокола, который юзер реально ввел
+        score += 10.0 * match.code_hits.get(pid, 0)
+        if pid in match.title_hits:
+            score += TITLE_MATCH_BOOST
+        scored_results.append((score, pid, point))
+
+    scored_results.sort(key=lambda x: x[0], reverse=True)
+
+    unique_protocols = []
+    seen_ids = set()
+    for s, pid, p in scored_results:
+        if pid not in seen_ids:
+            unique_protocols.append(replace(p, score=s))
+            seen_ids.add(pid)
+        if len(unique_protocols) >= top_k: break
+    return meta.resolve(unique_protocols)
+
+
+def build_retrieval_graph(query_text_raw: str, generation, ner_backend: str = NER_BACKEND) -> StageGraph:
+    """
+    Граф стадий поиска. Поиск по сырому тексту не зависит от саммари,
+    поэтому идет параллельно с NER-запросом к LLM; ждут NER только поиск по саммари и слияние.
+    """
+    store = generation.store
+    graph = StageGraph()
+    graph.add("summary", lambda: clinical_summary(query_text_raw, generation, ner_backend))
+    graph.add("hits_raw", lambda: search_text(store, query_text_raw))
+    graph.add("hits_med", lambda summary: search_text(store, summary, kind="summary"), deps=["summary"])
+    # BM25 быстрый (< 1 мс), поэтому ждет саммари: термины из него совпадают с лексикой протоколов
+    graph.add("hits_lex", lambda summary: search_lexical(generation, f"{query_text_raw} {summary}"), deps=["summary"])
+    graph.add("meta", lambda: protocol_index(generation))
+    graph.add("ranked", lambda res_raw, res_med, res_lex, meta: rank_protocols(query_text_raw, res_raw, res_med, res_lex, meta),
+              deps=["hits_raw", "hits_med", "hits_lex", "meta"])
+    return graph
+
+
+def query_text(body) -> str | None:
+    """Симптомы из любого возможного поля запроса."""
+    if not isinstance(body, dict):
+        return None
+    text = body.get("symptoms") or body.get("text") or body.get("query")
+    return text if isinstance(text, str) and text.strip() else None
+
+
+async def until_disconnected(request: Request, work):
+    """
+    Выполняет work, пока клиент на связи: отключился — work отменяется вместе с вызовами LLM,
+    квота хаба на ответ, который никто не прочитает, не тратится. Тело запроса должно быть уже прочитано.
+    """
+    task = asyncio.ensure_future(work)
+
+    async def disconnected():
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+
+    watcher = asyncio.ensure_future(disconnected())
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            return task.result()
+        print("🔌 Клиент отключился — запрос отменен")
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        raise HTTPException(status_code=499, detail="Client Closed Request")
+    finally:
+        watcher.cancel()
+        task.cancel()
+
+
+def cache_enabled(request: Request) -> bool:
+    return responses is not None and "no-cache" not in request.headers.get("cache-control", "")
+
+
+@timed("cache_lookup")
+async def lookup_cached(request: Request, generation):
+    """(text, vector, cached) для кэша ответов (в режиме гейта запроса); text=None — кэш в этом запросе не участвует."""
+    if not cache_enabled(request):
+        return None, None, None
+    try:
+        text = query_text(await request.json())
+    except ValueError:
+        text = None
+    if not text:
+        return None, None, None
+    vector = None
+    # Тот же вектор понадобится поиску по сырому тексту — второй раз он возьмется из кэша эмбеддингов
+    try:
+        vector = await inference.embed(f"query: {text[:1000]}")
+    except Exception as e:
+        print(f"⚠️ Кэш ответов: без эмбеддинга, только точное совпадение ({e})")
+    return text, vector, responses.get(text, vector, generation.name, gate_mode(request))
+
+
 @app.post("/diagnose")
-async def diagnose(request: Request):
+async def diagnose(request: Request, response: Response):
+    # Тело читаем сразу: дальше receive() слушает отключение клиента
+    await request.body()
+    started = time.perf_counter()
+    with collect() as timings, scope(from_headers(request.headers, REQUEST_DEADLINE, REQUEST_DEADLINE_MAX)) as deadline:
+        try:
+            result = await diagnose_within_deadline(request, response)
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="diagnose")
+        response.headers["X-Deadline"] = deadline.header()
+        response.headers["Server-Timing"] = server_timing(timings, time.perf_counter() - started)
+        return result
+
+
+async def diagnose_within_deadline(request: Request, response: Response):
+    # Запрос целиком работает на одном поколении индекса, даже если его подменили посреди запроса
+    async with index.lease() as generation:
+        text, vector, cached = await lookup_cached(request, generation)
+        if cached:
+            result, match, similarity, gate = cached
+            response.headers["X-Cache"] = "HIT"
+            response.headers["X-Cache-Match"] = f"{match}; similarity={similarity:.3f}"
+            response.headers.update(gate_headers(gate))
+            return result
+
+        result = await until_disconnected(request, coalesced_diagnosis(request, generation, text))
+        response.headers["X-Cache"] = "MISS" if cache_enabled(request) else "BYPASS"
+        response.headers.update(gate_headers(getattr(request.state, "gate", None)))
+        shed = getattr(request.state, "shed", None)
+        if shed:
+            response.headers["X-Admission"] = f"shed={shed}"
+        if getattr(request.state, "coalesced", False):
+            response.headers["X-Coalesced"] = "joined"
+        # Фоллбек (ошибка LLM) и ответ без LLM под перегрузкой не кэшируем — следующий запрос должен попробовать еще раз
+        if text and vector is not None and not getattr(request.state, "fallback", False) and not shed:
+            responses.put(text, vector, generation.name, result, gate_mode(request), getattr(request.state, "gate", None))
+        return result
+
+
+def request_priority(request: Request) -> int:
+    """X-Priority: urgent — запрос из неотложки, в очереди допуска идет вперед."""
+    return URGENT if request.headers.get("x-priority", "").lower() == "urgent" else NORMAL
+
+
+def admission_wait() -> float | None:
+    """Сколько можно ждать слота: после него должно хватить бюджета на LLM."""
+    return remaining(DEADLINE_LLM_MIN + DEADLINE_RESPONSE_RESERVE)
+
+
+# Что пайплайн пишет в request.state — вторые запросы получают это от первого вместе с ответом
+REQUEST_STATE = ("gate", "fallback", "shed")
+
+
+async def coalesced_diagnosis(request: Request, generation, text: str | None = None):
+    """admitted_diagnosis, общий для одинаковых запросов в полете; text — уже извлеченные симптомы (если есть)."""
+    if not COALESCE_REQUESTS:
+        return await admitted_diagnosis(request, generation)
+    if text is None:
+        try:
+            text = query_text(await request.json())
+        except ValueError:
+            text = None
+    if not text:
+        return await admitted_diagnosis(request, generation)
+
+    async def compute():
+        result = await admitted_diagnosis(request, generation)
+        return result, {name: getattr(request.state, name, None) for name in REQUEST_STATE}
+
+    # Первый запрос считает со своими дедлайном и приоритетом: срочный или с более коротким
+    # бюджетом к нему не присоединяется (получил бы ответ позже своего дедлайна / в обычной очереди)
+    deadline = current_deadline()
+    terms = (request_priority(request), deadline.expires_at if deadline is not None else math.inf)
+
+    def accepts(leader) -> bool:
+        return terms[0] >= leader[0] and terms[1] >= leader[1]
+
+    key = (normalize_query(text), generation.name, gate_mode(request))
+    started = time.perf_counter()
+    (result, state), joined = await flights.do(key, compute, terms, accepts)
+    if joined:
+        # Стадии считал первый запрос; здесь — только ожидание его результата
+        record("coalesced", time.perf_counter() - started)
+        print("🔗 Такой же запрос уже в работе — жду его результат")
+        for name, value in state.items():
+            setattr(request.state, name, value)
+        request.state.coalesced = True
+    return result
+
+
+async def admitted_diagnosis(request: Request, generation):
+    """run_diagnosis за слотом допуска; не допущен — ответ из поиска без LLM (с полем "shed") или 503."""
+    if admission is None:
+        return await run_diagnosis(request, generation)
+    waiting = time.perf_counter()
+    try:
+        async with admission.slot(request_priority(request), admission_wait()):
+            record("admission_wait", time.perf_counter() - waiting)
+            return await run_diagnosis(request, generation)
+    except Overloaded as e:
+        record("admission_wait", time.perf_counter() - waiting)
+        print(f"🚧 Перегрузка: {e}")
+        if ADMISSION_SHED == "reject":
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+        request.state.shed = e.reason
+        return {**await run_diagnosis(request, generation, retrieval_only=True), "shed": e.reason}
+
+
+def protocol_best_code(point, meta: ProtocolIndex | None = None) -> str:
+    if meta is not None:
+        return meta.best_code(point.payload['protocol_id'], point.payload.get('icd_codes', []))
+    return best_icd_code(point.payload.get('icd_codes', []))
+
+
+def fallback_diagnoses(protocols: list, limit: int = 3, meta: ProtocolIndex | None = None) -> list[dict]:
+    """Диагнозы прямо по найденным протоколам, без LLM (формат как у ответа LLM)."""
+    fallback = []
+    for i, p in enumerate(protocols[:limit]):
+        best_code = protocol_best_code(p, meta)
+        fallback.append({
+            "rank": i + 1,
+            "icd_code": best_code,
+            "icd10_code": best_code,
+            "name": p.payload['title'],
+            "explanation": f"Диагноз подобран на основе семантического поиска РК: {p.payload['title']}."
+        })
+    return fallback
+
+
+@timed("fallback")
+def fallback_response(protocols: list, meta: ProtocolIndex | None = None) -> dict:
+    # Fallback берет топ-3 из найденных протоколов
+    fallback = fallback_diagnoses(protocols, meta=meta)
+    # Если unique_protocols пустой (ошибка в поиске)
+    if not fallback:
+        fallback = [{"rank": 1, "icd_code": "Unknown", "name": "Error", "explanation": "System Failure"}]
+    return {"diagnoses": fallback, "confidence": 0.5}
+
+
+@timed("context_build")
+def build_context(protocols: list) -> str:
+    context_parts = []
+    for p in protocols:
+        payload = p.payload
+        context_parts.append(
+            f"ПРОТОКОЛ: {payload['title']}\n"
+            f"КОДЫ: {', '.join(payload['icd_codes'])}\n"
+            f"ТЕКСТ: {payload['content'][:1500]}"
+        )
+    return "\n\n---\n\n".join(context_parts)
+
+
+def gate_mode(request: Request) -> str:
+    """X-LLM-Gate: auto (по порогам), retrieval (всегда без LLM), llm (всегда через LLM) — для калибровки."""
+    mode = request.headers.get("x-llm-gate", "auto").lower()
+    return mode if mode in ("auto", "retrieval", "llm") else "auto"
+
+
+def gate_decision(unique_protocols: list, mode: str = "auto") -> dict:
+    """
+    Гейт после бустинга: если топ-1 протокол явно доминирует (скор и отрыв от топ-2 выше порогов,
+    например сработал +10.0 за код МКБ в тексте), ответ собирается прямо из поиска, без второго вызова LLM.
+    """
+    top1 = unique_protocols[0].score
+    top2 = unique_protocols[1].score if len(unique_protocols) > 1 else 0.0
+    margin = top1 - top2
+    if mode == "auto":
+        decisive = LLM_GATE and top1 >= LLM_GATE_MIN_SCORE and margin >= LLM_GATE_MIN_MARGIN
+    else:
+        decisive = mode == "retrieval"
+    gate = {"decisive": bool(decisive), "mode": mode, "top1": round(top1, 4), "margin": round(margin, 4)}
+    print(f"🚦 Гейт LLM: {'ответ из поиска' if decisive else 'LLM'} (top1={top1:.4f}, отрыв={margin:.4f}, режим {mode})")
+    return gate
+
+
+def gate_headers(gate: dict | None) -> dict:
+    if not gate:
+        return {}
+    return {
+        "X-LLM-Gate": "retrieval" if gate["decisive"] else "llm",
+        "X-LLM-Gate-Scores": f"top1={gate['top1']}; margin={gate['margin']}",
+    }
+
+
+def retrieval_response(unique_protocols: list, meta: ProtocolIndex | None = None) -> dict:
+    """Ответ без LLM для уверенного поиска: тот же выбор кода, что и в фоллбеке."""
+    return {"diagnoses": fallback_diagnoses(unique_protocols, meta=meta), "confidence": LLM_GATE_CONFIDENCE}
+
+
+def allowed_codes(unique_protocols: list, meta: ProtocolIndex | None = None) -> set:
+    """Коды МКБ найденных протоколов — только из них LLM может выбирать."""
+    codes = set()
+    for p in unique_protocols:
+        found = meta.codes(p.payload['protocol_id']) if meta is not None else ()
+        codes.update(found or (normalize_code(c) for c in p.payload.get('icd_codes', [])))
+    return codes
+
+
+def fix_diagnosis_code(d: dict, i: int, unique_protocols: list, meta: ProtocolIndex | None, valid_codes: set | None) -> dict:
+    """Авто-фикс кода i-го диагноза: NULL, Unknown или код не из найденных протоколов -> код протокола."""
+    code = d.get("icd_code")
+    if code and code != "Unknown" and valid_codes is not None:
+        # Более точный код внутри кода или диапазона протокола тоже годится
+        if code_covered(code, valid_codes):
+            d["icd_code"] = normalize_code(code)
+        else:
+            print(f"🩺 Код {code} не из найденных протоколов, заменяю")
+            code = None
+    if not code or code == "Unknown":
+        ref_p = unique_protocols[min(i, len(unique_protocols)-1)]
+        best_code = protocol_best_code(ref_p, meta)
+        d["icd_code"] = best_code
+        d["icd10_code"] = best_code
+    d["icd10_code"] = d["icd_code"]
+    return d
+
+
+def diagnosis_forwarder(on_diagnosis, unique_protocols: list, meta: ProtocolIndex | None, valid_codes: set | None):
+    """Колбэк для стрима LLM: i-й пришедший диагноз — через авто-фикс кода и дальше в on_diagnosis."""
+    forwarded = 0
+
+    def forward(d: dict):
+        nonlocal forwarded
+        on_diagnosis(fix_diagnosis_code(d, forwarded, unique_protocols, meta, valid_codes))
+        forwarded += 1
+
+    return forward
+
+
+async def llm_diagnosis(query_text_raw: str, unique_protocols: list, meta: ProtocolIndex | None = None,
+                        on_diagnosis=None) -> dict:
+    """
+    Сборка контекста и ответ LLM с авто-фиксом и проверкой кодов; любая проблема — исключение (уходим в Fallback).
+    on_diagnosis получает диагнозы (уже с исправленным кодом) по мере стрима LLM.
+    """
+    # 4. ШАГ: Сборка контекста
+    context = build_context(unique_protocols)
+    valid_codes = allowed_codes(unique_protocols, meta) if LLM_VALIDATE_CODES else None
+
+    forward = diagnosis_forwarder(on_diagnosis, unique_protocols, meta, valid_codes) if on_diagnosis else None
+
+    # 5. ШАГ: Генерация ответа через LLM
+    print(f"🧠 LLM анализирует Топ-1: {unique_protocols[0].payload['title']}")
+    try:
+        with stage("llm_diagnosis"):
+            result = await llm.get_diagnosis(query_text_raw, context, on_diagnosis=forward)
+
+        # Проверяем, не вернул ли провайдер ошибку
+        if isinstance(result, dict) and result.get("error"):
+            raise ValueError(result["error"])
+
+        if isinstance(result, dict) and "diagnoses" in result:
+            diagnoses_list = result["diagnoses"]
+            if not diagnoses_list:
+                raise ValueError("LLM вернула пустой список диагнозов")
+
+            # АВТО-ФИКС КОДОВ, ЕСЛИ LLM ВЕРНУЛА NULL, UNKNOWN ИЛИ КОД НЕ ИЗ НАЙДЕННЫХ ПРОТОКОЛОВ
+            for i, d in enumerate(diagnoses_list):
+                fix_diagnosis_code(d, i, unique_protocols, meta, valid_codes)
+
+            print("✅ LLM ответила успешно!")
+            return result
+        else:
+            LLM_JSON_FAILURES.inc(kind="schema")
+            raise ValueError(f"LLM вернула битый JSON или неверный формат: {str(result)[:100]}")
+
+    except Exception as e:
+        print(f"❌❌ ОШИБКА LLM: {str(e)}")
+        raise e # Уходим в Fallback
+
+
+async def budgeted_llm_diagnosis(query_text_raw: str, unique_protocols: list, meta: ProtocolIndex | None = None,
+                                 slots: asyncio.Semaphore | None = None, on_diagnosis=None) -> dict:
+    """
+    llm_diagnosis в рамках бюджета запроса (вместе с ожиданием слота slots): если времени меньше
+    DEADLINE_LLM_MIN — DeadlineExceeded сразу, по истечении бюджета вызов LLM отменяется; вызывающий уходит в фоллбек.
+    """
+    if not allows(DEADLINE_LLM_MIN, DEADLINE_RESPONSE_RESERVE):
+        current_deadline().degrade("llm")
+        raise DeadlineExceeded("Нет бюджета на LLM")
+
+    async def call():
+        if slots is None:
+            return await llm_diagnosis(query_text_raw, unique_protocols, meta, on_diagnosis)
+        async with slots:
+            return await llm_diagnosis(query_text_raw, unique_protocols, meta, on_diagnosis)
+
+    return await run_within(call(), DEADLINE_RESPONSE_RESERVE, stage="llm")
+
+
+async def run_diagnosis(request: Request, generation, retrieval_only: bool = False):
+    """Пайплайн /diagnose; retrieval_only — без вызовов LLM (локальный NER, ответ из поиска)."""
     unique_protocols = [] # Инициализация для Fallback
+    meta = None
+    graph = None
     try:
         body = await request.json()
         print(f"📥 Пришло в запросе: {body}") 
         
         # Вытаскиваем симптомы из любого возможного поля
-        query_text_raw = body.get("symptoms") or body.get("text") or body.get("query")
+        query_text_raw = query_text(body)
         print(f"\n📥 Вход: {query_text_raw[:100]}...")
         
-        # 1. ШАГ: Извлекаем клинические термины (Medical Summary)
-        med_summary = await get_clinical_keywords(query_text_raw)
+        # 1-3. ШАГ: NER (саммари) и ДВОЙНОЙ ПОИСК с бустингом — одним графом стадий
+        graph = build_retrieval_graph(query_text_raw, generation, "local" if retrieval_only else NER_BACKEND).start()
+        med_summary = await graph.result("summary")
         print(f"📋 Саммари: {med_summary}")
+        meta = await graph.result("meta")
+        unique_protocols = await run_within(graph.result("ranked"), DEADLINE_RESPONSE_RESERVE, stage="search")
+            
+        if not unique_protocols:
+            raise ValueError("No protocols found.")
 
-        await asyncio.sleep(4.1)
+        # Гейт: при явном лидере LLM не зовем
+        request.state.gate = gate_decision(unique_protocols, gate_mode(request))
+        if request.state.gate["decisive"]:
+            return retrieval_response(unique_protocols, meta)
+        if retrieval_only:
+            return fallback_response(unique_protocols, meta)
 
-        # 2. ШАГ: ДВОЙНОЙ ПОИСК
-        vector_raw = encoder.encode(f"query: {query_text_raw[:1000]}").tolist()
-        res_raw = qdrant.query_points(collection_name=COLLECTION_NAME, query=vector_raw, limit=30).points
-        
-        vector_med = encoder.encode(f"query: {med_summary[:1000]}").tolist()
-        res_med = qdrant.query_points(collection_name=COLLECTION_NAME, query=vector_med, limit=30).points
+        # 4-5. ШАГ: Контекст и ответ LLM (если бюджет позволяет)
+        return await budgeted_llm_diagnosis(query_text_raw, unique_protocols, meta)
 
-        # Объединяем результаты
-        all_results_dict = {p.id: p for p in res_raw + res_med}
-        all_results = list(all_results_dict.values())
+    except Exception as e:
+        print(f"⚠️ Работает Fallback: {e}")
+        FALLBACKS.inc(endpoint="diagnose")
+        request.state.fallback = True
+        return fallback_response(unique_protocols, meta)
+    finally:
+        if graph:
+            await graph.close()
 
-        # 3. ШАГ: Heavy Boosting с защитой от Стоп-слов
-        scored_results = []
-        q_lower = query_text_raw.lower()
 
-        for point in all_results:
-            p = point.payload
-            score = point.score # Берем чистый векторный скор
-            icd_codes = [str(c).upper().replace('О', 'O') for c in p.get('icd_codes', [])]
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-            # БУСТИНГ ПО КОДАМ МКБ (Оставляем, это хард-факты)
-            for code in icd_codes:
-                if len(code) > 2 and code.lower() in q_lower:
-                    score += 10.0 # Поднимаем, только если юзер реально ввел код
 
-            scored_results.append((score, point))
+@app.post("/diagnose/stream")
+async def diagnose_stream(request: Request):
+    """
+    Server-Sent Events вариант /diagnose, чтобы фронт не ждал LLM с пустым экраном.
+    События: candidates (stage=raw — по сырому тексту, не дожидаясь NER; stage=ranked — после
+    слияния двух поисков; формат как у фоллбека), diagnosis (каждый диагноз LLM, как только он
+    дописан), diagnoses (тот же ответ, что у /diagnose), done.
+    """
+    # Тело читаем до старта ответа: дальше receive() слушает уже StreamingResponse (отключение клиента)
+    await request.body()
+    return StreamingResponse(
+        stream_diagnosis(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-        scored_results.sort(key=lambda x: x[0], reverse=True)
-        
-        seen_ids = set()
-        for s, p in scored_results:
-            pid = p.payload['protocol_id']
-            if pid not in seen_ids:
-                unique_protocols.append(p)
-                seen_ids.add(pid)
-            if len(unique_protocols) >= 5: break
-            
-        if not unique_protocols:
-            raise ValueError("No protocols found.")
 
-        # 4. ШАГ: Сборка контекста
-        context_parts = []
-        for p in unique_protocols:
-            payload = p.payload
-            context_parts.append(
-                f"ПРОТОКОЛ: {payload['title']}\n"
-                f"КОДЫ: {', '.join(payload['icd_codes'])}\n"
-                f"ТЕКСТ: {payload['content'][:1500]}"
-            )
-        context = "\n\n---\n\n".join(context_parts)
-
-        # 5. ШАГ: Генерация ответа через LLM
-        print(f"🧠 LLM анализирует Топ-1: {unique_protocols[0].payload['title']}")
+async def stream_diagnosis(request: Request):
+    # Отключение клиента StreamingResponse обрабатывает сам: генератор отменяется вместе с вызовом LLM
+    started = time.perf_counter()
+    with collect() as timings, scope(from_headers(request.headers, REQUEST_DEADLINE, REQUEST_DEADLINE_MAX)) as deadline:
         try:
-            result = await llm.get_diagnosis(query_text_raw, context)
-            
-            # Проверяем, не вернул ли провайдер ошибку
-            if isinstance(result, dict) and result.get("error"):
-                raise ValueError(result["error"])
-
-            if isinstance(result, dict) and "diagnoses" in result:
-                diagnoses_list = result["diagnoses"]
-                if not diagnoses_list:
-                    raise ValueError("LLM вернула пустой список диагнозов")
-
-                # АВТО-ФИКС КОДОВ, ЕСЛИ LLM ВЕРНУЛА NULL ИЛИ UNKNOWN
-                for i, d in enumerate(diagnoses_list):
-                    if not d.get("icd_code") or d.get("icd_code") == "Unknown" or d.get("icd_code") is None:
-                        ref_p = unique_protocols[min(i, len(unique_protocols)-1)]
-                        
-                        # --- ТОЧЕЧНЫЙ ФИКС ВЫБОРА КОДА ---
-                        codes = ref_p.payload.get('icd_codes', [])
-                        best_code = "Unknown"
-                        if codes:
-                            # Ищем код с точкой (он точнее)
-                            specific_codes = [c for c in codes if '.' in c]
-                            best_code = specific_codes[0] if specific_codes else codes[-1]
-                        
-                        d["icd_code"] = best_code
-                        d["icd10_code"] = best_code
-                    d["icd10_code"] = d["icd_code"]
-                
-                print("✅ LLM ответила успешно!")
-                return result
+            async for event in stream_events(request, deadline, timings):
+                yield event
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="stream")
+
+
+async def streamed_llm_diagnosis(query_text_raw: str, unique_protocols: list, meta: ProtocolIndex | None = None):
+    """
+    budgeted_llm_diagnosis для стрима: по ходу генерации отдает ("diagnosis", диагноз) — каждый,
+    как только LLM его дописала, — и в конце ("result", ответ). Ошибка LLM поднимается как есть.
+    """
+    found = asyncio.Queue()
+    task = asyncio.ensure_future(budgeted_llm_diagnosis(query_text_raw, unique_protocols, meta, on_diagnosis=found.put_nowait))
+    try:
+        while not task.done():
+            getter = asyncio.ensure_future(found.get())
+            await asyncio.wait({task, getter}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                yield "diagnosis", getter.result()
+            else:
+                getter.cancel()
+        while not found.empty():
+            yield "diagnosis", found.get_nowait()
+        yield "result", task.result()
+    finally:
+        # Клиент ушел посреди генерации — вызов LLM больше не нужен
+        task.cancel()
+
+
+async def stream_events(request: Request, deadline, timings: list):
+    started = time.perf_counter()
+    async with index.lease() as generation:
+        text, vector, cached = await lookup_cached(request, generation)
+        if cached:
+            result, match, similarity, gate = cached
+            yield sse("diagnoses", result)
+            yield sse("done", {"fallback": False, "cache": match, "gate": gate, "generation": generation.name,
+                               "elapsed_ms": round((time.perf_counter() - started) * 1000)})
+            return
+
+        unique_protocols = []
+        meta = None
+        graph = None
+        fallback = False
+        gate = None
+        shed = None
+        admitted = False
+        try:
+            # Ответ уже начат, 503 не отправить: под перегрузкой стрим всегда отвечает из поиска
+            if admission is not None:
+                waiting = time.perf_counter()
+                try:
+                    await admission.acquire(request_priority(request), admission_wait())
+                    admitted, slot_started = True, time.perf_counter()
+                except Overloaded as e:
+                    print(f"🚧 Перегрузка (stream): {e}")
+                    shed = e.reason
+                record("admission_wait", time.perf_counter() - waiting)
+            query_text_raw = query_text(await request.json())
+            print(f"\n📥 Вход (stream): {query_text_raw[:100]}...")
+            graph = build_retrieval_graph(query_text_raw, generation, "local" if shed else NER_BACKEND).start()
+
+            res_raw = await graph.result("hits_raw")
+            meta = await graph.result("meta")
+            candidates = fallback_diagnoses(rank_protocols(query_text_raw, res_raw, [], meta=meta), limit=5, meta=meta)
+            yield sse("candidates", {"stage": "raw", "candidates": candidates})
+
+            unique_protocols = await run_within(graph.result("ranked"), DEADLINE_RESPONSE_RESERVE, stage="search")
+            if not unique_protocols:
+                raise ValueError("No protocols found.")
+            candidates = fallback_diagnoses(unique_protocols, limit=len(unique_protocols), meta=meta)
+            yield sse("candidates", {"stage": "ranked", "candidates": candidates})
+
+            gate = gate_decision(unique_protocols, gate_mode(request))
+            if gate["decisive"]:
+                result = retrieval_response(unique_protocols, meta)
+            elif shed:
+                result = fallback_response(unique_protocols, meta)
             else:
-                raise ValueError(f"LLM вернула битый JSON или неверный формат: {str(result)[:100]}")
-                
+                async for event, value in streamed_llm_diagnosis(query_text_raw, unique_protocols, meta):
+                    if event == "diagnosis":
+                        yield sse("diagnosis", value)
+                    else:
+                        result = value
         except Exception as e:
-            print(f"❌❌ ОШИБКА LLM: {str(e)}")
-            raise e # Уходим в Fallback
+            print(f"⚠️ Работает Fallback: {e}")
+            FALLBACKS.inc(endpoint="stream")
+            fallback = True
+            result = fallback_response(unique_protocols, meta)
+        finally:
+            # Слот — до любого await: при отключении клиента отмена в anyio повторяется на каждом await
+            if admitted:
+                admission.release(time.perf_counter() - slot_started)
+            if graph:
+                await graph.close()
 
-    except Exception as e:
-        print(f"⚠️ Работает Fallback: {e}")
-        fallback = []
-        # Fallback берет топ-3 из найденных протоколов
-        for i, p in enumerate(unique_protocols[:3] if 'unique_protocols' in locals() else []):
-            
-            # --- ТОТ ЖЕ УМНЫЙ ВЫБОР КОДА ДЛЯ ФОЛЛБЕКА ---
-            codes = p.payload.get('icd_codes', [])
-            best_code = "Unknown"
-            if codes:
-                specific_codes = [c for c in codes if '.' in c]
-                best_code = specific_codes[0] if specific_codes else codes[-1]
-
-            fallback.append({
-                "rank": i + 1,
-                "icd_code": best_code,
-                "icd10_code": best_code,
-                "name": p.payload['title'],
-                "explanation": f"Диагноз подобран на основе семантического поиска РК: {p.payload['title']}."
-            })
-            
-        # Если unique_protocols пустой (ошибка в поиске)
-        if not fallback:
-             fallback = [{"rank": 1, "icd_code": "Unknown", "name": "Error", "explanation": "System Failure"}]
-             
-        return {"diagnoses": fallback, "confidence": 0.5}
+        if shed:
+            result = {**result, "shed": shed}
+        yield sse("diagnoses", result)
+        if text and vector is not None and not fallback and not shed:
+            responses.put(text, vector, generation.name, result, gate_mode(request), gate)
+        yield sse("done", {"fallback": fallback, "cache": None, "gate": gate, "shed": shed, "generation": generation.name,
+                           "deadline": deadline.header(), "timing": server_timing(timings),
+                           "elapsed_ms": round((time.perf_counter() - started) * 1000)})
+
+
+@app.post("/diagnose/batch")
+async def diagnose_batch(request: Request, response: Response):
+    """
+    Пакетная диагностика: {"items": ["текст", {"symptoms": "..."}, ...]} или просто список.
+    Эмбеддинги всех текстов — одним вызовом энкодера, поиск — одним батч-запросом к хранилищу,
+    LLM-вызовы — с ограниченной параллельностью. Ответ в порядке входа; ошибка одного
+    элемента не валит весь батч.
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Ожидался JSON")
+    items = body.get("items") if isinstance(body, dict) else body
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail='Ожидался непустой список "items"')
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Не больше {BATCH_MAX_ITEMS} элементов в батче")
+
+    texts = [item if isinstance(item, str) and item.strip() else query_text(item) for item in items]
+    # Один бюджет на весь батч: элементы, на которые его не хватило, получают фоллбек
+    started = time.perf_counter()
+    with collect() as timings, scope(from_headers(request.headers, REQUEST_DEADLINE, REQUEST_DEADLINE_MAX)) as deadline:
+        try:
+            async with index.lease() as generation:
+                results = await until_disconnected(
+                    request, run_batch(texts, generation, use_cache=cache_enabled(request), mode=gate_mode(request)),
+                )
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="batch")
+        # Стадии элементов суммируются: при параллельной обработке сумма больше общего времени
+        response.headers["Server-Timing"] = server_timing(timings, time.perf_counter() - started)
+        return {"generation": generation.name, "deadline": deadline.header(), "results": results}
+
+
+async def run_batch(texts: list, generation, use_cache: bool = True, mode: str = "auto") -> list[dict]:
+    results: list[dict | None] = [None] * len(texts)
+    for i, text in enumerate(texts):
+        if not text:
+            results[i] = {"index": i, "status": "error", "error": "Нет текста симптомов"}
+    todo = [i for i, text in enumerate(texts) if text]
+    if not todo:
+        return results
+    print(f"\n📦 Батч: {len(texts)} элементов, к обработке {len(todo)}")
+
+    # 1. Сырые тексты: один вызов энкодера + один батч-поиск
+    with stage("encode_raw"):
+        raw_vectors = await inference.embed_many([f"query: {texts[i][:1000]}" for i in todo])
+    vectors = dict(zip(todo, raw_vectors))
+    if use_cache and responses is not None:
+        for i in todo:
+            cached = responses.get(texts[i], vectors[i], generation.name, mode)
+            if cached:
+                results[i] = {"index": i, "status": "ok", "cache": cached[1], "result": cached[0]}
+        todo = [i for i in todo if results[i] is None]
+        if not todo:
+            return results
+    with stage("search_raw"):
+        raw_hits = await search_vectors(generation.store, [vectors[i] for i in todo])
+    raw_hits = dict(zip(todo, raw_hits))
+    meta = await protocol_index(generation)
+
+    llm_slots = asyncio.Semaphore(BATCH_LLM_CONCURRENCY)
+
+    async def summarize(i):
+        if NER_BACKEND == "local":
+            return await clinical_summary(texts[i], generation, "local")
+        async with llm_slots:
+            return await clinical_summary(texts[i], generation, "llm")
+
+    # 2. NER по всем элементам (параллельно, но не больше BATCH_LLM_CONCURRENCY вызовов LLM сразу;
+    # локальный NER в слоты LLM не стоит)
+    summaries = await asyncio.gather(*[summarize(i) for i in todo])
+
+    # 3. Саммари: снова один вызов энкодера + один батч-поиск, затем бустинг и дедуп по каждому
+    with stage("encode_summary"):
+        med_vectors = await inference.embed_many([f"query: {s[:1000]}" for s in summaries])
+    with stage("search_summary"):
+        med_hits = await search_vectors(generation.store, med_vectors)
+    lex_hits = await asyncio.gather(*[search_lexical(generation, f"{texts[i]} {s}") for i, s in zip(todo, summaries)])
+    ranked = {
+        i: rank_protocols(texts[i], raw_hits[i], res_med, res_lex, meta)
+        for i, res_med, res_lex in zip(todo, med_hits, lex_hits)
+    }
+
+    # 4. LLM по каждому элементу; ошибка — фоллбек этого элемента, как в /diagnose
+    async def diagnose_item(i):
+        unique_protocols = ranked[i]
+        try:
+            if not unique_protocols:
+                raise ValueError("No protocols found.")
+            gate = gate_decision(unique_protocols, mode)
+            if gate["decisive"]:
+                result = retrieval_response(unique_protocols, meta)
+            else:
+                result = await budgeted_llm_diagnosis(texts[i], unique_protocols, meta, slots=llm_slots)
+            if use_cache and responses is not None:
+                responses.put(texts[i], vectors[i], generation.name, result, mode, gate)
+            return {"index": i, "status": "ok", "result": result}
+        except Exception as e:
+            print(f"⚠️ Батч [{i}]: Fallback: {e}")
+            FALLBACKS.inc(endpoint="batch")
+            return {"index": i, "status": "fallback", "error": str(e), "result": fallback_response(unique_protocols, meta)}
+
+    for item in await asyncio.gather(*[diagnose_item(i) for i in todo]):
+        results[item["index"]] = item
+    return results
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+
+# Метрики сервера в текстовом формате Prometheus (GET /metrics) без внешних зависимостей:
+# счетчики, гистограммы и gauge с функцией. Длительности стадий пайплайна дополнительно
+# собираются по запросу (contextvar, его видят и задачи графа стадий) — для заголовка Server-Timing.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Секунды: от быстрого поиска (мс) до LLM под лимитом хаба (десятки секунд)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+_registry = []
+_timings = contextvars.ContextVar("stage_timings", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: tuple = ()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self) -> list[str]:
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in sorted(self.values.items())
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]  # по корзинам, сумма, число
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            state[0][i] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, (('le', _number(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Gauge(Metric):
+    """Значение читается функцией в момент выгрузки; None — метрика не выводится."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, read):
+        super().__init__(name, documentation)
+        self.read = read
+
+    def render(self) -> list[str]:
+        value = self.read()
+        return [] if value is None else self.header() + [f"{self.name} {_number(value)}"]
+
+
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+# Метрики пайплайна (main.py) и вызовов хаба (providers.py)
+STAGE_SECONDS = Histogram("diagnose_stage_seconds", "Длительность стадий пайплайна диагностики", ("stage",))
+REQUEST_SECONDS = Histogram("diagnose_request_seconds", "Полное время обработки запроса", ("endpoint",))
+FALLBACKS = Counter("diagnose_fallbacks_total", "Ответы из поиска после ошибки LLM или нехватки бюджета", ("endpoint",))
+LLM_ATTEMPT_SECONDS = Histogram("llm_attempt_seconds", "Длительность одной попытки вызова хаба (для стрима — до открытия)", ("op", "outcome"))
+LLM_RATE_LIMITED = Counter("llm_rate_limited_total", "Ответы хаба 429")
+LLM_JSON_FAILURES = Counter("llm_json_parse_failures_total", "Ответы LLM, из которых не удалось достать диагнозы", ("kind",))
+LLM_TOKENS = Counter("llm_tokens_total", "Токены LLM по usage хаба (оборванный стрим — по оценке)", ("kind",))
+
+
+def record(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def timed(name: str):
+    """Декоратор: вся функция (обычная или async) — стадия name."""
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with stage(name):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with stage(name):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def collect():
+    """Собирает стадии текущего запроса: [(стадия, секунды), ...] в порядке завершения."""
+    timings = []
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def server_timing(timings: list, total: float | None = None) -> str:
+    """Заголовок Server-Timing; повторы стадии (батч, несколько поисков) суммируются."""
+    durations = {}
+    for name, seconds in timings:
+        durations[name] = durations.get(name, 0.0) + seconds
+    if total is not None:
+        durations["total"] = total
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in durations.items())
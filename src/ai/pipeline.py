@@ -0,0 +1,57 @@
+import asyncio
+import inspect
+import time
+
+
+class StageGraph:
+    """
+    Небольшой граф стадий пайплайна. Каждая стадия стартует сразу, как только
+    готовы ее зависимости, поэтому независимые ветки (поиск по сырому тексту
+    и NER-запрос к LLM) идут параллельно, а ждут друг друга только там, где нужно.
+    """
+
+    def __init__(self):
+        self._stages: dict[str, tuple] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        self.timings: dict[str, float] = {}
+
+    def add(self, name: str, fn, deps: tuple | list = ()):
+        """fn получает результаты deps позиционно; может быть обычной или async функцией."""
+        if name in self._stages:
+            raise ValueError(f"Стадия {name} уже есть в графе")
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"Стадия {name} зависит от неизвестной стадии {dep}")
+        self._stages[name] = (fn, tuple(deps))
+        return self
+
+    async def _run_stage(self, name: str):
+        fn, deps = self._stages[name]
+        args = [await self._tasks[dep] for dep in deps]
+        started = time.perf_counter()
+        try:
+            result = fn(*args)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        finally:
+            self.timings[name] = time.perf_counter() - started
+
+    def start(self):
+        """Запускает все стадии; порядок add() гарантирует, что зависимости уже созданы."""
+        for name in self._stages:
+            if name not in self._tasks:
+                self._tasks[name] = asyncio.create_task(self._run_stage(name), name=f"stage:{name}")
+        return self
+
+    async def result(self, name: str):
+        if not self._tasks:
+            self.start()
+        return await self._tasks[name]
+
+    async def close(self):
+        """Отменяет недоделанные стадии (например, если ответ уже готов) и гасит их ошибки."""
+        pending = [t for t in self._tasks.values() if not t.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
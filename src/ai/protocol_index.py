@@ -0,0 +1,298 @@
+import io
+import json
+import mmap
+import os
+import re
+from collections import deque
+from dataclasses import replace
+from typing import NamedTuple
+
+# Таблица протоколов, посчитанная один раз на поколение индекса: нормализованные коды МКБ,
+# предпочтительный (самый точный) код, тексты чанков для контекста LLM и автомат Ахо-Корасик
+# по всем кодам и названиям — запрос сканируется за один проход, бустинг и проверка кодов LLM
+# становятся поиском в множествах.
+# Точки векторного индекса несут только protocol_id и номер чанка; поиск идет без payload,
+# а название, коды и текст берутся отсюда по id точки. Раскладка каталога:
+# protocols.json (метаданные + id точек и смещения чанков) и chunks.bin (тексты подряд в UTF-8, читаются через mmap).
+
+# Кириллица, похожая на латиницу в кодах МКБ ("О" вместо "O" и т.п.), как в ingest.py
+CYRILLIC_TO_LATIN = str.maketrans("ОАВСКМЕ", "OABCKME")
+MIN_CODE_LENGTH = 3
+MIN_TITLE_LENGTH = 5
+# Столько символов чанка уходит в контекст LLM (build_context в main.py)
+CONTEXT_CHARS = 1500
+PROTOCOLS_FILE = "protocols.json"
+CHUNKS_FILE = "chunks.bin"
+
+
+def normalize_code(code) -> str:
+    return str(code).strip().upper().translate(CYRILLIC_TO_LATIN)
+
+
+# Диапазон рубрик в кодах протокола: "K80-K87", "A00–A09"
+RE_CODE_RANGE = re.compile(r"^([A-Z]\d{2})(?:\.\d+)?\s*[-–—]\s*([A-Z]\d{2})(?:\.\d+)?$")
+
+
+def code_covered(code: str, codes) -> bool:
+    """
+    Покрывает ли какой-то из кодов протокола код LLM: точное совпадение, уточнение родителя
+    (K35 покрывает K35.8, I21.0 — I21.01) или рубрика внутри диапазона (K80-K87 покрывает K81.0).
+    """
+    code = normalize_code(code)
+    for allowed in codes:
+        allowed = normalize_code(allowed)
+        if code == allowed:
+            return True
+        if allowed and code.startswith(allowed) and (code[len(allowed)] == "." or "." in allowed):
+            return True
+        found = RE_CODE_RANGE.match(allowed)
+        if found and found.group(1) <= code[:3] <= found.group(2):
+            return True
+    return False
+
+
+def normalize_text(text: str) -> str:
+    """Тот же вид, что у шаблонов автомата: верхний регистр, ё -> е, латиница в кодах."""
+    return " ".join(text.upper().replace("Ё", "Е").translate(CYRILLIC_TO_LATIN).split())
+
+
+def best_icd_code(codes: list) -> str:
+    """Самый точный код протокола: первый с точкой, иначе последний."""
+    best_code = "Unknown"
+    if codes:
+        # Ищем код с точкой (он точнее)
+        specific_codes = [c for c in codes if '.' in c]
+        best_code = specific_codes[0] if specific_codes else codes[-1]
+    return best_code
+
+
+class ChunkRef(NamedTuple):
+    point_id: int | str
+    offset: int  # байтовое смещение текста в chunks.bin
+    length: int
+    section: str
+
+
+class ProtocolMeta(NamedTuple):
+    title: str
+    codes: tuple
+    best_code: str
+    chunks: tuple = ()  # ChunkRef в порядке номеров чанков
+
+
+class QueryMatch(NamedTuple):
+    codes: set  # коды МКБ, найденные в тексте
+    code_hits: dict  # protocol_id -> сколько его кодов в тексте
+    title_hits: set  # protocol_id, чье название целиком есть в тексте
+
+
+class AhoCorasick:
+    """Автомат по словарю шаблонов: все вхождения всех шаблонов за один проход по тексту."""
+
+    def __init__(self, patterns: dict[str, object]):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for pattern, value in patterns.items():
+            state = 0
+            for ch in pattern:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = nxt
+            self.out[state].append((pattern, value))
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find(self, text: str):
+        """(позиция конца, шаблон, значение) для каждого вхождения."""
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            for pattern, value in self.out[state]:
+                yield i + 1, pattern, value
+
+
+class ProtocolIndex:
+    def __init__(self, protocols: dict[str, ProtocolMeta], blob=b""):
+        self.protocols = protocols
+        self.blob = blob  # bytes или mmap с текстами чанков
+        self.points = {}  # id точки -> (protocol_id, номер чанка)
+        patterns = {}
+        for pid, meta in protocols.items():
+            for n, chunk in enumerate(meta.chunks):
+                self.points[chunk.point_id] = (pid, n)
+            for code in meta.codes:
+                if len(code) >= MIN_CODE_LENGTH:
+                    patterns.setdefault(code, ("code", set()))[1].add(pid)
+            title = normalize_text(meta.title)
+            if len(title) >= MIN_TITLE_LENGTH:
+                patterns.setdefault(title, ("title", set()))[1].add(pid)
+        self.automaton = AhoCorasick(patterns)
+
+    @classmethod
+    def build(cls, points) -> "ProtocolIndex":
+        """По точкам старого формата (payload с title, icd_codes, section, content) — таблица в памяти."""
+        writer = ProtocolTableWriter()
+        for point in points:
+            writer.add(point.id, point.payload)
+        return writer.close()
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return bool(path) and os.path.exists(os.path.join(path, PROTOCOLS_FILE))
+
+    @classmethod
+    def load(cls, path: str) -> "ProtocolIndex":
+        with open(os.path.join(path, PROTOCOLS_FILE), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        protocols = {
+            pid: ProtocolMeta(m["title"], tuple(m["codes"]), m["best_code"], tuple(ChunkRef(*c) for c in m["chunks"]))
+            for pid, m in data.items()
+        }
+        blob = b""
+        with open(os.path.join(path, CHUNKS_FILE), "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                # Тексты не читаются в память целиком: страницы подтягивает ОС по мере обращения
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(protocols, blob)
+
+    def warm(self) -> int:
+        """Подтягивает страницы mmap с текстами чанков, чтобы первые запросы не ждали диск; возвращает байты."""
+        if isinstance(self.blob, mmap.mmap):
+            for offset in range(0, len(self.blob), mmap.PAGESIZE):
+                self.blob[offset]
+        return len(self.blob)
+
+    def scan(self, text: str) -> QueryMatch:
+        """Один проход автомата по запросу. Коды — как подстроки (K35 находится и в K35.8), названия — целыми словами."""
+        text = normalize_text(text)
+        codes, code_hits, title_hits = set(), {}, set()
+        for end, pattern, (kind, pids) in self.automaton.find(text):
+            if kind == "code":
+                if pattern not in codes:
+                    codes.add(pattern)
+                    for pid in pids:
+                        code_hits[pid] = code_hits.get(pid, 0) + 1
+            else:
+                start = end - len(pattern)
+                if (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum()):
+                    title_hits.update(pids)
+        return QueryMatch(codes, code_hits, title_hits)
+
+    def best_code(self, protocol_id, default: list | None = None) -> str:
+        meta = self.protocols.get(protocol_id)
+        if meta:
+            return meta.best_code
+        return best_icd_code([normalize_code(c) for c in default or []])
+
+    def codes(self, protocol_id) -> tuple:
+        meta = self.protocols.get(protocol_id)
+        return meta.codes if meta else ()
+
+    def protocol_of(self, point) -> str | None:
+        """protocol_id точки: по таблице, для точек не из нее — по payload, если он есть."""
+        found = self.points.get(point.id)
+        if found:
+            return found[0]
+        return (point.payload or {}).get("protocol_id")
+
+    def chunk_text(self, chunk: ChunkRef) -> str:
+        return self.blob[chunk.offset:chunk.offset + chunk.length].decode("utf-8")
+
+    def payload(self, point_id) -> dict | None:
+        """payload в старом виде (protocol_id, title, icd_codes, section, content) — для контекста и ответа."""
+        found = self.points.get(point_id)
+        if found is None:
+            return None
+        pid, n = found
+        meta = self.protocols[pid]
+        chunk = meta.chunks[n]
+        return {
+            "protocol_id": pid,
+            "chunk": n,
+            "title": meta.title,
+            "icd_codes": list(meta.codes),
+            "section": chunk.section,
+            "content": self.chunk_text(chunk),
+        }
+
+    def resolve(self, hits: list) -> list:
+        """Те же hits с полным payload из таблицы (поиск идет с with_payload=False)."""
+        return [replace(hit, payload=self.payload(hit.id) or hit.payload) for hit in hits]
+
+    def iter_points(self):
+        """(id точки, полный payload) по всем чанкам — для словаря терминов и BM25 при сборке поколения."""
+        for meta in self.protocols.values():
+            for chunk in meta.chunks:
+                yield PointPayload(chunk.point_id, self.payload(chunk.point_id))
+
+    def iter_payloads(self):
+        return (point.payload for point in self.iter_points())
+
+    def stats(self) -> dict:
+        return {"protocols": len(self.protocols), "chunks": len(self.points), "automaton_states": len(self.automaton.goto)}
+
+
+class PointPayload(NamedTuple):
+    id: int | str
+    payload: dict
+
+
+class ProtocolTableWriter:
+    """
+    Сборка таблицы по чанкам: тексты сразу пишутся в chunks.bin (или в память при path=None),
+    в памяти держатся только метаданные протоколов и смещения.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self.blob = open(os.path.join(path, CHUNKS_FILE + ".tmp"), "wb")
+        else:
+            self.blob = io.BytesIO()
+        self.offset = 0
+        self.protocols = {}
+
+    def add(self, point_id, payload: dict):
+        """Чанк протокола в порядке номеров; title и icd_codes у всех чанков протокола одинаковые, берем первый."""
+        pid = payload.get("protocol_id")
+        meta = self.protocols.get(pid)
+        if meta is None:
+            codes = tuple(dict.fromkeys(normalize_code(c) for c in payload.get("icd_codes", []) if str(c).strip()))
+            meta = self.protocols[pid] = ProtocolMeta(payload.get("title", ""), codes, best_icd_code(list(codes)), [])
+        data = payload.get("content", "")[:CONTEXT_CHARS].encode("utf-8")
+        self.blob.write(data)
+        meta.chunks.append(ChunkRef(point_id, self.offset, len(data), payload.get("section", "")))
+        self.offset += len(data)
+
+    def close(self) -> ProtocolIndex:
+        protocols = {pid: meta._replace(chunks=tuple(meta.chunks)) for pid, meta in self.protocols.items()}
+        if not self.path:
+            return ProtocolIndex(protocols, self.blob.getvalue())
+        self.blob.close()
+        tmp_path = os.path.join(self.path, PROTOCOLS_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {pid: {**meta._asdict(), "chunks": [list(c) for c in meta.chunks]} for pid, meta in protocols.items()},
+                f, ensure_ascii=False,
+            )
+        os.replace(os.path.join(self.path, CHUNKS_FILE + ".tmp"), os.path.join(self.path, CHUNKS_FILE))
+        os.replace(tmp_path, os.path.join(self.path, PROTOCOLS_FILE))
+        return ProtocolIndex.load(self.path)
@@ -1,30 +1,168 @@
+import asyncio
 import json
-from openai import AsyncOpenAI
+import re
+import time
+from contextlib import aclosing
+from openai import AsyncOpenAI, RateLimitError
+from .config import (
+    LLM_RPM, LLM_TPM, LLM_EXPECTED_COMPLETION_TOKENS, LLM_DEFAULT_RETRY_AFTER,
+    LLM_STREAM, LLM_STREAM_DIAGNOSES, LLM_BATCH_MAX_CASES,
+    LLM_TIMEOUT, LLM_MAX_ATTEMPTS, LLM_BACKOFF_BASE, LLM_BACKOFF_MAX,
+    LLM_HEDGE, LLM_HEDGE_QUANTILE, LLM_HEDGE_MIN_DELAY, LLM_BREAKER_FAILURES, LLM_BREAKER_RESET,
+)
+from .rate_limiter import get_limiter, estimate_tokens
+from .llm_resilience import CircuitBreaker, CircuitOpenError, ResilientCaller, retry_after_seconds, status_code
+from .metrics import LLM_ATTEMPT_SECONDS, LLM_JSON_FAILURES, LLM_RATE_LIMITED, LLM_TOKENS
+from .json_stream import DiagnosesParser
+
+# Чем может кончаться JSON ответа после последнего нужного диагноза — это не хвост генерации
+JSON_TAIL = " \t\r\n]}"
+
+# Системный промпт один для одиночного и пакетного режима
+SYSTEM_PROMPT = """
+            Ты — эксперт по кодированию МКБ-10. Твоя главная задача: выдать правильный код.
+
+        ПРАВИЛА:
+        1. В поле "icd_code" пиши ТОЛЬКО код (например, G91.1). 
+        2. Обязательно бери код из предоставленного контекста протоколов. Если в протоколе "ГИДРОЦЕФАЛИЯ" указан код G91.1 — пиши его!
+        3. Никогда не оставляй "icd_code" пустым или null.
+        """
+
 
 class GPTOSSProvider:
-    def __init__(self, api_key: str, base_url: str):
+    def __init__(self, api_key: str, base_url: str, rpm: int = LLM_RPM, tpm: int = LLM_TPM):
+        # Повторы делает ResilientCaller (свои в SDK выключены), таймаут — на одну попытку
         self.client = AsyncOpenAI(
             base_url=base_url,
-            api_key=api_key
+            api_key=api_key,
+            timeout=LLM_TIMEOUT,
+            max_retries=0,
         )
         self.model = "oss-120b"
-        
+        # Лимитер общий на процесс: все провайдеры одного хаба делят один бюджет
+        self.limiter = get_limiter(base_url, rpm, tpm)
+        self.resilience = ResilientCaller(
+            max_attempts=LLM_MAX_ATTEMPTS,
+            base_delay=LLM_BACKOFF_BASE,
+            max_delay=LLM_BACKOFF_MAX,
+            hedge=LLM_HEDGE,
+            hedge_quantile=LLM_HEDGE_QUANTILE,
+            hedge_min_delay=LLM_HEDGE_MIN_DELAY,
+            breaker=CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET),
+        )
+        # Счетчики стрима: сколько раз оборвали генерацию и сколько на этом сэкономили (оценка)
+        self.streams = 0
+        self.cut_short = 0
+        self.tokens_saved = 0
+        self.seconds_saved = 0.0
+        # Средняя длина полного ответа (в чанках стрима) — по ответам, которые дошли до конца
+        self.avg_full_tokens = float(LLM_EXPECTED_COMPLETION_TOKENS)
+        # Пакетный режим: пока лимитер держит, дела копятся и уходят одним промптом
+        self.batcher = DiagnosisBatcher(self, LLM_BATCH_MAX_CASES) if LLM_BATCH_MAX_CASES > 1 else None
+
+    async def _acquire(self, messages: list[dict], reserved: list) -> int:
+        """Бюджет одной попытки: первая может прийти уже с занятым (reserved), повторы и хедж ждут свой."""
+        if reserved:
+            return reserved.pop()
+        estimated = estimate_tokens(messages, LLM_EXPECTED_COMPLETION_TOKENS)
+        await self.limiter.acquire(estimated)
+        return estimated
 
-    async def get_diagnosis(self, symptoms: str, context: str = None):
+    async def chat(self, messages: list[dict], reserved_tokens: int | None = None, **kwargs):
         """
-        symptoms: текст от пользователя
-        context: найденные куски протоколов (пока можем тестить без них)
+        Единая точка вызова хаба через ResilientCaller (повторы, хедж, предохранитель).
+        Каждая попытка ждет бюджет в лимитере (только если он выбран), после ответа TPM правится
+        по реальному usage, на 429 лимитер блокируется на Retry-After.
+        reserved_tokens — бюджет первой попытки уже занят вызывающим (DiagnosisBatcher), повторно не ждем.
+        Хедж не запускается, пока лимитер держит: лишний запрос в выбранный лимит только продлит 429.
         """
-        
-        system_prompt = """
-            Ты — эксперт по кодированию МКБ-10. Твоя главная задача: выдать правильный код.
+        reserved = [] if reserved_tokens is None else [reserved_tokens]
 
-        ПРАВИЛА:
-        1. В поле "icd_code" пиши ТОЛЬКО код (например, G91.1). 
-        2. Обязательно бери код из предоставленного контекста протоколов. Если в протоколе "ГИДРОЦЕФАЛИЯ" указан код G91.1 — пиши его!
-        3. Никогда не оставляй "icd_code" пустым или null.
+        async def attempt():
+            estimated = await self._acquire(messages, reserved)
+            started = time.perf_counter()
+            try:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    **kwargs
+                )
+            except Exception as e:
+                _observe_attempt("chat", started, e)
+                if isinstance(e, RateLimitError):
+                    self.limiter.penalize(_retry_after(e))
+                raise
+            _observe_attempt("chat", started)
+            usage = getattr(response, "usage", None)
+            _count_tokens(getattr(usage, "prompt_tokens", 0), getattr(usage, "completion_tokens", 0))
+            self.limiter.settle(estimated, getattr(usage, "total_tokens", 0) or 0)
+            return response
+
+        return await self.resilience.call(attempt, can_hedge=self.limiter.ready)
+
+    async def chat_stream(self, messages: list[dict], reserved_tokens: int | None = None, **kwargs):
+        """
+        То же, что chat(), но со stream=True: отдает куски текста по мере генерации.
+        Если потребитель закрыл генератор (aclose), HTTP-стрим закрывается и хаб перестает генерировать.
+        Повторяется и хеджируется только открытие стрима (до первого байта); обрыв посреди генерации
+        уходит вызывающему. Стрим проигравшей попытки закрывается.
         """
+        reserved = [] if reserved_tokens is None else [reserved_tokens]
+
+        async def attempt():
+            estimated = await self._acquire(messages, reserved)
+            started = time.perf_counter()
+            try:
+                stream = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    stream=True,
+                    # Без этого хаб не присылает usage в стриме и лимитер/метрики живут на оценке
+                    stream_options={"include_usage": True},
+                    **kwargs
+                )
+            except Exception as e:
+                _observe_attempt("stream", started, e)
+                if isinstance(e, RateLimitError):
+                    self.limiter.penalize(_retry_after(e))
+                raise
+            _observe_attempt("stream", started)
+            return stream, estimated
+
+        stream, estimated = await self.resilience.call(
+            attempt, can_hedge=self.limiter.ready, discard=lambda opened: asyncio.ensure_future(opened[0].close()),
+        )
+        used, received, usage = 0, 0, None
+        try:
+            async for chunk in stream:
+                usage = getattr(chunk, "usage", None) or usage
+                if usage:
+                    used = usage.total_tokens
+                if chunk.choices and chunk.choices[0].delta.content:
+                    received += 1
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+            # usage приходит последним чанком (без choices); оборванный стрим его не получает —
+            # тогда считаем промпт + полученные чанки
+            self.limiter.settle(estimated, used or estimate_tokens(messages) + received)
+            if usage:
+                _count_tokens(usage.prompt_tokens, usage.completion_tokens)
+            else:
+                _count_tokens(estimate_tokens(messages), received)
 
+    async def get_diagnosis(self, symptoms: str, context: str = None, on_diagnosis=None):
+        """
+        symptoms: текст от пользователя
+        context: найденные куски протоколов (пока можем тестить без них)
+        on_diagnosis: вызывается с каждым диагнозом, как только он разобран из стрима
+        (без LLM_STREAM и в микробатче не вызывается — есть только итоговый ответ)
+        """
+        if self.batcher:
+            return await self.batcher.submit(symptoms, context)
+        return await self.diagnose_messages(self.case_messages(symptoms, context), on_diagnosis=on_diagnosis)
+
+    def case_messages(self, symptoms: str, context: str = None) -> list[dict]:
         user_content = f"Симптомы пациента: {symptoms}\n\n"
         if context:
             user_content += f"Используй этот контекст из протоколов РК для точности:\n{context}"
@@ -33,50 +171,288 @@ class GPTOSSProvider:
 
         user_content += (
             "\n\nВерни JSON объект с полями:\n"
-            "- diagnoses: список из 3 объектов (rank, icd_code, name, explanation)\n"
-            "- confidence: число от 0 до 1 (твоя уверенность)"
+            "- confidence: число от 0 до 1 (твоя уверенность), ПЕРВЫМ полем\n"
+            "- diagnoses: список из 3 объектов (rank, icd_code, name, explanation)"
         )
 
         user_content += (
             "Ответь в формате:\n"
             "{\n"
+            "  \"confidence\": 0.8,\n"
             "  \"diagnoses\": [\n"
             "    {\"rank\": 1, \"icd_code\": \"код\", \"name\": \"название\", \"explanation\": \"почему подходит\"}\n"
             "  ]\n"
             "}"
         )
 
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_content}
+        ]
+
+    def multi_case_messages(self, cases: list[tuple[str, str, str]]) -> list[dict]:
+        """cases: (case_id, symptoms, context). Один промпт на несколько пациентов, ответ — массив по case_id."""
+        parts = [f"Ниже {len(cases)} независимых пациентов. Разбери КАЖДОГО отдельно, не смешивая контексты.\n"]
+        for case_id, symptoms, context in cases:
+            parts.append(
+                f"### СЛУЧАЙ {case_id}\n"
+                f"Симптомы пациента: {symptoms}\n"
+                f"Контекст из протоколов РК для этого случая:\n{context or 'нет'}\n"
+            )
+        parts.append(
+            "Верни ОДИН JSON объект, в \"cases\" — по объекту на каждый случай:\n"
+            "{\n"
+            "  \"cases\": [\n"
+            "    {\"case_id\": \"id случая\", \"confidence\": 0.8, \"diagnoses\": [\n"
+            "      {\"rank\": 1, \"icd_code\": \"код\", \"name\": \"название\", \"explanation\": \"почему подходит\"}\n"
+            "    ]}\n"
+            "  ]\n"
+            "}\n"
+            "В diagnoses каждого случая — 3 объекта."
+        )
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": "\n".join(parts)}
+        ]
+
+    async def diagnose_messages(self, messages: list[dict], reserved_tokens: int | None = None, on_diagnosis=None):
         try:
-            # Если у тебя логика пула ключей, тут должно быть self.client (или diag_client)
-            # Я оставляю твой вызов, как он был
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_content}
-                ],
+            if LLM_STREAM:
+                return await self._stream_diagnosis(messages, reserved_tokens, on_diagnosis)
+
+            response = await self.chat(
+                messages=messages,
+                reserved_tokens=reserved_tokens,
                 temperature=0.1, # Низкая температура для стабильности
                 # УБРАЛИ response_format, так как он иногда ломает выдачу
             )
             
             content = response.choices[0].message.content
-            
-            # --- ТОЧЕЧНЫЙ ФИКС ПАРСИНГА ---
-            import re
-            # Ищем кусок текста, который начинается на { и заканчивается на }
-            match = re.search(r'\{[\s\S]*\}', content)
-            
-            if match:
-                json_str = match.group(0)
-                return json.loads(json_str)
-            else:
-                # Если регулярка не нашла скобки, пробуем твой старый метод как запасной
-                json_str = content.strip()
-                if "```json" in json_str:
-                    json_str = json_str.split("```json")[1].split("```")[0].strip()
-                return json.loads(json_str)
+            return _parse_content(content)
         
+        except CircuitOpenError as e:
+            # Хаб лежит: без ожидания таймаутов, main.py сразу уходит в ответ из поиска
+            print(f"🔌 {e}")
+            return {"error": f"Ошибка LLM: {e}", "circuit_open": True}
         except Exception as e:
+            if isinstance(e, json.JSONDecodeError):
+                LLM_JSON_FAILURES.inc(kind="decode")
             # Возвращаем СТРОКУ или СЛОВАРЬ с ошибкой, чтобы main.py мог это поймать
             print(f"❌ Ошибка LLM API: {str(e)}")
-            return {"error": f"Ошибка LLM: {str(e)}", "raw_response": content if 'content' in locals() else None}
\ No newline at end of file
+            return {"error": f"Ошибка LLM: {str(e)}", "raw_response": content if 'content' in locals() else None}
+
+    async def _stream_diagnosis(self, messages: list[dict], reserved_tokens: int | None = None, on_diagnosis=None) -> dict:
+        """
+        Стрим ответа с инкрементальным парсером: как только в "diagnoses" набралось
+        LLM_STREAM_DIAGNOSES объектов, закрываем стрим — хвост (болтовню после JSON) не ждем и не оплачиваем.
+        Каждый законченный объект диагноза сразу уходит в on_diagnosis.
+        """
+        parser = DiagnosesParser(LLM_STREAM_DIAGNOSES)
+        parts = []
+        received = 0
+        forwarded = 0
+        started = time.perf_counter()
+        first_token_at = None
+        stopped_early = False
+        async with aclosing(self.chat_stream(messages=messages, reserved_tokens=reserved_tokens, temperature=0.1)) as stream:
+            async for text in stream:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                parts.append(text)
+                received += 1
+                done = parser.feed(text)
+                while on_diagnosis is not None and forwarded < len(parser.diagnoses):
+                    on_diagnosis(parser.diagnoses[forwarded])
+                    forwarded += 1
+                if done:
+                    break
+            if parser.done:
+                # Остаток после нужных диагнозов может быть просто концом JSON ("]}"): обрывом считаем,
+                # только если после него хаб прислал что-то еще, иначе ответ кончился сам
+                tail = parser.buffer[parser.end:]
+                while not stopped_early and not tail.strip(JSON_TAIL):
+                    extra = await anext(stream, None)
+                    if extra is None:
+                        break
+                    received += 1
+                    tail += extra
+                    stopped_early = bool(tail.strip(JSON_TAIL))
+        elapsed = time.perf_counter() - started
+        self.streams += 1
+
+        if stopped_early:
+            # Сколько бы еще генерировала модель: средняя длина полного ответа минус полученное,
+            # по скорости генерации этого же ответа
+            self.cut_short += 1
+            saved_tokens = max(0, round(self.avg_full_tokens) - received)
+            generating = elapsed - (first_token_at - started) if first_token_at else 0
+            saved_seconds = saved_tokens * generating / received if received and generating > 0 else 0.0
+            self.tokens_saved += saved_tokens
+            self.seconds_saved += saved_seconds
+            print(
+                f"✂️ Генерация оборвана ({'JSON закрыт' if parser.complete else f'{len(parser.diagnoses)} диагноза'}): "
+                f"~{received} токенов за {elapsed:.1f} с, "
+                f"сэкономлено ~{saved_tokens} токенов / ~{saved_seconds:.1f} с"
+            )
+        else:
+            # Стрим дошел до конца сам — учим среднюю длину полного ответа
+            self.avg_full_tokens = 0.8 * self.avg_full_tokens + 0.2 * received
+
+        result = parser.result()
+        return result if result is not None else _parse_content("".join(parts))
+
+    def stats(self) -> dict:
+        return {
+            "stream": LLM_STREAM,
+            "streams": self.streams,
+            "cut_short": self.cut_short,
+            "tokens_saved_est": self.tokens_saved,
+            "seconds_saved_est": round(self.seconds_saved, 2),
+            "avg_full_tokens": round(self.avg_full_tokens, 1),
+            "limiter_waited_calls": self.limiter.waited_calls,
+            "limiter_total_wait": round(self.limiter.total_wait, 2),
+            "resilience": self.resilience.stats(),
+            "batching": self.batcher.stats() if self.batcher else None,
+        }
+
+
+class DiagnosisBatcher:
+    """
+    Пакетный режим get_diagnosis под давлением лимита хаба.
+    Пока лимитер не пускает, дела копятся в очереди; как только бюджет есть — до max_cases
+    ожидающих уходят одним multi-case промптом (один запрос вместо N), ответ раскладывается
+    по case_id. Если лимитер свободен, дело уходит сразу обычным одиночным промптом —
+    задержки на склейку нет. Случай, который не удалось разобрать, получает {"error": ...},
+    и main.py уходит для него в обычный фоллбек.
+    """
+
+    def __init__(self, provider: GPTOSSProvider, max_cases: int = 4):
+        self.provider = provider
+        self.max_cases = max_cases
+        self._pending: list[tuple[str, str, asyncio.Future]] = []
+        self._worker = None
+        self._tasks = set()
+        self.requests = 0
+        self.multi_case_requests = 0
+        self.cases = 0
+        self.cases_failed = 0
+
+    async def submit(self, symptoms: str, context: str = None) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((symptoms, context, future))
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        try:
+            while self._pending:
+                # Пока ждем бюджет, в _pending доезжают новые дела
+                await self.provider.limiter.wait_ready()
+                batch = [c for c in self._pending[:self.max_cases] if not c[2].done()]
+                self._pending = self._pending[self.max_cases:]
+                if not batch:
+                    continue
+                if len(batch) == 1:
+                    symptoms, context, future = batch[0]
+                    messages = self.provider.case_messages(symptoms, context)
+                    reserved = estimate_tokens(messages, LLM_EXPECTED_COMPLETION_TOKENS)
+                    job = self._single(messages, reserved, future)
+                else:
+                    cases = [(str(n), symptoms, context) for n, (symptoms, context, _) in enumerate(batch, 1)]
+                    messages = self.provider.multi_case_messages(cases)
+                    reserved = estimate_tokens(messages, LLM_EXPECTED_COMPLETION_TOKENS * len(batch))
+                    job = self._multi(messages, reserved, batch)
+                # Бюджет занимаем здесь, до следующего круга: иначе wait_ready пустит следующий пакет в тот же слот
+                await self.provider.limiter.acquire(reserved)
+                self.requests += 1
+                self.cases += len(batch)
+                task = asyncio.create_task(job)
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            self._worker = None
+
+    async def _single(self, messages: list[dict], reserved: int, future: asyncio.Future):
+        result = await self.provider.diagnose_messages(messages, reserved)
+        if not future.done():
+            future.set_result(result)
+
+    async def _multi(self, messages: list[dict], reserved: int, batch: list):
+        self.multi_case_requests += 1
+        print(f"📦 LLM: {len(batch)} пациентов одним запросом")
+        try:
+            response = await self.provider.chat(messages=messages, reserved_tokens=reserved, temperature=0.1)
+            by_id = _parse_cases(response.choices[0].message.content)
+            error = None
+        except Exception as e:
+            if isinstance(e, json.JSONDecodeError):
+                LLM_JSON_FAILURES.inc(kind="decode")
+            print(f"❌ Ошибка пакетного запроса LLM: {e}")
+            by_id, error = {}, f"Ошибка LLM: {e}"
+        for n, (_, _, future) in enumerate(batch, 1):
+            case = by_id.get(str(n))
+            if isinstance(case, dict) and case.get("diagnoses"):
+                result = {k: v for k, v in case.items() if k != "case_id"}
+            else:
+                self.cases_failed += 1
+                result = {"error": error or f"Случай {n} не найден в пакетном ответе LLM"}
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "max_cases": self.max_cases,
+            "pending": len(self._pending),
+            "requests": self.requests,
+            "multi_case_requests": self.multi_case_requests,
+            "cases": self.cases,
+            "cases_failed": self.cases_failed,
+            "cases_per_request": round(self.cases / self.requests, 2) if self.requests else 0.0,
+        }
+
+
+def _parse_content(content: str) -> dict:
+    # --- ТОЧЕЧНЫЙ ФИКС ПАРСИНГА ---
+    # Ищем кусок текста, который начинается на { и заканчивается на }
+    match = re.search(r'\{[\s\S]*\}', content)
+
+    if match:
+        json_str = match.group(0)
+        return json.loads(json_str)
+    else:
+        # Если регулярка не нашла скобки, пробуем твой старый метод как запасной
+        json_str = content.strip()
+        if "```json" in json_str:
+            json_str = json_str.split("```json")[1].split("```")[0].strip()
+        return json.loads(json_str)
+
+
+def _parse_cases(content: str) -> dict:
+    """Ответ multi-case промпта -> {case_id: объект случая}. Принимает и {"cases": [...]}, и голый массив."""
+    try:
+        data = _parse_content(content)
+        cases = data.get("cases", []) if isinstance(data, dict) else data
+    except (json.JSONDecodeError, IndexError):
+        match = re.search(r'\[[\s\S]*\]', content)
+        cases = json.loads(match.group(0)) if match else []
+    return {str(c.get("case_id")): c for c in cases if isinstance(c, dict)}
+
+
+def _observe_attempt(op: str, started: float, error: Exception | None = None):
+    """Длительность попытки в llm_attempt_seconds; outcome — ok, HTTP-статус или класс ошибки."""
+    outcome = "ok" if error is None else str(status_code(error) or type(error).__name__)
+    LLM_ATTEMPT_SECONDS.observe(time.perf_counter() - started, op=op, outcome=outcome)
+    if outcome == "429":
+        LLM_RATE_LIMITED.inc()
+
+
+def _count_tokens(prompt: int | None, completion: int | None):
+    LLM_TOKENS.inc(prompt or 0, kind="prompt")
+    LLM_TOKENS.inc(completion or 0, kind="completion")
+
+
+def _retry_after(error: RateLimitError) -> float:
+    """Сколько секунд просит подождать хаб (заголовок Retry-After), иначе дефолт."""
+    seconds = retry_after_seconds(error)
+    return LLM_DEFAULT_RETRY_AFTER if seconds is None else seconds
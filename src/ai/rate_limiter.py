@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Ведро токенов: capacity единиц, пополняется со скоростью refill_per_sec."""
+
+    def __init__(self, capacity: float, refill_per_sec: float):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.refill_per_sec)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # Запрос больше всего ведра ждет только полного ведра, а не вечность
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_per_sec
+
+    def consume(self, amount: float):
+        self.level -= amount  # может уйти в минус — это "долг", который отдадим ожиданием
+
+
+class RateLimiter:
+    """
+    Общий на процесс лимитер запросов к LLM-хабу (RPM + TPM).
+    Вызывающие встают в честную FIFO-очередь и ждут только тогда,
+    когда бюджет минуты действительно выбран. Если хаб свободен — задержки нет.
+    """
+
+    def __init__(self, rpm: int, tpm: int = 0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm, rpm / 60) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm, tpm / 60) if tpm > 0 else None
+        self._lock = asyncio.Lock()  # asyncio.Lock будит ожидающих по порядку (FIFO)
+        self._blocked_until = 0.0
+        self.total_wait = 0.0
+        self.waited_calls = 0
+
+    def _delay(self, tokens: int) -> float:
+        now = time.monotonic()
+        delay = self._blocked_until - now
+        if self.requests:
+            delay = max(delay, self.requests.wait_time(1, now))
+        if self.tokens:
+            delay = max(delay, self.tokens.wait_time(tokens, now))
+        return delay
+
+    async def acquire(self, tokens: int = 0):
+        """Занимает один запрос и оценку токенов из бюджета, при необходимости ждет."""
+        async with self._lock:
+            started = time.monotonic()
+            while (delay := self._delay(tokens)) > 0:
+                await asyncio.sleep(delay)
+            waited = time.monotonic() - started
+            if waited > 0.001:
+                self.total_wait += waited
+                self.waited_calls += 1
+            if self.requests:
+                self.requests.consume(1)
+            if self.tokens:
+                self.tokens.consume(tokens)
+
+    async def wait_ready(self, tokens: int = 0):
+        """Ждет, пока бюджет позволит вызов, ничего не занимая (пока ждем — вызывающий копит работу)."""
+        async with self._lock:
+            while (delay := self._delay(tokens)) > 0:
+                await asyncio.sleep(delay)
+
+    def ready(self, tokens: int = 0) -> bool:
+        """Бюджет есть прямо сейчас и в очереди никто не ждет (ничего не занимает)."""
+        return not self._lock.locked() and self._delay(tokens) <= 0
+
+    def settle(self, estimated: int, actual: int):
+        """Поправляет бюджет TPM на разницу между оценкой и реальным usage из ответа."""
+        if self.tokens and actual:
+            self.tokens.consume(actual - estimated)
+
+    def penalize(self, retry_after: float):
+        """Хаб ответил 429: никого не пускаем, пока не пройдет Retry-After."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        if self.requests:
+            self.requests.level = min(self.requests.level, 0)
+
+
+_limiters: dict[str, RateLimiter] = {}
+
+
+def get_limiter(key: str, rpm: int, tpm: int = 0) -> RateLimiter:
+    """
+    Один лимитер на хаб (base_url) на весь процесс — все провайдеры делят бюджет.
+    Лимиты задает первый вызов: бюджет у хаба один, и отдельный лимитер с другими
+    rpm/tpm пропускал бы сверх него. Другие лимиты для того же хаба — предупреждение.
+    """
+    limiter = _limiters.get(key)
+    if limiter is None:
+        limiter = _limiters[key] = RateLimiter(rpm, tpm)
+    elif (limiter.rpm, limiter.tpm) != (rpm, tpm):
+        print(
+            f"⚠️ Лимитер {key} уже создан с RPM={limiter.rpm}, TPM={limiter.tpm}; "
+            f"запрошенные RPM={rpm}, TPM={tpm} игнорируются"
+        )
+    return limiter
+
+
+def estimate_tokens(messages: list[dict], completion_tokens: int = 0) -> int:
+    """Грубая оценка токенов до вызова: ~3 символа кириллицы на токен + ожидаемый ответ."""
+    chars = sum(len(m.get("content") or "") for m in messages)
+    return chars // 3 + completion_tokens
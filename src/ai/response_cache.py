@@ -0,0 +1,116 @@
+import copy
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_query(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+class CachedResponse:
+    def __init__(self, vector: np.ndarray, response: dict, generation: str, mode: str = "auto", gate: dict | None = None):
+        self.vector = vector
+        self.response = response
+        self.generation = generation
+        self.mode = mode
+        self.gate = gate  # решение гейта LLM, с которым посчитан ответ — для заголовков на HIT
+        self.created_at = time.monotonic()
+
+
+class ResponseCache:
+    """
+    Кэш готовых ответов /diagnose перед всем пайплайном (NER + поиск + LLM).
+    Точное совпадение — по нормализованному тексту жалоб; почти-дубликаты —
+    по косинусу эмбеддинга запроса не ниже similarity.
+    Записи живут ttl секунд, сверх max_items вытесняются по LRU и привязаны к поколению индекса
+    (после переиндексации старые ответы считаются промахом) и к режиму гейта LLM (X-LLM-Gate):
+    ответ, посчитанный без LLM, не отдается запросу, который требует LLM, и наоборот.
+    """
+
+    def __init__(self, max_items: int = 1000, ttl: float = 3600, similarity: float = 0.97):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.similarity = similarity
+        self.entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._matrix = None  # векторы entries по порядку, пересобирается после изменений
+        self.hits_exact = 0
+        self.hits_semantic = 0
+        self.misses = 0
+        self.expired = 0
+
+    def _alive(self, entry: CachedResponse, generation: str) -> bool:
+        return entry.generation == generation and time.monotonic() - entry.created_at < self.ttl
+
+    @staticmethod
+    def _key(text: str, mode: str) -> tuple:
+        return mode, normalize_query(text)
+
+    def _drop(self, key: str):
+        del self.entries[key]
+        self._matrix = None
+
+    def get(self, text: str, vector, generation: str, mode: str = "auto"):
+        """(ответ, "exact" | "semantic", сходство, решение гейта) или None."""
+        key = self._key(text, mode)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if self._alive(entry, generation):
+                self.entries.move_to_end(key)
+                self.hits_exact += 1
+                return copy.deepcopy(entry.response), "exact", 1.0, copy.deepcopy(entry.gate)
+            self._drop(key)
+            self.expired += 1
+
+        if vector is not None and self.similarity < 1 and self.entries:
+            if self._matrix is None:
+                self._matrix = np.stack([e.vector for e in self.entries.values()])
+            query = np.asarray(vector, dtype=np.float32)
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+            scores = self._matrix @ query
+            keys = list(self.entries)
+            for i in np.argsort(-scores):
+                if scores[i] < self.similarity:
+                    break
+                best_key = keys[i]
+                best = self.entries[best_key]
+                if best.mode != mode or not self._alive(best, generation):
+                    continue
+                self.entries.move_to_end(best_key)
+                self._matrix = None
+                self.hits_semantic += 1
+                return copy.deepcopy(best.response), "semantic", float(scores[i]), copy.deepcopy(best.gate)
+
+        self.misses += 1
+        return None
+
+    def put(self, text: str, vector, generation: str, response: dict, mode: str = "auto", gate: dict | None = None):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        key = self._key(text, mode)
+        self.entries[key] = CachedResponse(vector, copy.deepcopy(response), generation, mode, copy.deepcopy(gate))
+        self.entries.move_to_end(key)
+        # Сначала выкидываем протухшие и чужие поколения, потом самые старые по LRU
+        if len(self.entries) > self.max_items:
+            for stale in [k for k, e in self.entries.items() if not self._alive(e, generation)]:
+                del self.entries[stale]
+                self.expired += 1
+        while len(self.entries) > self.max_items:
+            self.entries.popitem(last=False)
+        self._matrix = None
+
+    def stats(self) -> dict:
+        lookups = self.hits_exact + self.hits_semantic + self.misses
+        return {
+            "items": len(self.entries),
+            "max_items": self.max_items,
+            "ttl": self.ttl,
+            "similarity": self.similarity,
+            "hits_exact": self.hits_exact,
+            "hits_semantic": self.hits_semantic,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_ratio": round((self.hits_exact + self.hits_semantic) / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,75 @@
+import asyncio
+import copy
+
+# Схлопывание одинаковых запросов в полете: второй такой же запрос (двойной сабмит фронта,
+# повтор бэкенда по таймауту) не запускает пайплайн заново, а ждет результат первого.
+# После завершения ничего не хранится — это не кэш, а только общий вызов на время работы.
+
+
+class Flight:
+    def __init__(self, task: asyncio.Task, terms=None):
+        self.task = task
+        self.terms = terms  # условия первого вызова (дедлайн, приоритет) — с ними считается результат
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    do(key, fn): первый вызов с ключом запускает fn() отдельной задачей, остальные ждут ее же;
+    исключение получают все. Задача отменяется, только когда ушли все ожидающие
+    (отключился первый клиент — второй все равно получит ответ).
+    Результат считается на условиях первого вызова (terms): если accepts(terms) говорит, что они
+    слабее нужных вызывающему, он не присоединяется, а выполняет fn() сам, мимо общего вызова.
+    """
+
+    def __init__(self):
+        self._flights: dict = {}
+        self.leaders = 0
+        self.joined = 0
+        self.failed = 0
+        self.bypassed = 0
+
+    async def do(self, key, fn, terms=None, accepts=None):
+        """(результат, joined): joined=True — результат чужого вызова (отдается копия)."""
+        flight = self._flights.get(key)
+        if flight is not None and accepts is not None and not accepts(flight.terms):
+            self.bypassed += 1
+            return await fn(), False
+        joined = flight is not None
+        if joined:
+            self.joined += 1
+        else:
+            flight = Flight(asyncio.ensure_future(fn()), terms)
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda task: self._done(key, flight))
+            self.leaders += 1
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                # Ушел последний ожидающий: вызов больше никому не нужен, новые запросы начнут свой
+                flight.task.cancel()
+                self._finished(key, flight)
+            raise
+        finally:
+            flight.waiters -= 1
+        return (copy.deepcopy(result) if joined else result), joined
+
+    def _finished(self, key, flight: Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def _done(self, key, flight: Flight):
+        self._finished(key, flight)
+        if not flight.task.cancelled() and flight.task.exception() is not None:
+            self.failed += 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "joined": self.joined,
+            "bypassed": self.bypassed,
+            "failed": self.failed,
+        }
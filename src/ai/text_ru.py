@@ -0,0 +1,84 @@
+import re
+
+# Утилиты русского текста без внешних зависимостей: токенизация, легкий стемминг
+# (отрезание флексий, как упрощенный Snowball) и отрицания в пределах клаузы.
+
+RE_TOKEN = re.compile(r"[а-яёa-z0-9]+(?:-[а-яёa-z0-9]+)*|[.,;:!?()\n]")
+CLAUSE_BREAKS = {".", ";", ":", "!", "?", "(", ")", "\n", ",", "но", "а", "однако", "зато"}
+NEGATIONS = {"не", "нет", "ни", "без", "отрицает", "отрицаю", "отсутствует", "отсутствуют", "отсутствовал", "отсутствовала"}
+NEGATION_SCOPE = 4  # сколько слов после отрицания считаем отрицаемыми
+
+STOPWORDS = {
+    "и", "в", "во", "на", "с", "со", "по", "к", "ко", "о", "об", "от", "до", "из", "за", "для", "при", "под", "над",
+    "у", "а", "но", "или", "либо", "что", "как", "так", "же", "ли", "бы", "то", "это", "этот", "эта", "эти", "его",
+    "ее", "их", "он", "она", "оно", "они", "я", "мы", "вы", "ты", "мне", "меня", "нас", "вас", "уже", "еще", "очень",
+    "может", "могут", "быть", "был", "была", "были", "есть", "также", "более", "менее", "всех", "все", "всё", "весь",
+    "который", "которые", "которая", "которых", "такие", "такой", "другие", "других", "после", "перед", "между",
+    "через", "если", "когда", "чем", "где", "лет", "год", "года", "дней", "день", "раз", "случае", "случаях", "виде",
+    "наличие", "наличии", "отсутствие", "отсутствии", "характерно", "характерны", "отмечается", "отмечаются",
+    "являются", "является", "часто", "редко", "чаще", "реже", "обычно", "возможно", "возможны", "развитие", "течение",
+    # бытовой рассказ пациента: время, частота, связки
+    "недели", "неделю", "недель", "месяц", "месяца", "месяцев", "начала", "начал", "началось", "начались", "иногда",
+    "постоянно", "сейчас", "сегодня", "вчера", "ночью", "утром", "вечером", "сильно", "немного", "быстро", "время",
+    "раньше", "потом", "затем", "стал", "стала", "стало", "стали", "назад", "около", "всегда", "периодически",
+    "проблема", "проблемы", "здравствуйте", "пожалуйста", "подскажите", "помогите", "врач", "врачи", "врачу",
+    "почти", "только", "можно", "нужно", "надо", "таких", "такие", "чтобы", "сделать", "целью", "следующих", "могли",
+    "последних", "последние", "особенно", "примерно", "будто", "наоборот", "сначала", "сразу", "даже", "совсем",
+} | NEGATIONS
+
+# Окончания по убыванию длины: снимаем самое длинное, оставляя основу не короче 3 букв
+ENDINGS = sorted({
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ией", "ием", "иях", "иям",
+    "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ую", "юю", "ых", "их", "ом", "ем", "ам", "ям",
+    "ах", "ях", "ов", "ев", "ию", "ия", "ии", "ья", "ье", "ьи", "ью", "ешь", "ишь", "ете", "ите", "ет", "ит",
+    "ут", "ют", "ат", "ят", "ть", "ла", "ло", "ли", "ал", "ил", "ел", "ость", "ости",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+}, key=len, reverse=True)
+REFLEXIVE = ("ся", "сь")
+
+
+def normalize(text: str) -> str:
+    return text.lower().replace("ё", "е")
+
+
+def tokenize(text: str) -> list[str]:
+    """Слова и знаки-границы клауз (пунктуация остается отдельными токенами)."""
+    return RE_TOKEN.findall(normalize(text))
+
+
+def words(text: str) -> list[str]:
+    return [t for t in tokenize(text) if t[0].isalnum()]
+
+
+def stem(word: str) -> str:
+    if len(word) <= 3 or not word[0].isalpha():
+        return word
+    for suffix in REFLEXIVE:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            word = word[:-len(suffix)]
+            break
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def negation_flags(tokens: list[str]) -> list[bool]:
+    """
+    Для каждого токена: стоит ли он под отрицанием ("нет температуры", "без рвоты", "не было кашля").
+    Отрицание действует до границы клаузы (пунктуация, "но", "а") и не дальше NEGATION_SCOPE слов.
+    Сам маркер отрицания отрицаемым не считается.
+    """
+    flags = []
+    left = 0
+    for token in tokens:
+        if token in NEGATIONS:
+            flags.append(False)
+            left = NEGATION_SCOPE
+        elif token in CLAUSE_BREAKS:
+            flags.append(False)
+            left = 0
+        else:
+            flags.append(left > 0)
+            left = max(0, left - 1)
+    return flags
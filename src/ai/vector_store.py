@@ -0,0 +1,318 @@
+import json
+import os
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class Hit:
+    """Результат поиска: тот же набор полей, что у ScoredPoint Qdrant (id, score, payload)."""
+    id: int | str
+    score: float
+    payload: dict | None
+
+
+class VectorStore(ABC):
+    """Общий интерфейс векторного хранилища для сервера и отладочных скриптов."""
+
+    @abstractmethod
+    def search(self, vector, limit: int = 30) -> list[Hit]:
+        ...
+
+    def search_batch(self, vectors, limit: int = 30) -> list[list[Hit]]:
+        return [self.search(v, limit) for v in vectors]
+
+    def search_groups(self, vector, limit: int = 10, candidates: int = 0) -> list[Hit]:
+        """
+        Лучший чанк каждого из limit протоколов (ровно limit разных protocol_id, если столько есть).
+        Общий вариант — дозапрос с удвоением limit, бэкенды переопределяют его дешевле.
+        candidates — см. NumpyStore.search_groups_batch.
+        """
+        fetch = limit * 3
+        while True:
+            hits = self._group_search(vector, fetch)
+            best = {}
+            for hit in hits:
+                best.setdefault(hit.payload.get("protocol_id"), hit)
+            if len(best) >= limit or len(hits) < fetch:
+                return list(best.values())[:limit]
+            fetch *= 2
+
+    def _group_search(self, vector, limit: int) -> list[Hit]:
+        """Поиск для дозапроса search_groups: у hits должен быть protocol_id в payload."""
+        return self.search(vector, limit)
+
+    def search_groups_batch(self, vectors, limit: int = 10, candidates: int = 0) -> list[list[Hit]]:
+        return [self.search_groups(v, limit, candidates) for v in vectors]
+
+    @abstractmethod
+    def count(self) -> int:
+        ...
+
+    @abstractmethod
+    def scroll(self, limit: int = 10) -> list[Hit]:
+        """Первые limit точек с payload (для инспекции базы)."""
+
+    def iter_points(self):
+        """Все точки коллекции с payload (для словарей и индексов, которые строятся по базе)."""
+        return iter(self.scroll(limit=self.count()))
+
+    def iter_payloads(self):
+        return (hit.payload for hit in self.iter_points())
+
+    def retrieve(self, ids: list) -> list[Hit]:
+        """Точки по id в том же порядке (score=0), неизвестные id пропускаются."""
+        by_id = {hit.id: hit for hit in self.iter_points()}
+        return [by_id[i] for i in ids if i in by_id]
+
+    def close(self):
+        pass
+
+
+class QdrantStore(VectorStore):
+    """
+    Встроенный Qdrant (QdrantClient(path=...)) — источник правды, в него пишет ingest.
+    with_payload=False: поиск возвращает только id и скоры (payload=None), сервер берет
+    название, коды и текст из таблицы протоколов, а не десериализует payload каждой точки.
+    """
+
+    def __init__(self, path: str, collection_name: str, client=None, with_payload: bool = True):
+        if client is None:
+            from qdrant_client import QdrantClient
+            client = QdrantClient(path=path)
+        self.client = client
+        self.collection_name = collection_name
+        self.with_payload = with_payload
+
+    @staticmethod
+    def _hit(point) -> Hit:
+        return Hit(id=point.id, score=point.score, payload=point.payload)
+
+    def search(self, vector, limit: int = 30) -> list[Hit]:
+        points = self.client.query_points(
+            collection_name=self.collection_name, query=list(vector), limit=limit, with_payload=self.with_payload,
+        ).points
+        return [self._hit(p) for p in points]
+
+    def _group_search(self, vector, limit: int) -> list[Hit]:
+        # Группировать без payload нечем — для дозапроса тянем только protocol_id
+        points = self.client.query_points(
+            collection_name=self.collection_name, query=list(vector), limit=limit,
+            with_payload=True if self.with_payload else ["protocol_id"],
+        ).points
+        return [self._hit(p) for p in points]
+
+    def search_batch(self, vectors, limit: int = 30) -> list[list[Hit]]:
+        from qdrant_client.models import QueryRequest
+
+        responses = self.client.query_batch_points(
+            collection_name=self.collection_name,
+            requests=[QueryRequest(query=list(v), limit=limit, with_payload=self.with_payload) for v in vectors],
+        )
+        return [[self._hit(p) for p in r.points] for r in responses]
+
+    # search_groups — общий дозапрос: query_points_groups во встроенном Qdrant группирует на Python
+    # и на 882 точках был в ~20 раз медленнее (19.6 мс против 1 мс)
+
+    def count(self) -> int:
+        return self.client.count(collection_name=self.collection_name).count
+
+    def scroll(self, limit: int = 10) -> list[Hit]:
+        points, _ = self.client.scroll(collection_name=self.collection_name, limit=limit, with_payload=True)
+        return [Hit(id=p.id, score=0.0, payload=p.payload) for p in points]
+
+    def iter_points(self, page_size: int = 1000):
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=self.collection_name, limit=page_size, offset=offset, with_payload=True,
+            )
+            for p in points:
+                yield Hit(id=p.id, score=0.0, payload=p.payload)
+            if offset is None:
+                break
+
+    def retrieve(self, ids: list) -> list[Hit]:
+        if not ids:
+            return []
+        points = {p.id: p for p in self.client.retrieve(collection_name=self.collection_name, ids=ids, with_payload=True)}
+        return [Hit(id=i, score=0.0, payload=points[i].payload) for i in ids if i in points]
+
+    def export_numpy(self, path: str, dtype: str = "float32", page_size: int = 1000):
+        """Выгружает всю коллекцию в файлы NumpyStore."""
+        ids, vectors, payloads = [], [], []
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=self.collection_name, limit=page_size, offset=offset,
+                with_payload=True, with_vectors=True,
+            )
+            for p in points:
+                ids.append(p.id)
+                vectors.append(p.vector)
+                payloads.append(p.payload)
+            if offset is None:
+                break
+        NumpyStore.build(path, ids, vectors, payloads, dtype=dtype)
+        return len(ids)
+
+    def close(self):
+        self.client.close()
+
+
+class NumpyStore(VectorStore):
+    """
+    Точный поиск в памяти: все чанки лежат одной матрицей (N x 384),
+    один матричный умножитель считает скоры сразу для всех, top-k через argpartition.
+    Файлы: vectors.npy (нормированные строки, float32/float16, читаются через mmap)
+    и points.json (id и payload в том же порядке).
+    Для поиска по протоколам при загрузке считаются центроиды протоколов (G x 384)
+    и строки матрицы, сгруппированные по протоколу.
+    """
+
+    VECTORS_FILE = "vectors.npy"
+    POINTS_FILE = "points.json"
+
+    def __init__(self, path: str):
+        vectors = np.load(os.path.join(path, self.VECTORS_FILE), mmap_mode="r")
+        # float16 хорош на диске, но matmul в numpy на нем медленный — поднимаем один раз
+        self.vectors = np.asarray(vectors, dtype=np.float32) if vectors.dtype != np.float32 else vectors
+        with open(os.path.join(path, self.POINTS_FILE), "r", encoding="utf-8") as f:
+            points = json.load(f)
+        self.ids = [p["id"] for p in points]
+        self.payloads = [p["payload"] for p in points]
+        self._rows = None  # id -> строка, для retrieve()
+        self._build_groups()
+
+    def _build_groups(self):
+        protocol_ids = [p.get("protocol_id") for p in self.payloads]
+        self.group_ids = list(dict.fromkeys(protocol_ids))
+        group_of = {pid: g for g, pid in enumerate(self.group_ids)}
+        row_groups = np.array([group_of[pid] for pid in protocol_ids], dtype=np.int64)
+        # group_rows[group_offsets[g]:group_offsets[g + 1]] — строки протокола g
+        self.group_rows = np.argsort(row_groups, kind="stable")
+        counts = np.bincount(row_groups, minlength=len(self.group_ids))
+        self.group_offsets = np.concatenate([[0], np.cumsum(counts)])
+        if not len(self.group_rows):
+            self.centroids = np.zeros((0, self.vectors.shape[1]), dtype=np.float32)
+            return
+        sums = np.add.reduceat(np.asarray(self.vectors[self.group_rows], dtype=np.float32), self.group_offsets[:-1], axis=0)
+        self.centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+    @classmethod
+    def build(cls, path: str, ids: list, vectors, payloads: list[dict], dtype: str = "float32"):
+        os.makedirs(path, exist_ok=True)
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.maximum(norms, 1e-12)
+        np.save(os.path.join(path, cls.VECTORS_FILE), matrix.astype(dtype))
+        with open(os.path.join(path, cls.POINTS_FILE), "w", encoding="utf-8") as f:
+            json.dump([{"id": i, "payload": p} for i, p in zip(ids, payloads)], f, ensure_ascii=False)
+
+    def _top_k(self, scores: np.ndarray, limit: int) -> list[list[Hit]]:
+        limit = min(limit, scores.shape[1])
+        if limit <= 0:
+            return [[] for _ in range(scores.shape[0])]
+        top = np.argpartition(-scores, limit - 1, axis=1)[:, :limit]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        results = []
+        for rows, row_scores in zip(np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)):
+            results.append([
+                Hit(id=self.ids[r], score=float(s), payload=self.payloads[r]) for r, s in zip(rows, row_scores)
+            ])
+        return results
+
+    def search(self, vector, limit: int = 30) -> list[Hit]:
+        return self.search_batch([vector], limit)[0]
+
+    def search_batch(self, vectors, limit: int = 30) -> list[list[Hit]]:
+        queries = np.asarray(vectors, dtype=np.float32).reshape(-1, self.vectors.shape[1])
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        return self._top_k(queries @ self.vectors.T, limit)
+
+    def search_groups(self, vector, limit: int = 10, candidates: int = 0) -> list[Hit]:
+        return self.search_groups_batch([vector], limit, candidates)[0]
+
+    def search_groups_batch(self, vectors, limit: int = 10, candidates: int = 0) -> list[list[Hit]]:
+        """
+        Протоколу — скор его лучшего чанка. candidates=0: точно, скоры всех чанков и максимум по группам.
+        candidates>0: двухэтапно — грубо косинус к центроидам (limit * candidates протоколов-кандидатов),
+        точно — скоры чанков только этих протоколов (дешевле на больших корпусах, но может упустить протокол).
+        """
+        queries = np.asarray(vectors, dtype=np.float32).reshape(-1, self.vectors.shape[1])
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        limit = min(limit, len(self.group_ids))
+        if limit <= 0:
+            return [[] for _ in range(queries.shape[0])]
+        if candidates <= 0 or limit * candidates >= len(self.group_ids):
+            return self._exact_groups(queries, limit)
+        n_candidates = limit * candidates
+        coarse = queries @ self.centroids.T
+        shortlist = np.argpartition(-coarse, n_candidates - 1, axis=1)[:, :n_candidates]
+
+        results = []
+        for query, groups in zip(queries, shortlist):
+            starts, ends = self.group_offsets[groups], self.group_offsets[groups + 1]
+            rows = np.concatenate([self.group_rows[s:e] for s, e in zip(starts, ends)])
+            scores = self.vectors[rows] @ query
+            # Максимум по сегменту каждого кандидата и строка, где он достигнут
+            bounds = np.concatenate([[0], np.cumsum(ends - starts)])
+            best = np.maximum.reduceat(scores, bounds[:-1])
+            segment = np.repeat(np.arange(len(groups)), ends - starts)
+            at_max = np.flatnonzero(scores == best[segment])
+            _, first = np.unique(segment[at_max], return_index=True)
+            best_rows = rows[at_max[first]]
+            order = np.argsort(-best)[:limit]
+            results.append([
+                Hit(id=self.ids[best_rows[g]], score=float(best[g]), payload=self.payloads[best_rows[g]]) for g in order
+            ])
+        return results
+
+    def _exact_groups(self, queries: np.ndarray, limit: int) -> list[list[Hit]]:
+        scores = (queries @ self.vectors.T)[:, self.group_rows]
+        best = np.maximum.reduceat(scores, self.group_offsets[:-1], axis=1)
+        top = np.argpartition(-best, limit - 1, axis=1)[:, :limit]
+        results = []
+        for q_scores, q_best, groups in zip(scores, best, top):
+            groups = groups[np.argsort(-q_best[groups])]
+            hits = []
+            for g in groups:
+                start, end = self.group_offsets[g], self.group_offsets[g + 1]
+                row = self.group_rows[start + int(np.argmax(q_scores[start:end]))]
+                hits.append(Hit(id=self.ids[row], score=float(q_best[g]), payload=self.payloads[row]))
+            results.append(hits)
+        return results
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def scroll(self, limit: int = 10) -> list[Hit]:
+        return [Hit(id=i, score=0.0, payload=p) for i, p in zip(self.ids[:limit], self.payloads[:limit])]
+
+    def iter_points(self):
+        return (Hit(id=i, score=0.0, payload=p) for i, p in zip(self.ids, self.payloads))
+
+    def iter_payloads(self):
+        return iter(self.payloads)
+
+    def retrieve(self, ids: list) -> list[Hit]:
+        if self._rows is None:
+            self._rows = {point_id: row for row, point_id in enumerate(self.ids)}
+        rows = [self._rows[i] for i in ids if i in self._rows]
+        return [Hit(id=self.ids[r], score=0.0, payload=self.payloads[r]) for r in rows]
+
+
+def open_store(backend: str, qdrant_path: str, numpy_path: str, collection_name: str,
+               with_payload: bool = True) -> VectorStore:
+    """
+    backend: "qdrant" (встроенный Qdrant) или "numpy" (точный поиск в памяти).
+    with_payload=False — см. QdrantStore; NumpyStore держит payload в памяти, ему это ничего не стоит.
+    """
+    if backend == "numpy":
+        return NumpyStore(numpy_path)
+    if backend == "qdrant":
+        return QdrantStore(qdrant_path, collection_name, with_payload=with_payload)
+    raise ValueError(f"Неизвестный VECTOR_BACKEND: {backend}")
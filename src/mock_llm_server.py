@@ -0,0 +1,132 @@
+"""
+Fake OpenAI-compatible LLM hub for exercising retries, hedging and the circuit breaker.
+
+Usage:
+    uv run uvicorn src.mock_llm_server:app --host 127.0.0.1 --port 8100
+    LLM_BASE_URL=http://127.0.0.1:8100/v1 GPT_OSS_API_KEY=x uv run uvicorn src.ai.main:app
+
+Faults are configured at runtime (or with the same MOCK_LLM_* environment variables):
+    curl -X POST 127.0.0.1:8100/control -H 'Content-Type: application/json' \\
+         -d '{"error_rate": 0.5, "error_status": 503, "retry_after": 1, "delay": 0.2, "slow_rate": 0.1, "slow_delay": 5}'
+
+    error_rate   share of requests answered with error_status (429 adds Retry-After)
+    delay        base latency of every request, seconds
+    slow_rate    share of requests delayed by slow_delay instead (tail latency for hedging)
+GET /control returns the current settings and request counters.
+"""
+
+import asyncio
+import json
+import os
+import random
+import re
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Mock LLM Hub")
+
+settings = {
+    "error_rate": float(os.getenv("MOCK_LLM_ERROR_RATE", "0")),
+    "error_status": int(os.getenv("MOCK_LLM_ERROR_STATUS", "503")),
+    "retry_after": float(os.getenv("MOCK_LLM_RETRY_AFTER", "1")),
+    "delay": float(os.getenv("MOCK_LLM_DELAY", "0.2")),
+    "slow_rate": float(os.getenv("MOCK_LLM_SLOW_RATE", "0")),
+    "slow_delay": float(os.getenv("MOCK_LLM_SLOW_DELAY", "5")),
+}
+counters = {"requests": 0, "errors": 0, "slow": 0, "cancelled": 0}
+
+RE_CODES = re.compile(r"КОДЫ: ([A-Z]\d{2}(?:\.\d{1,2})?)")
+
+
+def answer(messages: list[dict]) -> str:
+    """A summary for NER prompts, otherwise a diagnoses JSON built from the codes in the context."""
+    text = messages[-1].get("content", "")
+    if "саммари" in text:
+        return "Боль в животе, лихорадка, тошнота"
+    codes = RE_CODES.findall(text) or ["R69"]
+    diagnoses = [
+        {"rank": i + 1, "icd_code": code, "name": f"Mock diagnosis {code}", "explanation": "mock"}
+        for i, code in enumerate(codes[:3])
+    ]
+    return "Ответ: " + json.dumps({"confidence": 0.7, "diagnoses": diagnoses}, ensure_ascii=False)
+
+
+def usage(content: str) -> dict:
+    return {"prompt_tokens": 100, "completion_tokens": len(content) // 3, "total_tokens": 100 + len(content) // 3}
+
+
+def completion(content: str, model: str) -> dict:
+    return {
+        "id": f"mock-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": usage(content),
+    }
+
+
+def stream_chunks(content: str, model: str, include_usage: bool = False):
+    for i in range(0, len(content), 8):
+        chunk = {
+            "id": "mock-stream",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": content[i:i + 8]}, "finish_reason": None}],
+        }
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    if include_usage:
+        # Как у OpenAI: последний чанк без choices, с usage за весь ответ
+        chunk = {"id": "mock-stream", "object": "chat.completion.chunk", "created": int(time.time()),
+                 "model": model, "choices": [], "usage": usage(content)}
+        yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/chat/completions")
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    counters["requests"] += 1
+    slow = random.random() < settings["slow_rate"]
+    counters["slow"] += slow
+    try:
+        await asyncio.sleep(settings["slow_delay"] if slow else settings["delay"])
+    except asyncio.CancelledError:
+        counters["cancelled"] += 1
+        raise
+
+    if random.random() < settings["error_rate"]:
+        counters["errors"] += 1
+        status = settings["error_status"]
+        headers = {"Retry-After": str(settings["retry_after"])} if status == 429 else {}
+        return JSONResponse(
+            {"error": {"message": f"mock error {status}", "type": "mock_error"}}, status_code=status, headers=headers,
+        )
+
+    model = body.get("model", "mock")
+    content = answer(body.get("messages", []))
+    if body.get("stream"):
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        return StreamingResponse(stream_chunks(content, model, include_usage), media_type="text/event-stream")
+    return completion(content, model)
+
+
+@app.get("/control")
+async def get_control():
+    return {"settings": settings, "counters": counters}
+
+
+@app.post("/control")
+async def set_control(request: Request):
+    updates = await request.json()
+    for key, value in updates.items():
+        if key in settings:
+            settings[key] = type(settings[key])(value)
+    if updates.get("reset_counters"):
+        for key in counters:
+            counters[key] = 0
+    return {"settings": settings, "counters": counters}
@@ -0,0 +1,111 @@
+import asyncio
+import unittest
+
+from src.ai.admission import NORMAL, URGENT, AdmissionController, Overloaded
+
+
+async def settle():
+    """Дать ожидающим задачам дойти до очереди."""
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+class AdmissionControllerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_free_slot_is_granted_immediately(self):
+        admission = AdmissionController(max_active=2, queue_size=1)
+        await admission.acquire()
+        await admission.acquire()
+        self.assertEqual(admission.active, 2)
+        admission.release()
+        admission.release()
+        self.assertEqual(admission.active, 0)
+
+    async def test_urgent_goes_first_and_slot_is_handed_over(self):
+        admission = AdmissionController(max_active=1, queue_size=4)
+        await admission.acquire()
+        order = []
+
+        async def wait(name, priority):
+            await admission.acquire(priority)
+            order.append(name)
+
+        tasks = [asyncio.create_task(wait("normal", NORMAL)), asyncio.create_task(wait("urgent", URGENT))]
+        await settle()
+        self.assertEqual(admission.depth(), 2)
+        admission.release()
+        await settle()
+        self.assertEqual(order, ["urgent"])
+        self.assertEqual(admission.active, 1)  # слот передан напрямую, а не освобожден
+        admission.release()
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ["urgent", "normal"])
+
+    async def test_urgent_preempts_normal_when_queue_is_full(self):
+        admission = AdmissionController(max_active=1, queue_size=1)
+        await admission.acquire()
+        normal = asyncio.create_task(admission.acquire(NORMAL))
+        await settle()
+        urgent = asyncio.create_task(admission.acquire(URGENT))
+        await settle()
+
+        with self.assertRaises(Overloaded) as raised:
+            await normal
+        self.assertEqual(raised.exception.reason, "preempted")
+        self.assertGreaterEqual(raised.exception.retry_after, 1.0)
+        admission.release()
+        await urgent
+        self.assertEqual(admission.active, 1)
+        self.assertEqual(admission.stats()["shed"], {"preempted": 1})
+
+    async def test_full_queue_sheds_equal_priority(self):
+        admission = AdmissionController(max_active=1, queue_size=1)
+        await admission.acquire()
+        waiting = asyncio.create_task(admission.acquire(NORMAL))
+        await settle()
+        with self.assertRaises(Overloaded) as raised:
+            await admission.acquire(NORMAL)
+        self.assertEqual(raised.exception.reason, "queue_full")
+        admission.release()
+        await waiting
+
+    async def test_sheds_when_estimated_wait_exceeds_budget(self):
+        admission = AdmissionController(max_active=1, queue_size=8)
+        await admission.acquire()
+        admission.release(held=4.0)
+        await admission.acquire()
+        with self.assertRaises(Overloaded) as raised:
+            await admission.acquire(max_wait=1.0)
+        self.assertEqual(raised.exception.reason, "wait")
+        self.assertEqual(raised.exception.retry_after, 4.0)
+        with self.assertRaises(Overloaded):
+            await admission.acquire(max_wait=0)
+        self.assertEqual(admission.depth(), 0)
+
+    async def test_timeout_and_cancel_leave_no_waiters(self):
+        admission = AdmissionController(max_active=1, queue_size=8)
+        await admission.acquire()
+        with self.assertRaises(Overloaded) as raised:
+            await admission.acquire(max_wait=0.01)
+        self.assertEqual(raised.exception.reason, "timeout")
+
+        cancelled = asyncio.create_task(admission.acquire())
+        await settle()
+        cancelled.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await cancelled
+        self.assertEqual(admission.depth(), 0)
+        admission.release()
+        self.assertEqual(admission.active, 0)
+
+    async def test_slot_context_releases_on_error(self):
+        admission = AdmissionController(max_active=1, queue_size=1)
+        with self.assertRaises(RuntimeError):
+            async with admission.slot():
+                self.assertEqual(admission.active, 1)
+                raise RuntimeError("stage failed")
+        self.assertEqual(admission.active, 0)
+        self.assertIsNotNone(admission.service_time)
+
+
+if __name__ == "__main__":
+    unittest.main()
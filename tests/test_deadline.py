@@ -0,0 +1,54 @@
+import asyncio
+import unittest
+
+from src.ai.deadline import Deadline, DeadlineExceeded, allows, from_headers, remaining, run_within, scope
+
+
+class DeadlineTest(unittest.IsolatedAsyncioTestCase):
+    async def test_stage_over_budget_is_cancelled_and_degraded(self):
+        cancelled = asyncio.Event()
+
+        async def slow_llm():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        with scope(Deadline(0.05)) as deadline:
+            with self.assertRaises(DeadlineExceeded):
+                await run_within(slow_llm(), stage="llm")
+        self.assertTrue(cancelled.is_set())
+        self.assertEqual(deadline.degraded, ["llm"])
+
+    async def test_own_timeout_of_stage_is_not_a_budget_overrun(self):
+        async def socket_timeout():
+            raise TimeoutError("read timed out")
+
+        with scope(Deadline(5.0)) as deadline:
+            with self.assertRaises(TimeoutError) as raised:
+                await run_within(socket_timeout(), stage="ner")
+        self.assertNotIsInstance(raised.exception, DeadlineExceeded)
+        self.assertEqual(str(raised.exception), "read timed out")
+        self.assertEqual(deadline.degraded, [])
+
+    async def test_exhausted_budget_skips_stage(self):
+        with scope(Deadline(1.0)) as deadline:
+            self.assertFalse(allows(0.5, reserve=0.9))
+            with self.assertRaises(DeadlineExceeded):
+                await run_within(asyncio.sleep(0), reserve=2.0, stage="search")
+        self.assertEqual(deadline.degraded, ["search"])
+
+    async def test_without_deadline_runs_unbounded(self):
+        self.assertIsNone(remaining())
+        self.assertEqual(await run_within(asyncio.sleep(0, "ok")), "ok")
+
+    def test_budget_from_headers(self):
+        self.assertEqual(from_headers({"x-request-timeout": "3"}, 20, 60).budget, 3.0)
+        self.assertEqual(from_headers({"x-request-timeout-ms": "1500"}, 20, 60).budget, 1.5)
+        self.assertEqual(from_headers({"x-request-timeout": "600"}, 20, 60).budget, 60)
+        self.assertEqual(from_headers({"x-request-timeout": "abc"}, 20, 60).budget, 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import json
+import unittest
+
+from src.ai.json_stream import DiagnosesParser
+
+
+def diagnoses(n: int) -> list[dict]:
+    return [{"rank": i, "icd_code": f"J0{i}", "name": f"диагноз {i}", "explanation": "x"} for i in range(1, n + 1)]
+
+
+def feed_in_chunks(parser: DiagnosesParser, text: str, size: int) -> int:
+    """Скармливает текст кусками по size символов; возвращает, сколько символов ушло до done."""
+    for start in range(0, len(text), size):
+        if parser.feed(text[start:start + size]):
+            return start + size
+    return len(text)
+
+
+class DiagnosesParserTest(unittest.TestCase):
+    def test_cuts_after_three_diagnoses_on_split_chunks(self):
+        text = "Конечно! ```json\n" + json.dumps({"confidence": 0.7, "diagnoses": diagnoses(5)}, ensure_ascii=False)
+        for size in (1, 3, 7, 64):
+            with self.subTest(chunk=size):
+                parser = DiagnosesParser(3)
+                consumed = feed_in_chunks(parser, text, size)
+                self.assertTrue(parser.done)
+                self.assertFalse(parser.complete)
+                self.assertEqual([d["rank"] for d in parser.diagnoses], [1, 2, 3])
+                # Четвертый диагноз уже не читали
+                self.assertLess(consumed, text.index('"rank": 4') + size)
+                self.assertEqual(parser.result(), {"confidence": 0.7, "diagnoses": diagnoses(3)})
+
+    def test_brackets_inside_strings_are_ignored(self):
+        items = [{"rank": 1, "icd_code": "K35", "name": "аппендицит {острый] }", "explanation": "кавычка \" и ]}"}]
+        text = json.dumps({"diagnoses": items + diagnoses(2)}, ensure_ascii=False)
+        parser = DiagnosesParser(3)
+        feed_in_chunks(parser, text, 5)
+        self.assertEqual(parser.diagnoses[0], items[0])
+        self.assertEqual(len(parser.diagnoses), 3)
+
+    def test_short_answer_completes_when_object_closes(self):
+        text = json.dumps({"confidence": 0.4, "diagnoses": diagnoses(2)}) + "\nНадеюсь, это поможет!"
+        parser = DiagnosesParser(3)
+        feed_in_chunks(parser, text, 4)
+        self.assertTrue(parser.done)
+        self.assertTrue(parser.complete)
+        # Болтовня после JSON в result() не попадает
+        self.assertEqual(parser.result(), {"confidence": 0.4, "diagnoses": diagnoses(2)})
+
+    def test_no_json_gives_no_result(self):
+        parser = DiagnosesParser(3)
+        self.assertFalse(parser.feed("Не могу ответить на этот вопрос."))
+        self.assertIsNone(parser.result())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from src.ai.llm_resilience import CircuitBreaker, CircuitOpenError, ResilientCaller, is_retryable, retry_after_seconds
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class HubError(Exception):
+    """Как ошибки openai: status_code и response с заголовками."""
+
+    def __init__(self, status: int, headers: dict | None = None):
+        super().__init__(f"hub {status}")
+        self.status_code = status
+        self.response = mock.Mock(status_code=status, headers=headers or {})
+
+
+def failing(status: int, calls: list):
+    async def fn():
+        calls.append(status)
+        raise HubError(status)
+    return fn
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch("src.ai.llm_resilience.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        print_patcher = mock.patch("builtins.print")
+        print_patcher.start()
+        self.addCleanup(print_patcher.stop)
+
+    def test_open_half_open_close(self):
+        breaker = CircuitBreaker(failures=2, reset_timeout=30)
+        breaker.failure()
+        self.assertEqual(breaker.state, "closed")
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allow())
+
+        self.clock.now += 30
+        self.assertTrue(breaker.allow())  # один пробный вызов
+        self.assertEqual(breaker.state, "half_open")
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, "closed")
+        self.assertEqual(breaker.failures, 0)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.stats()["opened"], 1)
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(failures=1, reset_timeout=30)
+        breaker.failure()
+        self.clock.now += 30
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, "open")
+        self.clock.now += 29
+        self.assertFalse(breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(breaker.allow())
+
+    def test_disabled_breaker_never_opens(self):
+        breaker = CircuitBreaker(failures=0)
+        for _ in range(10):
+            breaker.failure()
+        self.assertTrue(breaker.allow())
+
+
+class ResilientCallerTest(unittest.TestCase):
+    def setUp(self):
+        print_patcher = mock.patch("builtins.print")
+        print_patcher.start()
+        self.addCleanup(print_patcher.stop)
+
+    def caller(self, **kwargs) -> ResilientCaller:
+        return ResilientCaller(base_delay=0, max_delay=1, **kwargs)
+
+    def test_rate_limit_does_not_open_breaker(self):
+        caller = self.caller(max_attempts=3, breaker=CircuitBreaker(failures=2))
+        calls = []
+        for _ in range(3):
+            with self.assertRaises(HubError):
+                asyncio.run(caller.call(failing(429, calls)))
+        self.assertEqual(len(calls), 9)  # 429 повторяется
+        self.assertEqual(caller.breaker.state, "closed")
+        self.assertEqual(caller.breaker.failures, 0)
+
+    def test_server_errors_open_breaker(self):
+        caller = self.caller(max_attempts=3, breaker=CircuitBreaker(failures=2))
+        calls = []
+        with self.assertRaises(CircuitOpenError):
+            asyncio.run(caller.call(failing(503, calls)))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(caller.breaker.state, "open")
+        # Разомкнут — хаб даже не вызывается
+        with self.assertRaises(CircuitOpenError):
+            asyncio.run(caller.call(failing(503, calls)))
+        self.assertEqual(len(calls), 2)
+
+    def test_client_errors_are_not_retried(self):
+        caller = self.caller(max_attempts=3, breaker=CircuitBreaker(failures=1))
+        calls = []
+        with self.assertRaises(HubError):
+            asyncio.run(caller.call(failing(400, calls)))
+        self.assertEqual(calls, [400])
+        self.assertEqual(caller.breaker.state, "closed")
+
+    def test_retry_then_success(self):
+        caller = self.caller(max_attempts=3, breaker=CircuitBreaker(failures=5))
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise HubError(502)
+            return "ok"
+
+        self.assertEqual(asyncio.run(caller.call(flaky)), "ok")
+        self.assertEqual(caller.retries, 2)
+        self.assertEqual(caller.breaker.failures, 0)
+
+    def test_long_retry_after_fails_fast(self):
+        caller = self.caller(max_attempts=3)
+        calls = []
+
+        async def limited():
+            calls.append(1)
+            raise HubError(429, {"retry-after": "30"})
+
+        with self.assertRaises(HubError):
+            asyncio.run(caller.call(limited))
+        self.assertEqual(len(calls), 1)
+
+    def test_error_classification(self):
+        self.assertTrue(is_retryable(HubError(429)))
+        self.assertTrue(is_retryable(asyncio.TimeoutError()))
+        self.assertFalse(is_retryable(HubError(404)))
+        self.assertEqual(retry_after_seconds(HubError(429, {"retry-after-ms": "1500"})), 1.5)
+        self.assertEqual(retry_after_seconds(HubError(429, {"retry-after": "2"})), 2.0)
+        self.assertIsNone(retry_after_seconds(HubError(429, {"retry-after": "soon"})))
+
+
+if __name__ == "__main__":
+    unittest.main()
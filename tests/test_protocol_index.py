@@ -0,0 +1,42 @@
+import unittest
+
+from src.ai.protocol_index import code_covered, normalize_code
+
+
+class CodeCoveredTest(unittest.TestCase):
+    def test_exact_and_normalized(self):
+        self.assertTrue(code_covered("K35.8", ["K35.8"]))
+        self.assertTrue(code_covered(" k35.8 ", ["K35.8"]))
+        # Кириллица в коде (К вместо K) — тот же код
+        self.assertTrue(code_covered("К35.8", ["K35.8"]))
+        self.assertEqual(normalize_code("к35.8"), "K35.8")
+
+    def test_more_specific_code_under_parent(self):
+        self.assertTrue(code_covered("K35.8", ["K35"]))
+        self.assertTrue(code_covered("I21.01", ["I21.0"]))
+        # Другая рубрика с тем же началом — не уточнение
+        self.assertFalse(code_covered("K351", ["K35"]))
+        self.assertFalse(code_covered("K36", ["K35"]))
+        # Более общий код, чем у протокола, не покрыт
+        self.assertFalse(code_covered("K35", ["K35.8"]))
+
+    def test_ranges(self):
+        for allowed in ("K80-K87", "K80–K87", "K80 — K87", "K80.0-K87.1"):
+            with self.subTest(range=allowed):
+                self.assertTrue(code_covered("K80", [allowed]))
+                self.assertTrue(code_covered("K81.0", [allowed]))
+                self.assertTrue(code_covered("K87.9", [allowed]))
+                self.assertFalse(code_covered("K79.9", [allowed]))
+                self.assertFalse(code_covered("K88", [allowed]))
+                self.assertFalse(code_covered("J81", [allowed]))
+
+    def test_any_of_several_codes(self):
+        codes = {"J06.9", "A00-A09", "K35"}
+        self.assertTrue(code_covered("A04.7", codes))
+        self.assertTrue(code_covered("K35.2", codes))
+        self.assertFalse(code_covered("J18", codes))
+        self.assertFalse(code_covered("J18", []))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from src.ai.rate_limiter import RateLimiter, TokenBucket, estimate_tokens, get_limiter
+
+
+class Clock:
+    """Подменяет time.monotonic в rate_limiter: время двигается только вручную."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_refill_over_time_up_to_capacity(self):
+        bucket = TokenBucket(60, 1.0)
+        bucket.updated = 0.0
+        bucket.consume(60)
+        self.assertEqual(bucket.wait_time(1, now=0.0), 1.0)
+        self.assertEqual(bucket.wait_time(10, now=4.0), 6.0)
+        self.assertEqual(bucket.wait_time(10, now=10.0), 0.0)
+        # Простой дольше минуты не копит больше capacity
+        bucket.wait_time(1, now=1000.0)
+        self.assertEqual(bucket.level, 60)
+
+    def test_debt_and_oversized_request(self):
+        bucket = TokenBucket(60, 1.0)
+        bucket.updated = 0.0
+        bucket.consume(90)  # ушли в долг на 30
+        self.assertEqual(bucket.wait_time(1, now=0.0), 31.0)
+        # Запрос больше ведра ждет только полного ведра
+        self.assertEqual(bucket.wait_time(1000, now=30.0), 60.0)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch("src.ai.rate_limiter.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requests_per_minute(self):
+        limiter = RateLimiter(rpm=2)
+        asyncio.run(limiter.acquire())
+        asyncio.run(limiter.acquire())
+        self.assertFalse(limiter.ready())
+        self.assertAlmostEqual(limiter._delay(0), 30.0)
+        self.clock.now += 30
+        self.assertTrue(limiter.ready())
+
+    def test_penalize_blocks_until_retry_after(self):
+        limiter = RateLimiter(rpm=60)
+        self.assertTrue(limiter.ready())
+        limiter.penalize(5.0)
+        self.assertFalse(limiter.ready())
+        self.assertLessEqual(limiter.requests.level, 0)
+        self.clock.now += 4.9
+        self.assertFalse(limiter.ready())
+        self.clock.now += 0.2
+        self.assertTrue(limiter.ready())
+        # Более короткий Retry-After не сокращает уже назначенную блокировку
+        limiter.penalize(10.0)
+        limiter.penalize(1.0)
+        self.clock.now += 5
+        self.assertFalse(limiter.ready())
+
+    def test_settle_corrects_token_estimate(self):
+        limiter = RateLimiter(rpm=0, tpm=600)
+        asyncio.run(limiter.acquire(100))
+        self.assertEqual(limiter.tokens.level, 500)
+        limiter.settle(100, 300)
+        self.assertEqual(limiter.tokens.level, 300)
+        limiter.settle(300, 0)  # usage не пришел — оценка остается
+        self.assertEqual(limiter.tokens.level, 300)
+        self.assertTrue(limiter.ready(300))
+        self.assertFalse(limiter.ready(301))
+
+
+class RegistryTest(unittest.TestCase):
+    def test_first_configuration_wins(self):
+        first = get_limiter("http://hub.test/registry", rpm=15)
+        with mock.patch("builtins.print") as printed:
+            again = get_limiter("http://hub.test/registry", rpm=15)
+            printed.assert_not_called()
+            other = get_limiter("http://hub.test/registry", rpm=30, tpm=1000)
+            printed.assert_called_once()
+        self.assertIs(first, again)
+        self.assertIs(first, other)
+        self.assertEqual((other.rpm, other.tpm), (15, 0))
+
+    def test_estimate_tokens(self):
+        messages = [{"role": "user", "content": "а" * 300}, {"role": "system", "content": None}]
+        self.assertEqual(estimate_tokens(messages, 50), 150)
+
+
+if __name__ == "__main__":
+    unittest.main()
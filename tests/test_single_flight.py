@@ -0,0 +1,97 @@
+import asyncio
+import unittest
+
+from src.ai.single_flight import SingleFlight
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.flights = SingleFlight()
+        self.release = asyncio.Event()
+        self.calls = 0
+
+    async def compute(self):
+        self.calls += 1
+        await self.release.wait()
+        return {"diagnoses": [{"rank": 1}]}
+
+    async def test_followers_share_one_call_and_get_copies(self):
+        leader = asyncio.create_task(self.flights.do("key", self.compute))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(self.flights.do("key", self.compute))
+        await asyncio.sleep(0)
+        self.release.set()
+        (first, joined_first), (second, joined_second) = await asyncio.gather(leader, follower)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual((joined_first, joined_second), (False, True))
+        self.assertEqual(first, second)
+        second["diagnoses"].append({"rank": 2})
+        self.assertEqual(len(first["diagnoses"]), 1)
+        self.assertEqual(self.flights.stats()["in_flight"], 0)
+
+    async def test_leader_cancellation_keeps_call_for_followers(self):
+        leader = asyncio.create_task(self.flights.do("key", self.compute))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(self.flights.do("key", self.compute))
+        await asyncio.sleep(0)
+
+        leader.cancel()  # первый клиент отключился
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        self.assertFalse(follower.done())
+        self.assertEqual(self.flights.stats()["in_flight"], 1)
+
+        self.release.set()
+        result, joined = await follower
+        self.assertTrue(joined)
+        self.assertEqual(result, {"diagnoses": [{"rank": 1}]})
+        self.assertEqual(self.calls, 1)
+
+    async def test_last_waiter_leaving_cancels_the_call(self):
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def compute():
+            started.set()
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        task = asyncio.create_task(self.flights.do("key", compute))
+        await started.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        await asyncio.wait_for(cancelled.wait(), 1)
+        self.assertEqual(self.flights.stats()["in_flight"], 0)
+
+    async def test_errors_reach_every_waiter(self):
+        async def broken():
+            await self.release.wait()
+            raise ValueError("LLM вернула битый JSON")
+
+        waiters = [asyncio.create_task(self.flights.do("key", broken)) for _ in range(3)]
+        await asyncio.sleep(0)
+        self.release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(self.flights.stats()["failed"], 1)
+
+    async def test_stricter_caller_runs_on_its_own(self):
+        leader = asyncio.create_task(self.flights.do("key", self.compute, terms=(1, 100.0)))
+        await asyncio.sleep(0)
+
+        async def own():
+            return "свой результат"
+
+        result, joined = await self.flights.do("key", own, terms=(0, 50.0), accepts=lambda leader_terms: False)
+        self.assertEqual((result, joined), ("свой результат", False))
+        self.assertEqual(self.flights.stats()["bypassed"], 1)
+        self.release.set()
+        await leader
+
+
+if __name__ == "__main__":
+    unittest.main()